@@ -0,0 +1,60 @@
+from smart.common import rdf_ontology
+import os, sys, time, argparse, tempfile
+
+"""
+Time ontology startup: a full parse of smart.owl (parse_ontology),
+a first start that parses and writes the snapshot, and a start that
+loads the snapshot (load_ontology with a matching hash).
+
+To run:
+
+PYTHONPATH=/path/to/smart_server \\
+  /usr/bin/python \\
+  benchmarks/ontology_startup.py [--ontology smart/document_processing/schema/smart.owl] [--repeat 5]
+"""
+
+def reset():
+    rdf_ontology.SMArtCall.store = {}
+    rdf_ontology.SMArtType.store = {}
+    rdf_ontology.SMArtType.compiled_queries = {}
+
+def best_of(repeat, f):
+    best = None
+    for r in xrange(repeat):
+        reset()
+        started = time.time()
+        f()
+        elapsed = time.time() - started
+        best = best is None and elapsed or min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time ontology startup with and without a snapshot.")
+    parser.add_argument("--ontology", default="smart/document_processing/schema/smart.owl")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    f = open(args.ontology).read()
+    snapshot = os.path.join(tempfile.mkdtemp(), "smart.owl.snapshot")
+
+    def first_start():
+        if os.path.exists(snapshot): os.remove(snapshot)
+        assert not rdf_ontology.load_ontology(f, snapshot)
+
+    def snapshot_start():
+        assert rdf_ontology.load_ontology(f, snapshot), "Snapshot missed"
+
+    stdout = sys.stdout
+    sys.stdout = sys.stderr     # parse_ontology prints
+    parse = best_of(args.repeat, lambda: rdf_ontology.parse_ontology(f))
+    first = best_of(args.repeat, first_start)
+    warm = best_of(args.repeat, snapshot_start)
+    sys.stdout = stdout
+
+    print "%s types, %s calls, %s compiled queries; snapshot is %s bytes"%(
+        len(rdf_ontology.api_types), len(rdf_ontology.api_calls),
+        len(rdf_ontology.SMArtType.compiled_queries), os.path.getsize(snapshot))
+    print "parse:            %8.1f ms"%(parse * 1e3)
+    print "parse + snapshot: %8.1f ms"%(first * 1e3)
+    print "from snapshot:    %8.1f ms (%.0fx)"%(warm * 1e3, parse / warm)
+    os.remove(snapshot)
@@ -0,0 +1,60 @@
+from smart.common.util import parse_rdf, serialize_rdf, serialize_ntriples, parse_ntriples, bound_graph, URIRef, BNode, Literal, rdf, sp
+import sys, time, argparse
+
+"""
+Compare the cost of reading a SPARQL CONSTRUCT result back as RDF/XML,
+as N-Triples through rdflib's parser, and as N-Triples through
+smart.common.util's fast parser.
+
+To run:
+
+PYTHONPATH=/path/to/smart_server \
+  /usr/bin/python \
+  benchmarks/parse_formats.py [--triples 50000] [--repeat 3]
+"""
+
+def sample_graph(n):
+    """Roughly n triples shaped like a record's medication list."""
+    g = bound_graph()
+    i = 0
+    while len(g) < n:
+        m = URIRef("http://smartplatforms.org/records/1/medications/%s"%i)
+        code = BNode()
+        g.add((m, rdf.type, sp.Medication))
+        g.add((m, sp.drugName, code))
+        g.add((code, rdf.type, sp.CodedValue))
+        g.add((code, sp.code, URIRef("http://rxnav.nlm.nih.gov/REST/rxcui/%s"%(i % 500))))
+        g.add((code, URIRef("http://purl.org/dc/terms/title"), Literal(u"Drug \u00e9 %s 10mg \"tablet\""%i)))
+        g.add((m, sp.startDate, Literal("2007-03-%02d"%(i % 28 + 1))))
+        g.add((m, sp.instructions, Literal("Take one tablet by mouth\ndaily", lang="en")))
+        i += 1
+    return g
+
+def per_10k(f, data, triples, repeat):
+    best = None
+    for r in xrange(repeat):
+        started = time.time()
+        f(data)
+        elapsed = time.time() - started
+        best = best is None and elapsed or min(best, elapsed)
+    return best * 10000.0 / triples * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time RDF result parsing per 10k triples.")
+    parser.add_argument("--triples", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    g = sample_graph(args.triples)
+    n = len(g)
+    xml = serialize_rdf(g)
+    nt = serialize_ntriples(g)
+    print "%s triples: %s bytes of RDF/XML, %s bytes of N-Triples"%(n, len(xml), len(nt))
+
+    for (name, f, data) in [
+        ("RDF/XML (rdflib)", lambda d: parse_rdf(d, format="xml"), xml),
+        ("N-Triples (rdflib)", lambda d: bound_graph().parse(data=d, format="nt"), nt),
+        ("N-Triples (fast parser)", lambda d: list(parse_ntriples(d)), nt),
+        ("N-Triples (fast parser, into graph)", lambda d: parse_rdf(d, format="nt"), nt)]:
+        print "%-38s %8.1f ms / 10k triples"%(name, per_10k(f, data, n, args.repeat))
+        sys.stdout.flush()
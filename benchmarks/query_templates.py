@@ -0,0 +1,56 @@
+from smart.common import rdf_ontology
+import sys, time, argparse
+
+"""
+Time SMArtType query generation for every api_type: building each
+query from the ontology (build_query) against filling in the compiled
+template (query), for query_all, query_one and -- where a type sits
+below another -- query_all beneath a parent.
+
+To run:
+
+PYTHONPATH=/path/to/smart_server \\
+  /usr/bin/python \\
+  benchmarks/query_templates.py [--ontology smart/document_processing/schema/smart.owl] [--repeat 100]
+"""
+
+def shapes(t):
+    """(description, kwargs) for each query shape this type is asked for."""
+    ret = [("all", {}),
+           ("one", {"one_name": "<http://localhost:7000/records/1/items/123>"})]
+    for above in t.containing_types.keys():
+        ret.append(("below %s"%above.name, {"above_type": above, "above_uri": "http://localhost:7000/records/1/parent"}))
+    return ret
+
+def best_of(repeat, f):
+    best = None
+    for r in xrange(3):
+        started = time.time()
+        for i in xrange(repeat): f()
+        elapsed = (time.time() - started) / repeat
+        best = best is None and elapsed or min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time query generation for every api_type.")
+    parser.add_argument("--ontology", default="smart/document_processing/schema/smart.owl")
+    parser.add_argument("--repeat", type=int, default=100)
+    args = parser.parse_args()
+
+    if not rdf_ontology.parsed:
+        rdf_ontology.parse_ontology(open(args.ontology).read())
+
+    total_built, total_filled, n = 0.0, 0.0, 0
+    for t in sorted(rdf_ontology.api_types, key=lambda t: str(t.node)):
+        for (name, kwargs) in shapes(t):
+            assert t.query(**kwargs) == t.build_query(**kwargs), "Compiled query differs for %s %s"%(t, name)
+            built = best_of(max(1, args.repeat / 10), lambda: t.build_query(**kwargs))
+            filled = best_of(args.repeat, lambda: t.query(**kwargs))
+            total_built += built
+            total_filled += filled
+            n += 1
+            print "%-60s %10.1f us %8.1f us"%("%s (%s)"%(t.node, name), built * 1e6, filled * 1e6)
+            sys.stdout.flush()
+
+    print "%s queries: %.1f ms to build them all, %.3f ms to fill them all (%.0fx)"%(
+        n, total_built * 1e3, total_filled * 1e3, total_filled and total_built / total_filled or 0)
@@ -0,0 +1,78 @@
+from smart.common.util import remap_node, remap_nodes, bound_graph, URIRef, BNode, Literal, rdf, sp
+import sys, time, argparse
+
+"""
+Compare remapping every blank node and external-ID URI of an incoming
+patient graph one node at a time (remap_node, as generate_uris used to)
+against one remap_nodes pass over the whole mapping.
+
+To run:
+
+PYTHONPATH=/path/to/smart_server \\
+  /usr/bin/python \\
+  benchmarks/remap_nodes.py [--triples 50000] [--repeat 3]
+"""
+
+def sample_patient(n):
+    """Roughly n triples shaped like a POSTed patient file: external-ID
+    medications and problems, each with coded-value blank nodes."""
+    triples = []
+    i = 0
+    while len(triples) < n:
+        m = URIRef("urn:smart_external_id:med_%s"%i)
+        code = BNode()
+        p = BNode()
+        pcode = BNode()
+        triples.extend([
+            (m, rdf.type, sp.Medication),
+            (m, sp.drugName, code),
+            (code, rdf.type, sp.CodedValue),
+            (code, sp.code, URIRef("http://rxnav.nlm.nih.gov/REST/rxcui/%s"%(i % 500))),
+            (code, URIRef("http://purl.org/dc/terms/title"), Literal("Drug %s 10mg tablet"%i)),
+            (m, sp.startDate, Literal("2007-03-%02d"%(i % 28 + 1))),
+            (p, rdf.type, sp.Problem),
+            (p, sp.problemName, pcode),
+            (pcode, rdf.type, sp.CodedValue),
+            (pcode, URIRef("http://purl.org/dc/terms/title"), Literal("Problem %s"%i)),
+            (p, sp.onset, Literal("2007-04-%02d"%(i % 28 + 1)))])
+        i += 1
+    g = bound_graph()
+    g.addN([t + (g,) for t in triples])
+    return g
+
+def node_map(g):
+    nodes = set(g.subjects()) | set(g.objects())
+    return dict([(n, URIRef("http://localhost:7000/records/1/items/%s"%i)) for (i, n) in enumerate(nodes)
+                 if type(n) == BNode or str(n).startswith("urn:smart_external_id:")])
+
+def one_at_a_time(g, m):
+    for (old, new) in m.iteritems():
+        remap_node(g, old, new)
+        if type(old) == URIRef: g.add((old, sp.externalIDFor, new))
+
+def best_of(repeat, n, f):
+    best = None
+    for r in xrange(repeat):
+        g = sample_patient(n)
+        m = node_map(g)
+        started = time.time()
+        f(g, m)
+        elapsed = time.time() - started
+        best = best is None and elapsed or min(best, elapsed)
+    return (best, g)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time remapping an incoming patient graph's nodes.")
+    parser.add_argument("--triples", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    g = sample_patient(args.triples)
+    print "%s triples, %s nodes to remap"%(len(g), len(node_map(g)))
+
+    (slow, a) = best_of(args.repeat, args.triples, one_at_a_time)
+    print "remap_node per node: %8.1f ms"%(slow * 1e3)
+    sys.stdout.flush()
+    (fast, b) = best_of(args.repeat, args.triples, lambda g, m: remap_nodes(g, m, sp.externalIDFor))
+    print "remap_nodes:         %8.1f ms (%.1fx)"%(fast * 1e3, slow / fast)
+    assert len(a) == len(b), "Remapped graphs differ in size"
@@ -0,0 +1,68 @@
+from smart.common.util import serialize_rdf, bound_graph, URIRef, BNode, Literal, rdf, sp
+from rdflib.compare import isomorphic
+import sys, time, argparse
+
+"""
+Compare the cost of writing a response graph with rdflib's pretty-xml
+serializer (what serialize_rdf used to call) against the streaming
+RDF/XML, N-Triples and Turtle writers in smart.common.util, and check
+that each one's output parses back to the same graph.
+
+To run:
+
+PYTHONPATH=/path/to/smart_server \\
+  /usr/bin/python \\
+  benchmarks/serializers.py [--triples 50000] [--repeat 3]
+"""
+
+def sample_graph(n):
+    """Roughly n triples shaped like a record's medication list."""
+    triples = []
+    i = 0
+    while len(triples) < n:
+        m = URIRef("http://smartplatforms.org/records/1/medications/%s"%i)
+        code = BNode()
+        triples.extend([
+            (m, rdf.type, sp.Medication),
+            (m, sp.drugName, code),
+            (code, rdf.type, sp.CodedValue),
+            (code, sp.code, URIRef("http://rxnav.nlm.nih.gov/REST/rxcui/%s"%(i % 500))),
+            (code, URIRef("http://purl.org/dc/terms/title"), Literal(u"Drug \u00e9 %s 10mg \"tablet\" <&>"%i)),
+            (m, sp.startDate, Literal("2007-03-%02d"%(i % 28 + 1))),
+            (m, sp.instructions, Literal("Take one tablet by mouth\ndaily", lang="en"))])
+        i += 1
+    g = bound_graph()
+    g.addN([t + (g,) for t in triples])
+    return g
+
+def per_10k(f, triples, repeat):
+    best = None
+    for r in xrange(repeat):
+        started = time.time()
+        f()
+        elapsed = time.time() - started
+        best = best is None and elapsed or min(best, elapsed)
+    return best * 10000.0 / triples * 1000
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time RDF serialization per 10k triples.")
+    parser.add_argument("--triples", type=int, default=50000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    g = sample_graph(args.triples)
+    n = len(g)
+    small = sample_graph(1000)
+    print "%s triples"%n
+
+    for (name, f, parse_format) in [
+        ("pretty-xml (rdflib)", lambda m: m.serialize(format="pretty-xml"), "xml"),
+        ("N-Triples (rdflib)", lambda m: m.serialize(format="nt"), "nt"),
+        ("RDF/XML (streaming)", lambda m: serialize_rdf(m, "xml"), "xml"),
+        ("N-Triples (streaming)", lambda m: serialize_rdf(m, "nt"), "nt"),
+        ("Turtle (streaming)", lambda m: serialize_rdf(m, "turtle"), "n3")]:
+        out = bound_graph().parse(data=f(small), format=parse_format)
+        assert isomorphic(out, small), "%s doesn't round-trip"%name
+        print "%-24s %8.1f ms / 10k triples, %9s bytes"%(
+            name, per_10k(lambda: f(g), n, args.repeat), len(f(g)))
+        sys.stdout.flush()
@@ -0,0 +1,67 @@
+from smart.common import rdf_ontology
+from smart.models.ontology_url_patterns import OntologyURLMapper, CallMapper, BasicCallMapper
+import re, sys, time, argparse
+
+"""
+Time routing a request path for every api_call: the URLTrie that
+OntologyURLMapper builds, against the per-path regex list it used to
+append to urlpatterns (tried longest path first, as Django would).
+
+To run:
+
+DJANGO_SETTINGS_MODULE=settings PYTHONPATH=/path/to/smart_server \\
+  /usr/bin/python \\
+  benchmarks/url_routing.py [--repeat 1000]
+"""
+
+def view(request, **kwargs):
+    pass
+
+class EveryCallMapper(BasicCallMapper):
+    """Maps every call, so routes can be built without loading the views."""
+    maps_to = staticmethod(view)
+    @property
+    def map_score(self): return 1
+
+def example_path(path):
+    """A request path for an OWL path, with each {variable} filled in."""
+    return re.sub("{(.*?)}", lambda m: "%s_123"%m.group(1), str(path).split("?")[0])[1:]
+
+def best_of(repeat, f):
+    best = None
+    for r in xrange(3):
+        started = time.time()
+        for i in xrange(repeat): f()
+        elapsed = (time.time() - started) / repeat
+        best = best is None and elapsed or min(best, elapsed)
+    return best
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time ontology URL routing.")
+    parser.add_argument("--repeat", type=int, default=1000)
+    args = parser.parse_args()
+
+    CallMapper.register(EveryCallMapper)
+    mapper = OntologyURLMapper([])
+    regexes = [re.compile(mapper.django_path(p), re.UNICODE) for (p, calls) in mapper.calls_by_path()]
+
+    def regex_resolve(path):
+        for r in regexes:
+            m = r.search(path)
+            if m: return m.groupdict()
+
+    total_regex, total_trie, n = 0.0, 0.0, 0
+    for p in sorted(set([str(c.path) for c in rdf_ontology.api_calls])):
+        path = example_path(p)
+        expected = regex_resolve(path)
+        assert mapper.trie.resolve(path)[2] == expected, "Trie routes %s differently"%path
+        by_regex = best_of(args.repeat, lambda: regex_resolve(path))
+        by_trie = best_of(args.repeat, lambda: mapper.trie.resolve(path))
+        total_regex += by_regex
+        total_trie += by_trie
+        n += 1
+        print "%-80s %8.2f us %8.2f us"%(p, by_regex * 1e6, by_trie * 1e6)
+        sys.stdout.flush()
+
+    print "%s paths (%s regexes): %.2f us per path by regex list, %.2f us by trie (%.1fx)"%(
+        n, len(regexes), total_regex / n * 1e6, total_trie / n * 1e6, total_regex / total_trie)
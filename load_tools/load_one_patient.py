@@ -2,7 +2,7 @@ from smart.models.rdf_store import TemporaryStoreConnector, RecordStoreConnector
 from smart.models.record_object import api_types, Record, RecordObject
 from smart.common.util import parse_rdf, serialize_rdf, remap_node, bound_graph, URIRef, BNode, sp
 from django.conf import settings
-import sys
+import sys, argparse
 
 """
 To run:
@@ -11,12 +11,16 @@ PYTHONPATH=/path/to/smart_server \
   DJANGO_SETTINGS_MODULE=settings \
   /usr/bin/python \
   load_tools/load_one_patient.py \
+  [--batch-size 5000] [--workers 4] [--atomic] \
   records/* 
 """
 class RecordImporter(object):
-    def __init__(self, filename, target_id=None):            
+    def __init__(self, filename, target_id=None, batch_size=5000, workers=4, atomic=False):
         # 0. Read supplied data
         self.target_id = target_id
+        self.batch_size = batch_size
+        self.workers = workers
+        self.atomic = atomic
         self.data = parse_rdf(open(filename).read())
 
         # 1. For each known data type, extract relevant nodes
@@ -32,11 +36,18 @@ class RecordImporter(object):
             rconn = RecordStoreConnector(r)
             if not created:
                 print "DESTROYING existing record"
-                rconn.destroy_triples()
+                if self.atomic:
+                    # cleared in the same update that swaps the new data in
+                    rconn.pending_clears.append(URIRef(rconn.context.encode()))
+                else:
+                    rconn.destroy_triples()
                 
             self.add_all(rconn, self.data)
             print "adds: ",len(rconn.pending_adds)
-            rconn.execute_transaction()
+            stats = rconn.execute_bulk_transaction(batch_size=self.batch_size,
+                                                   workers=self.workers,
+                                                   atomic=self.atomic)
+            print "committed %(statements)s statements in %(batches)s batches: %(seconds).2fs, %(statements_per_sec).0f statements/sec"%stats
         
     @staticmethod
     def add_all(connector, model):
@@ -44,8 +55,17 @@ class RecordImporter(object):
             connector.pending_adds.append(a)
 
 if __name__ == "__main__":
-    import string
-    for v in sys.argv[1:]:
+    parser = argparse.ArgumentParser(description="Load patient RDF files into the SMArt record store.")
+    parser.add_argument("--batch-size", type=int, default=5000,
+                        help="statements per transaction (default 5000)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="transactions sent concurrently (default 4)")
+    parser.add_argument("--atomic", action="store_true",
+                        help="stage each record and swap it in all-or-nothing (needs SPARQL 1.1 Update)")
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    for v in args.files:
         rid = filter(str.isdigit, v.split("/")[-1].split(".")[0])
         print "Using record id: %s"%rid
-        RecordImporter(v, rid)
+        RecordImporter(v, rid, args.batch_size, args.workers, args.atomic)
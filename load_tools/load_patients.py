@@ -0,0 +1,182 @@
+from smart.models.rdf_store import RecordStoreConnector
+from smart.models.record_object import Record, RecordObject
+from smart.common.util import parse_rdf, serialize_ntriples, parse_ntriples, URIRef, sp
+from django.utils import simplejson
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+import os, sys, time, hashlib, threading, argparse
+
+"""
+Load many patient RDF files into the SMArt record store.
+
+Files are parsed and prepared (prepare_graph) in a pool of processes;
+each prepared record is then committed as a bulk transaction (see
+SesameConnector.execute_bulk_transaction), several records at a time.
+Every commit is noted in a manifest (file hash --> record id -->
+committed), so a rerun after a crash skips the records already loaded.
+
+To run:
+
+PYTHONPATH=/path/to/smart_server \\
+  DJANGO_SETTINGS_MODULE=settings \\
+  /usr/bin/python \\
+  load_tools/load_patients.py \\
+  [--processes 4] [--uploads 4] [--batch-size 5000] [--workers 4] [--atomic] \\
+  [--manifest load_patients.manifest] \\
+  records/*
+"""
+
+def record_id_for(filename):
+    """The digits of the file's name (as load_one_patient uses), or of
+    its directory's name for records/<id>/data.rdf."""
+    (head, name) = os.path.split(filename)
+    return filter(str.isdigit, name.split(".")[0]) or filter(str.isdigit, os.path.basename(head))
+
+def file_hash(filename):
+    h = hashlib.sha1()
+    f = open(filename, "rb")
+    for chunk in iter(lambda: f.read(1 << 20), ""):
+        h.update(chunk)
+    f.close()
+    return h.hexdigest()
+
+def prepare(job):
+    """In a pool process: read, parse and prepare one file.  The graph
+    comes back as N-Triples, which is cheap to pickle and re-parse."""
+    (filename, record_id) = job
+    timings = {}
+    started = time.time()
+    data = open(filename).read()
+    timings["read"] = time.time() - started
+
+    started = time.time()
+    g = parse_rdf(data)
+    timings["parse"] = time.time() - started
+
+    started = time.time()
+    RecordObject[sp.MedicalDataElement].prepare_graph(g, None, {'record_id': record_id})
+    timings["prepare"] = time.time() - started
+
+    started = time.time()
+    nt = serialize_ntriples(g)
+    timings["serialize"] = time.time() - started
+    return (filename, nt, timings)
+
+class Manifest(object):
+    """Which files (by hash) have been committed as which records:
+    file hash --> record id --> {"file": ..., "committed": ...}."""
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            self.entries = simplejson.load(open(path))
+
+    def committed(self, h, record_id):
+        e = self.entries.get(h, {}).get(record_id)
+        return e != None and e["committed"]
+
+    def commit(self, h, filename, record_id):
+        self.lock.acquire()
+        try:
+            self.entries.setdefault(h, {})[record_id] = {"file": filename, "committed": True}
+            tmp = self.path + ".tmp"
+            f = open(tmp, "w")
+            simplejson.dump(self.entries, f, indent=1)
+            f.close()
+            os.rename(tmp, self.path)
+        finally:
+            self.lock.release()
+
+class BulkLoader(object):
+    def __init__(self, files, manifest, processes=None, uploads=4, batch_size=5000, workers=4, atomic=False):
+        self.manifest = Manifest(manifest)
+        self.processes = processes or cpu_count()
+        self.uploads = uploads
+        self.batch_size = batch_size
+        self.workers = workers
+        self.atomic = atomic
+        self.timings = {}
+        self.timings_lock = threading.Lock()
+
+        self.jobs = {}      # filename --> (hash, record id)
+        self.skipped = 0
+        for filename in files:
+            record_id = record_id_for(filename)
+            assert record_id, "Can't tell which record %s is for"%filename
+            h = file_hash(filename)
+            if self.manifest.committed(h, record_id):
+                self.skipped += 1
+                continue
+            self.jobs[filename] = (h, record_id)
+
+    def add_timings(self, timings):
+        self.timings_lock.acquire()
+        try:
+            for (stage, seconds) in timings.iteritems():
+                self.timings[stage] = self.timings.get(stage, 0.0) + seconds
+        finally:
+            self.timings_lock.release()
+
+    def upload(self, prepared):
+        (filename, nt, timings) = prepared
+        (h, record_id) = self.jobs[filename]
+
+        started = time.time()
+        r, created = Record.objects.get_or_create(id=record_id)
+        rconn = RecordStoreConnector(r)
+        if not created:
+            if self.atomic:
+                # cleared in the same update that swaps the new data in
+                rconn.pending_clears.append(URIRef(rconn.context.encode()))
+            else:
+                rconn.destroy_triples()
+        rconn.pending_adds = list(parse_ntriples(nt))
+        stats = rconn.execute_bulk_transaction(batch_size=self.batch_size,
+                                               workers=self.workers,
+                                               atomic=self.atomic)
+        timings["upload"] = time.time() - started
+
+        self.manifest.commit(h, filename, record_id)
+        self.add_timings(timings)
+        print "record %s (%s): %s statements in %.2fs"%(record_id, filename, stats["statements"], timings["upload"])
+        sys.stdout.flush()
+
+    def run(self):
+        started = time.time()
+        processes = Pool(self.processes)
+        uploads = ThreadPool(self.uploads)
+        try:
+            jobs = [(f, record_id) for (f, (h, record_id)) in sorted(self.jobs.iteritems())]
+            pending = [uploads.apply_async(self.upload, (p,)) for p in processes.imap_unordered(prepare, jobs)]
+            for p in pending:
+                p.get()
+        finally:
+            processes.close()
+            uploads.close()
+
+        elapsed = time.time() - started
+        print "loaded %s records (%s already loaded) in %.1fs: %.1f patients/minute"%(
+            len(self.jobs), self.skipped, elapsed, elapsed and len(self.jobs) * 60.0 / elapsed or 0.0)
+        for stage in ("read", "parse", "prepare", "serialize", "upload"):
+            print "  %-10s %8.1fs total"%(stage, self.timings.get(stage, 0.0))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load many patient RDF files into the SMArt record store, resumably.")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="processes parsing and preparing files (default: one per CPU)")
+    parser.add_argument("--uploads", type=int, default=4,
+                        help="records committed concurrently (default 4)")
+    parser.add_argument("--batch-size", type=int, default=5000,
+                        help="statements per transaction (default 5000)")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="transactions sent concurrently per record (default 4)")
+    parser.add_argument("--atomic", action="store_true",
+                        help="stage each record and swap it in all-or-nothing (needs SPARQL 1.1 Update)")
+    parser.add_argument("--manifest", default="load_patients.manifest",
+                        help="checkpoint file of records already committed (default load_patients.manifest)")
+    parser.add_argument("files", nargs="+")
+    args = parser.parse_args()
+
+    BulkLoader(args.files, args.manifest, args.processes, args.uploads,
+               args.batch_size, args.workers, args.atomic).run()
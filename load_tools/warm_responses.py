@@ -0,0 +1,45 @@
+from smart.models.response_store import get_store
+from smart.models.records import Record
+import sys, time, argparse
+
+"""
+Materialize the whole-collection responses of many records ahead of
+their first GET (see smart.models.response_store), e.g. after a bulk
+load with load_patients.py.  Needs RESPONSE_STORE_BACKEND = 'shared' to
+be of use to the server's processes.
+
+To run:
+
+PYTHONPATH=/path/to/smart_server \\
+  DJANGO_SETTINGS_MODULE=settings \\
+  /usr/bin/python \\
+  load_tools/warm_responses.py \\
+  [--types http://smartplatforms.org/terms#Medication ...] [--formats xml json] \\
+  [record_id ...]
+"""
+
+# Only types whose whole-collection GET is record_get_all_objects, which
+# serves from the store -- not allergies, say, answered by
+# record_get_allergies together with their exceptions.
+default_types = ["http://smartplatforms.org/terms#%s"%t for t in
+                 ("Medication", "Problem", "LabResult", "VitalSigns", "Encounter")]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Materialize record collections' responses.")
+    parser.add_argument("--types", nargs="+", default=default_types,
+                        help="type URIs to materialize (default: meds, problems, labs, vitals, encounters)")
+    parser.add_argument("--formats", nargs="+", default=None,
+                        help="formats to materialize (default RESPONSE_STORE_FORMATS)")
+    parser.add_argument("record_ids", nargs="*",
+                        help="records to warm (default: all of them)")
+    args = parser.parse_args()
+
+    store = get_store()
+    if store is None:
+        sys.exit("No response store: set RESPONSE_STORE_BACKEND (and SPARQL_CACHE_BACKEND).")
+
+    record_ids = args.record_ids or [r.id for r in Record.objects.all()]
+    started = time.time()
+    store.warm(record_ids, args.types, args.formats)
+    store.wait()
+    print "warmed %s records in %.1fs: %s"%(len(record_ids), time.time() - started, store.stats())
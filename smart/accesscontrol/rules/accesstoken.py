@@ -37,6 +37,7 @@ def grant(accesstoken, permset):
 
     permset.grant(record_get_filtered_labs, [check_token_for_record])
     permset.grant(record_get_allergies, [check_token_for_record])
+    permset.grant(record_batch, [check_token_for_record])
 
     try:
         permset.grant(record_proxy_backend.proxy_get, [check_token_for_record])
@@ -0,0 +1,161 @@
+"""
+Embedded, disk-persisted quad store
+
+Holds named-graph contexts in memory with SPOC and POSC indexes (the same
+indexes reset.sh asks Sesame to build), and persists every change to an
+append-only journal that's replayed on startup and compacted as it grows.
+
+Josh Mandel
+"""
+
+import os, threading
+from smart.common.util import nt_terms
+
+def encode_term(t):
+    if t is None: return "-"
+    return t.n3().encode("utf-8")
+
+class QuadStore(object):
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.RLock()
+        self.spoc = {}   # context --> s --> p --> set(o)
+        self.posc = {}   # context --> p --> o --> set(s)
+        self.size = 0
+        self.journal = None
+        self.journal_lines = 0
+
+        if path:
+            if not os.path.exists(path): os.makedirs(path)
+            self.replay()
+            self.journal = open(self.journal_path(), "a")
+
+    def journal_path(self):
+        return os.path.join(self.path, "journal.nq")
+
+    def add(self, s, p, o, c=None):
+        objects = self.spoc.setdefault(c, {}).setdefault(s, {}).setdefault(p, set())
+        if o in objects: return False
+        objects.add(o)
+        self.posc.setdefault(c, {}).setdefault(p, {}).setdefault(o, set()).add(s)
+        self.size += 1
+        return True
+
+    def remove(self, s, p, o, c=None):
+        try:
+            self.spoc[c][s][p].remove(o)
+        except KeyError:
+            return False
+        self.posc[c][p][o].discard(s)
+        self.size -= 1
+        return True
+
+    def clear(self, c=None):
+        for (s, p, o, ctx) in list(self.triples((None, None, None), [c])):
+            self.size -= 1
+        self.spoc.pop(c, None)
+        self.posc.pop(c, None)
+
+    def count(self, c=None):
+        return sum([len(objs) for po in self.spoc.get(c, {}).values() for objs in po.values()])
+
+    def contexts(self):
+        return self.spoc.keys()
+
+    def triples(self, (s, p, o), contexts=None):
+        """Yield (s, p, o, context) quads matching the pattern.  None is a
+        wildcard; contexts=None means every context."""
+        if contexts is None: contexts = self.spoc.keys()
+        for c in contexts:
+            spo = self.spoc.get(c)
+            if not spo: continue
+            if s is not None:
+                po = spo.get(s)
+                if not po: continue
+                preds = p is None and po.keys() or [p]
+                for pred in preds:
+                    objs = po.get(pred)
+                    if not objs: continue
+                    if o is None:
+                        for obj in list(objs): yield (s, pred, obj, c)
+                    elif o in objs: yield (s, pred, o, c)
+            elif p is not None:
+                os_ = self.posc[c].get(p)
+                if not os_: continue
+                objs = o is None and os_.keys() or [o]
+                for obj in objs:
+                    for subj in list(os_.get(obj, ())): yield (subj, p, obj, c)
+            else:
+                for (subj, po) in spo.items():
+                    for (pred, objs) in po.items():
+                        for obj in list(objs):
+                            if o is None or o == obj: yield (subj, pred, obj, c)
+
+    def apply(self, clears=(), adds=(), removes=(), context=None):
+        """Apply one transaction: clears first, then adds, then removes
+        (the order Sesame's transaction document gives them)."""
+        self.lock.acquire()
+        try:
+            log = []
+            for c in clears:
+                self.clear(c)
+                log.append("C %s\n"%encode_term(c))
+            for (s, p, o) in adds:
+                if self.add(s, p, o, context):
+                    log.append("+ %s %s %s %s\n"%(encode_term(s), encode_term(p), encode_term(o), encode_term(context)))
+            for (s, p, o) in removes:
+                if self.remove(s, p, o, context):
+                    log.append("- %s %s %s %s\n"%(encode_term(s), encode_term(p), encode_term(o), encode_term(context)))
+            self.write_journal(log)
+        finally:
+            self.lock.release()
+
+    def write_journal(self, log):
+        if not self.journal or not log: return
+        self.journal.writelines(log)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.journal_lines += len(log)
+        if self.journal_lines > 2 * self.size + 10000:
+            self.compact()
+
+    def replay(self):
+        if not os.path.exists(self.journal_path()): return
+        for line in open(self.journal_path()):
+            op = line[0]
+            terms = nt_terms(line[2:])
+            if op == "C":
+                self.clear(len(terms) and terms[0] or None)
+            else:
+                if len(terms) == 3: terms.append(None)
+                (s, p, o, c) = terms
+                if op == "+": self.add(s, p, o, c)
+                elif op == "-": self.remove(s, p, o, c)
+            self.journal_lines += 1
+
+    def compact(self):
+        """Rewrite the journal as just the live quads."""
+        tmp = self.journal_path() + ".tmp"
+        f = open(tmp, "w")
+        for (s, p, o, c) in self.triples((None, None, None)):
+            f.write("+ %s %s %s %s\n"%(encode_term(s), encode_term(p), encode_term(o), encode_term(c)))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        if self.journal: self.journal.close()
+        os.rename(tmp, self.journal_path())
+        self.journal = open(self.journal_path(), "a")
+        self.journal_lines = self.size
+
+stores = {}
+stores_lock = threading.Lock()
+
+def get_store(name, base_dir=None):
+    """The process-wide store called name, persisted under base_dir."""
+    stores_lock.acquire()
+    try:
+        if name not in stores:
+            stores[name] = QuadStore(base_dir and os.path.join(base_dir, name) or None)
+        return stores[name]
+    finally:
+        stores_lock.release()
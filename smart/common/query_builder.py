@@ -1,4 +1,4 @@
-import re
+import re, time, threading
 
 class QueryBuilder(object):
     def __init__(self, root_type, root_name):
@@ -9,6 +9,11 @@ class QueryBuilder(object):
 
     def construct_triples(self):
         return "\n ".join(self.triples_created)
+
+    def root_triples(self):
+        """Just the patterns that pick out root subjects: the root's type,
+        and its link from above if required.  Call before build()."""
+        return " ".join(self.triples_created) + " %s rdf:type %s. "%(self.root_name, self.root_type.node.n3())
         
     def require_above(self, above_type=None, above_uri=None):
         if (above_uri == None): return
@@ -47,15 +52,18 @@ class QueryBuilder(object):
         self.triples_created.append("%s %s %s. " % (root_name, pred, obj))
         return " OPTIONAL { %s %s %s. } \n" % (root_name, pred, obj)
         
-    def optional_linked_type(self, linked_type, root_name,  predicate, object, to_follow, depth):
+    def optional_linked_type(self, linked_type, root_name,  predicate, object, to_follow, depth, fields=None):
         self.triples_created.append("%s %s %s. " % (root_name, predicate, object))
         ret = " OPTIONAL { %s %s %s. $insertion } \n" % (root_name, predicate, object)
-        repl = self.build(to_follow, linked_type, depth)
+        repl = self.build(to_follow, linked_type, depth, fields)
         ret = ret.replace("$insertion", repl)
         return ret
 
-    def build(self, root_name=None, root_type=None, depth=0):
+    def build(self, root_name=None, root_type=None, depth=0, fields=None):
+        """fields, if given, is a projection (see SMArtType.projection):
+        only the properties and contained types it names are expanded."""
         ret = ""
+        fields = fields != None and dict(fields) or None
 
         # If we're at the root of a record, don't try to expand ALL data.
         if depth>0 and root_type.node.n3() == "<http://smartplatforms.org/terms#MedicalRecord>":
@@ -71,6 +79,7 @@ class QueryBuilder(object):
         ret += self.required_triple(root_name, "rdf:type", root_type.node.n3())
 
         for p in root_type.properties:
+            if fields != None and p.property not in fields: continue
             p = str(p.property)
             oid = self.get_identifier("?"+p, "object")
             # a special case for the rdf:li predicate, which resolves
@@ -84,6 +93,7 @@ class QueryBuilder(object):
         # We'll traverse + recurse down *only* from the top of the hierarchy
         # OR if we're dealing with "core" (i.e. blank-node, i.e. non-GETtable) resources.
         for pred, contained_list in root_type.contained_types.iteritems():
+            if fields != None and pred not in fields: continue
             for contained in contained_list:
                 if depth > 0 and contained.base_path: continue
 
@@ -94,10 +104,12 @@ class QueryBuilder(object):
                                              predicate="<"+p+">", 
                                              object=oid, 
                                              to_follow=oid,
-                                             depth=depth+1)
+                                             depth=depth+1,
+                                             fields=fields and fields[pred])
 
-        # We'll only traverse *up* once, from the top level of our query. 
-        if depth == 0:
+        # We'll only traverse *up* once, from the top level of our query
+        # (and not at all for a projection, which names only what's below).
+        if depth == 0 and fields == None:
             for containing, pred in root_type.containing_types.iteritems():
                 p = str(pred)
                 oid = self.get_identifier("?"+p, "object")
@@ -109,3 +121,49 @@ class QueryBuilder(object):
                                                  depth=depth+1)
         
         return ret
+
+class QueryPlanner(object):
+    """Chooses how to fetch a whole collection: as one CONSTRUCT (SINGLE),
+    or TWO_PHASE -- SELECT just the root subjects, then CONSTRUCT their
+    subgraphs batch_size roots at a time, in parallel.  One big CONSTRUCT
+    is cheapest for small collections, but its nested OPTIONALs get very
+    expensive for thousands of roots.
+
+    TWO_PHASE needs SPARQL 1.1 VALUES (Sesame 2.7+), so it's only used
+    when asked for: forced, or under AUTO for a collection whose root
+    count, last seen when the first phase ran and trusted for
+    estimate_ttl seconds, is over threshold.  Otherwise -- with no plan
+    asked for, or no estimate -- a single CONSTRUCT it is."""
+    SINGLE = "single"
+    TWO_PHASE = "two_phase"
+    AUTO = "auto"
+
+    def __init__(self, threshold=500, batch_size=200, estimate_ttl=300):
+        self.threshold = threshold
+        self.batch_size = batch_size
+        self.estimate_ttl = estimate_ttl
+        self.estimates = {}     # collection --> (root count, when seen)
+        self.lock = threading.Lock()
+
+    def estimate(self, collection):
+        e = self.estimates.get(collection)
+        if e and time.time() - e[1] < self.estimate_ttl: return e[0]
+        return None
+
+    def observe(self, collection, n):
+        self.lock.acquire()
+        try:
+            self.estimates[collection] = (n, time.time())
+        finally:
+            self.lock.release()
+
+    def choose(self, collection, force=None):
+        """force is SINGLE, TWO_PHASE, AUTO (choose by estimate) or None."""
+        if force in (self.SINGLE, self.TWO_PHASE): return force
+        if force != self.AUTO: return self.SINGLE
+        n = self.estimate(collection)
+        if n != None and n > self.threshold: return self.TWO_PHASE
+        return self.SINGLE
+
+    def batches(self, roots):
+        return [roots[i:i+self.batch_size] for i in xrange(0, len(roots), self.batch_size)]
@@ -0,0 +1,116 @@
+from util import rdf, URIRef, BNode, default_ns, local_name, looks_like_ntriples, parse_ntriples, parse_rdf
+
+"""
+Compact JSON for record data, shaped by the ontology.
+
+Each root (a node of one of the requested types) becomes an object:
+"@id" is its URI, "@type" its type, and each predicate a key -- its
+local name ("drugName", "startDate"), or "prefix:name" where that would
+be ambiguous or the predicate isn't one of the type's own.  A node
+described in the result (a contained CodedValue, say) nests as an
+object; a URI that isn't is {"@id": ...}; a literal is its string.  A
+key with several values holds a list.  Keys are written sorted, so the
+output is stable.
+
+The per-type key tables (JSONShape) are built once, when the ontology
+loads; writing a result is then one pass over its triples to index them
+by subject, and one walk down from the roots.
+"""
+
+class JSONShape(object):
+    """How to write one SMArtType's nodes: predicate --> (key, {contained
+    type --> JSONShape})."""
+    def __init__(self, smart_type):
+        self.type = smart_type.node
+        self.fields = {}
+
+    def child(self, predicate, node_types):
+        """The shape for an object of predicate, given its rdf:types."""
+        children = self.fields.get(predicate, (None, {}))[1]
+        for t in node_types:
+            if t in children: return children[t]
+        if len(children) == 1: return children.values()[0]
+        return None
+
+def compile_shapes(types):
+    """Give every SMArtType in types its json_shape."""
+    shapes = dict([(t.node, JSONShape(t)) for t in types])
+    for t in types:
+        predicates = []
+        for p in [r.property for r in t.properties] + t.contained_types.keys():
+            if p not in predicates: predicates.append(p)
+        names = {}
+        for p in predicates:
+            names.setdefault(local_name(p), []).append(p)
+
+        fields = shapes[t.node].fields
+        for p in predicates:
+            key = len(names[local_name(p)]) == 1 and local_name(p) or qname(p)
+            fields[p] = (key, dict([(c.node, shapes[c.node]) for c in t.contained_types.get(p, [])]))
+        t.json_shape = shapes[t.node]
+
+qnames = {}
+
+def qname(node):
+    """"prefix:name" for node (just the name for sp: terms), or the URI
+    itself if none of default_ns fits."""
+    ret = qnames.get(node)
+    if ret == None:
+        ret = unicode(node)
+        for (prefix, uri) in default_ns.iteritems():
+            if ret.startswith(uri) and len(ret) > len(uri):
+                ret = prefix == "sp" and ret[len(uri):] or u"%s:%s"%(prefix, ret[len(uri):])
+                break
+        qnames[node] = ret
+    return ret
+
+def parse_triples(data):
+    """The triples of a CONSTRUCT result, without building a graph when
+    it came back as N-Triples."""
+    if looks_like_ntriples(data): return parse_ntriples(data)
+    return parse_rdf(data)
+
+def to_json(triples, types, roots=None):
+    """A list of JSON-ready objects, one for each root (by default every
+    subject typed as one of the SMArtTypes in types, in URI order)."""
+    index = {}      # subject --> [(predicate, object)]
+    seen = set()
+    for t in triples:
+        if t in seen: continue
+        seen.add(t)
+        index.setdefault(t[0], []).append((t[1], t[2]))
+
+    shapes = dict([(t.node, t.json_shape) for t in types])
+    typed = {}
+    for (s, pos) in index.iteritems():
+        for (p, o) in pos:
+            if p == rdf.type and o in shapes: typed[s] = shapes[o]
+
+    if roots == None: roots = sorted(typed.keys())
+    return [node_json(r, typed[r], index, set()) for r in roots if r in typed]
+
+def node_json(node, shape, index, path):
+    ret = {}
+    if type(node) == URIRef: ret["@id"] = unicode(node)
+    path.add(node)
+    for (p, o) in index[node]:
+        if p == rdf.type:
+            add_value(ret, "@type", qname(o))
+            continue
+        key = shape and p in shape.fields and shape.fields[p][0] or qname(p)
+        if o in index and o not in path:
+            child = shape and shape.child(p, [t for (tp, t) in index[o] if tp == rdf.type])
+            add_value(ret, key, node_json(o, child, index, path))
+        elif type(o) == URIRef:
+            add_value(ret, key, {"@id": unicode(o)})
+        elif type(o) == BNode:
+            add_value(ret, key, {})
+        else:
+            add_value(ret, key, unicode(o))
+    path.remove(node)
+    return ret
+
+def add_value(obj, key, value):
+    if key not in obj: obj[key] = value
+    elif type(obj[key]) == list: obj[key].append(value)
+    else: obj[key] = [obj[key], value]
@@ -1,5 +1,8 @@
 from query_builder import QueryBuilder
+from rdf_json import compile_shapes
 from util import *
+import query_builder, rdf_json, util
+import re, os, hashlib, cPickle
 
 class OwlAttr(object):
     def __init__(self, name, predicate, object=anyuri, max_cardinality=1, min_cardinality=0):
@@ -17,6 +20,12 @@ class OwlObject(object):
         
     def __repr__(self):
         return "("+", ".join(["%s:%s"%(a.name, getattr(self, a.name)) for a in self.attributes])+")"
+
+    def __getstate__(self):
+        # Snapshots keep what was read from the model, not the model.
+        state = self.__dict__.copy()
+        state["model"] = None
+        return state
     
 class SMArtOwlObject(OwlObject):
     __metaclass__ = LookupType
@@ -144,16 +153,143 @@ class SMArtType(SMArtOwlObject):
     def __repr__(self):
         return "SMArtType:" + str(self.node)
 
-    def query_one(self, id,filter_clause=""):
-        return self.query(one_name=id,filter_clause=filter_clause)
+    def query_one(self, id,filter_clause="", fields=None):
+        return self.query(one_name=id,filter_clause=filter_clause, fields=fields)
+
+    def query_all(self, above_type=None, above_uri=None,filter_clause="", fields=None):
+        return self.query(above_type=above_type, above_uri=above_uri,filter_clause=filter_clause, fields=fields)
 
-    def query_all(self, above_type=None, above_uri=None,filter_clause=""):
-        return self.query(above_type=above_type, above_uri=above_uri,filter_clause=filter_clause)
+    # Compiled query templates, keyed by (type, above type, root variable,
+    # projection).
+    compiled_queries = {}
 
     def query(self, one_name="?root_subject", 
                     above_type=None, 
                     above_uri=None, 
-                    filter_clause=""):
+                    filter_clause="",
+                    fields=None):
+        # The query's shape depends only on the types involved; a specific
+        # root (an IRI or bnode) and above_uri just fill slots in it.
+        root_slot = one_name[0] in "<_"
+        above = (above_type and above_uri) and above_type or None
+        key = (self.node, above and above.node, not root_slot and one_name or None, fields)
+
+        compiled = SMArtType.compiled_queries.get(key)
+        if compiled == None:
+            compiled = CompiledQuery(self.build_query(one_name=root_slot and CompiledQuery.slot("one_name") or one_name,
+                                                      above_type=above,
+                                                      above_uri=above and CompiledQuery.slot("above_uri")[1:-1],
+                                                      filter_clause=CompiledQuery.slot("filter_clause"),
+                                                      fields=fields))
+            SMArtType.compiled_queries[key] = compiled
+        return compiled.fill(one_name=one_name, above_uri=above_uri, filter_clause=filter_clause)
+
+    def roots_query(self, above_type=None, above_uri=None,
+                          order_by=None, descending=False, after=None, limit=None):
+        """First phase of a two-phase query: SELECT the root subjects.
+
+        For paging, roots come back in a stable order -- by the value at
+        the end of the order_by predicate path (see order_path), if given,
+        then by URI -- as ?root_subject and ?order_key.  after=(order key,
+        root) resumes just past that root; limit caps the count."""
+        q = QueryBuilder(self, "?root_subject")
+        if (above_type and above_uri):
+            q.require_above(above_type, above_uri)
+        root = q.root_name
+
+        select = root
+        patterns = q.root_triples()
+        keys = []
+        if order_by:
+            select += " ?order_key"
+            steps = ["?order_step_%s"%i for i in xrange(1, len(order_by))] + ["?order_key"]
+            path = " ".join(["%s %s %s."%(s, p.n3(), o) for (s, p, o) in zip([root] + steps[:-1], order_by, steps)])
+            patterns += " OPTIONAL { %s }"%path
+            keys.append("%s(?order_key)"%(descending and "DESC" or "ASC"))
+        if order_by or after or limit:
+            keys.append("ASC(str(%s))"%root)
+
+        if after:
+            (last_key, last_root) = after
+            past_root = "str(%s) > %s"%(root, Literal(unicode(last_root)).n3())
+            if not order_by:
+                condition = past_root
+            elif last_key == None and not descending:
+                condition = "bound(?order_key) || %s"%past_root
+            elif last_key == None:
+                condition = "!bound(?order_key) && %s"%past_root
+            else:
+                beyond = "?order_key %s %s || (?order_key = %s && %s)"%(descending and "<" or ">", last_key.n3(), last_key.n3(), past_root)
+                if descending: condition = "!bound(?order_key) || %s"%beyond
+                else: condition = "bound(?order_key) && (%s)"%beyond
+            patterns += " FILTER(%s)"%condition
+
+        return """
+        BASE <http://smartplatforms.org/>
+        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+        SELECT DISTINCT %s
+        FROM $context
+        WHERE { %s }
+        %s %s
+        """%(select, patterns, keys and "ORDER BY " + " ".join(keys) or "", limit and "LIMIT %s"%int(limit) or "")
+
+    def order_path(self, path):
+        """Predicates for an order_by path: the local names of contained-
+        type predicates, then of a property, separated by "/" -- e.g.
+        "startDate", or "specimenCollected/startDate" for a LabResult.
+        None if the path doesn't lead to a property."""
+        t = self
+        ret = []
+        steps = path.split("/")
+        for (i, step) in enumerate(steps):
+            last = i == len(steps) - 1
+            if last: candidates = [p.property for p in t.properties]
+            else: candidates = t.contained_types.keys()
+            match = [p for p in candidates if local_name(p) == step]
+            if not match: return None
+            ret.append(match[0])
+            if not last: t = t.contained_types[match[0]][0]
+        return ret
+
+    def projection(self, fields):
+        """A projection for query(), from a comma-separated list of paths
+        like order_path's: "drugName,startDate", or "drugName/title" for
+        just part of a contained type.  Returned as nested, sorted
+        (predicate, sub-projection) tuples so it can key compiled queries;
+        a sub-projection of None keeps the whole contained type."""
+        tree = {}
+        for path in fields.split(","):
+            (types, level) = ([self], tree)
+            steps = path.strip().split("/")
+            for (i, step) in enumerate(steps):
+                last = i == len(steps) - 1
+                props = [p.property for t in types for p in t.properties if local_name(p.property) == step]
+                contained = [p for t in types for p in t.contained_types if local_name(p) == step]
+                if last and props:
+                    level[props[0]] = None
+                    break
+                if not contained:
+                    raise BadRequest("%s has no field %s"%(self.name, path))
+                pred = contained[0]
+                if last or level.get(pred, {}) == None:
+                    level[pred] = None
+                    break
+                level = level.setdefault(pred, {})
+                types = [c for t in types for c in t.contained_types.get(pred, [])]
+        return freeze_projection(tree)
+
+    def values_query(self, roots, fields=None, values=True):
+        """Second phase: the full CONSTRUCT, bound to the given roots --
+        with SPARQL 1.1 VALUES, or (values=False) a SPARQL 1.0 FILTER."""
+        if values:
+            return self.query(filter_clause="VALUES ?root_subject { %s }"%" ".join([r.n3() for r in roots]), fields=fields)
+        return self.query(filter_clause="FILTER (%s)"%" || ".join(["?root_subject = %s"%r.n3() for r in roots]), fields=fields)
+
+    def build_query(self, one_name="?root_subject", 
+                    above_type=None, 
+                    above_uri=None, 
+                    filter_clause="",
+                    fields=None):
         ret = """
         BASE <http://smartplatforms.org/>
         PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
@@ -169,7 +305,7 @@ class SMArtType(SMArtOwlObject):
         
         if (above_type and above_uri):
             q.require_above(above_type, above_uri)
-        b = q.build()
+        b = q.build(fields=fields)
 
         ret = ret.replace("$construct_triples", q.construct_triples())
         ret = ret.replace("$query_triples", b)        
@@ -177,6 +313,39 @@ class SMArtType(SMArtOwlObject):
 #        print ret
         return ret
                  
+def freeze_projection(tree):
+    if tree == None: return None
+    return tuple(sorted([(p, freeze_projection(sub)) for (p, sub) in tree.iteritems()]))
+
+class CompiledQuery(object):
+    """A built query, split around its slots so that filling it in is a
+    join rather than another walk of the ontology."""
+    slot_re = re.compile(r'(<slot:[a-z_]+>)')
+    term_re = re.compile(r'^(<[^<>"{}|^`\\\s]*>|_:[A-Za-z0-9_-]+)$')
+    iri_re = re.compile(r'^[^<>"{}|^`\\\s]*$')
+
+    @staticmethod
+    def slot(name):
+        return "<slot:%s>"%name
+
+    def __init__(self, query):
+        self.parts = []
+        for (i, part) in enumerate(self.slot_re.split(query)):
+            self.parts.append(i % 2 and part[6:-1] or part)
+
+    def fill(self, one_name, above_uri, filter_clause):
+        # These go into the query verbatim, so they mustn't be able to
+        # close the term they're in.
+        if one_name[0] in "<_" and not self.term_re.match(one_name):
+            raise BadRequest("Not an IRI or blank node: %s"%one_name)
+        if above_uri and not self.iri_re.match(above_uri):
+            raise BadRequest("Not an IRI: %s"%above_uri)
+        values = {"one_name": one_name, "above_uri": "<%s>"%above_uri, "filter_clause": filter_clause}
+        ret = self.parts[:]
+        for i in xrange(1, len(ret), 2):
+            ret[i] = values[ret[i]]
+        return "".join(ret)
+
 parsed = False
                 
 def parse_ontology(f):
@@ -186,9 +355,74 @@ def parse_ontology(f):
     global api_types
     global parsed
     
+    # Calls are blank nodes, so a re-parse would add to, not replace, them.
+    SMArtCall.store.clear()
+    SMArtType.store.clear()
+    SMArtType.compiled_queries.clear()
     api_calls = SMArtCall.find_all(m)  
     api_types = SMArtType.find_all(m, api_calls)
+    compile_shapes(api_types)
     parsed = True
+
+# Bump to orphan old snapshots; changes to the code that builds what they
+# hold do so anyway (see code_hash).
+SNAPSHOT_VERSION = 2
+
+def code_hash():
+    """A hash of the source of the modules whose classes, compiled queries
+    and JSON shapes a snapshot holds."""
+    h = hashlib.sha1()
+    for path in (__file__, query_builder.__file__, rdf_json.__file__, util.__file__):
+        if path[-4:] in (".pyc", ".pyo") and os.path.exists(path[:-1]): path = path[:-1]
+        h.update(open(path, "rb").read())
+    return h.hexdigest()
+
+def precompile_queries():
+    """Compile the query shapes every type is asked for."""
+    for t in api_types:
+        t.query_all()
+        t.query_one("<http://smartplatforms.org/precompile>")
+        for above in t.containing_types.keys():
+            t.query_all(above_type=above, above_uri="http://smartplatforms.org/precompile")
+
+def load_ontology(f, snapshot_file=None):
+    """parse_ontology, unless snapshot_file holds the resolved types,
+    calls and compiled queries of an ontology with the same hash, built
+    by the same code (see code_hash).  After
+    a full parse, (re)writes the snapshot.  Returns True on a hit."""
+    global api_calls
+    global api_types
+    global parsed
+
+    key = (SNAPSHOT_VERSION, hashlib.sha1(f).hexdigest(), code_hash())
+    if snapshot_file and os.path.exists(snapshot_file):
+        try:
+            snapshot = cPickle.load(open(snapshot_file, "rb"))
+            if snapshot["key"] == key:
+                SMArtCall.store = snapshot["calls"]
+                SMArtType.store = snapshot["types"]
+                SMArtType.compiled_queries = snapshot["compiled_queries"]
+                api_calls = SMArtCall.store.values()
+                api_types = SMArtType.store.values()
+                parsed = True
+                return True
+        except Exception, e:
+            print "Ignoring unreadable ontology snapshot %s: %s"%(snapshot_file, e)
+
+    parse_ontology(f)
+    if snapshot_file:
+        precompile_queries()
+        snapshot = {"key": key,
+                    "calls": SMArtCall.store,
+                    "types": SMArtType.store,
+                    "compiled_queries": SMArtType.compiled_queries}
+        try:
+            tmp = "%s.%s.tmp"%(snapshot_file, os.getpid())
+            cPickle.dump(snapshot, open(tmp, "wb"), cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, snapshot_file)
+        except (IOError, OSError), e:
+            print "Couldn't write ontology snapshot %s: %s"%(snapshot_file, e)
+    return False
     
 api_calls = None  
 api_types = None 
@@ -197,7 +431,7 @@ ontology = SMArtType
 try:
     from django.conf import settings
     f = open(settings.ONTOLOGY_FILE).read()
-    parse_ontology(f)
+    load_ontology(f, getattr(settings, 'ONTOLOGY_SNAPSHOT_FILE', None))
 except (ImportError, AttributeError): 
     pass
 
@@ -0,0 +1,603 @@
+"""
+A small SPARQL evaluator for the embedded quad store
+
+Covers what the server itself generates (see SMArtType.query and
+RecordObject.internal_id): BASE/PREFIX, CONSTRUCT and SELECT with FROM,
+basic graph patterns, nested groups, OPTIONAL, UNION, FILTER, VALUES
+(one variable), ORDER BY, LIMIT and OFFSET -- plus the CLEAR/DROP/ADD
+updates used by bulk loads and the DELETEs used by rdf_delete.
+It is not a general SPARQL engine.
+
+construct_to_delete() turns one of those CONSTRUCTs into the equivalent
+SPARQL 1.1 DELETE, for Sesame and for update() here alike.
+
+Josh Mandel
+"""
+
+import re, urlparse
+from rdflib import URIRef, Literal, BNode
+from smart.common.util import bound_graph, serialize_rdf, rdf
+
+class SparqlSyntaxError(Exception):
+    pass
+
+class Var(object):
+    __slots__ = ["name"]
+    def __init__(self, name): self.name = name
+    def __repr__(self): return "?" + self.name
+
+token_re = re.compile(r'''
+   (?P<ws>\s+|\#[^\n]*)
+  |(?P<iri><[^<>"{}|^`\\\s]*>)
+  |(?P<string>"(?:[^"\\\n]|\\.)*"|'(?:[^'\\\n]|\\.)*')
+  |(?P<var>[?$][A-Za-z0-9_]+)
+  |(?P<bnode>_:[A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)*)
+  |(?P<lang>@[A-Za-z]+(?:-[A-Za-z0-9]+)*)
+  |(?P<number>[0-9]+(?:\.[0-9]+)?)
+  |(?P<pname>(?:[A-Za-z][A-Za-z0-9_-]*)?:(?:[A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)*)?)
+  |(?P<name>[A-Za-z_][A-Za-z0-9_]*)
+  |(?P<op>\^\^|\|\||&&|!=|<=|>=|[{}().;,*=<>!+/-])
+''', re.X)
+
+string_escapes = {'t': u'\t', 'n': u'\n', 'r': u'\r', 'b': u'\b', 'f': u'\f',
+                  '"': u'"', "'": u"'", '\\': u'\\'}
+
+def tokenize(q):
+    if type(q) == str: q = q.decode("utf-8")
+    ret = []
+    pos = 0
+    while pos < len(q):
+        m = token_re.match(q, pos)
+        if not m: raise SparqlSyntaxError("Can't parse query at: %s"%q[pos:pos+40])
+        pos = m.end()
+        if m.lastgroup != "ws": ret.append((m.lastgroup, m.group()))
+    return ret
+
+class Parser(object):
+    def __init__(self, q):
+        self.tokens = tokenize(q)
+        self.i = 0
+        self.base = None
+        self.prefixes = {"rdf": str(rdf)}
+        self.bnodes = {}
+
+    def peek(self, offset=0):
+        try: return self.tokens[self.i + offset]
+        except IndexError: return (None, None)
+
+    def next(self):
+        t = self.peek()
+        self.i += 1
+        return t
+
+    def at_keyword(self, *words):
+        (kind, val) = self.peek()
+        return kind == "name" and val.upper() in words
+
+    def at_op(self, op):
+        return self.peek() == ("op", op)
+
+    def expect_op(self, op):
+        t = self.next()
+        if t != ("op", op): raise SparqlSyntaxError("Expected %s, got %s"%(op, t[1]))
+
+    def expect_keyword(self, word):
+        if not self.at_keyword(word): raise SparqlSyntaxError("Expected %s, got %s"%(word, self.peek()[1]))
+        self.next()
+
+    def iri(self, val):
+        v = val[1:-1]
+        if self.base and not re.match(r'[A-Za-z][A-Za-z0-9+.-]*:', v):
+            v = urlparse.urljoin(self.base, v)
+        return URIRef(v)
+
+    def prologue(self):
+        while self.at_keyword("BASE", "PREFIX"):
+            if self.next()[1].upper() == "BASE":
+                self.base = str(self.iri(self.next()[1]))
+            else:
+                prefix = self.next()[1][:-1]
+                self.prefixes[prefix] = str(self.iri(self.next()[1]))
+
+    def term(self):
+        (kind, val) = self.next()
+        if kind == "var": return Var(val[1:])
+        if kind == "iri": return self.iri(val)
+        if kind == "pname":
+            (prefix, local) = val.split(":", 1)
+            if prefix not in self.prefixes: raise SparqlSyntaxError("Unknown prefix %s"%prefix)
+            return URIRef(self.prefixes[prefix] + local)
+        if kind == "bnode":
+            return self.bnodes.setdefault(val, Var("_bnode_" + val[2:]))
+        if kind == "number":
+            return Literal(val, datatype=URIRef("http://www.w3.org/2001/XMLSchema#" + ("." in val and "decimal" or "integer")))
+        if kind == "string":
+            lexical = re.sub(r'\\(.)', lambda m: string_escapes.get(m.group(1), m.group(1)), val[1:-1])
+            if self.peek()[0] == "lang":
+                return Literal(lexical, lang=self.next()[1][1:])
+            if self.at_op("^^"):
+                self.next()
+                return Literal(lexical, datatype=self.term())
+            return Literal(lexical)
+        if kind == "name" and val == "a": return rdf.type
+        if kind == "name" and val.lower() in ("true", "false"):
+            return Literal(val.lower() == "true")
+        raise SparqlSyntaxError("Unexpected token %s"%val)
+
+    def triples(self, into):
+        s = self.term()
+        while True:
+            p = self.term()
+            while True:
+                into.append((s, p, self.term()))
+                if not self.at_op(","): break
+                self.next()
+            if not self.at_op(";"): break
+            self.next()
+            if self.at_op(".") or self.at_op("}"): break
+        if self.at_op("."): self.next()
+
+    def template(self):
+        self.expect_op("{")
+        ret = []
+        while not self.at_op("}"):
+            self.triples(ret)
+        self.next()
+        return ret
+
+    def group(self):
+        """A group graph pattern, as a list of (kind, ...) elements."""
+        self.expect_op("{")
+        ret = []
+        while not self.at_op("}"):
+            if self.peek()[0] is None: raise SparqlSyntaxError("Unterminated group")
+            if self.at_keyword("OPTIONAL"):
+                self.next()
+                ret.append(("optional", self.group()))
+            elif self.at_keyword("FILTER"):
+                self.next()
+                ret.append(("filter", self.constraint()))
+            elif self.at_keyword("VALUES"):
+                self.next()
+                var = self.term()
+                if not isinstance(var, Var): raise SparqlSyntaxError("VALUES needs a variable")
+                self.expect_op("{")
+                values = []
+                while not self.at_op("}"):
+                    values.append(self.term())
+                self.next()
+                # Inline data constrains the whole group; bind it first.
+                ret.insert(0, ("values", var, values))
+            elif self.at_op("{"):
+                if self.peek(1) == ("name", "SELECT") or (self.peek(1)[0] == "name" and self.peek(1)[1].upper() == "SELECT"):
+                    self.next()
+                    sub = self.query()
+                    self.expect_op("}")
+                    ret.append(("subselect", sub))
+                    continue
+                alternatives = [self.group()]
+                while self.at_keyword("UNION"):
+                    self.next()
+                    alternatives.append(self.group())
+                if len(alternatives) == 1: ret.append(("group", alternatives[0]))
+                else: ret.append(("union", alternatives))
+            elif self.at_op("."):
+                self.next()
+            else:
+                patterns = []
+                self.triples(patterns)
+                ret.append(("triples", patterns))
+        self.next()
+        return ret
+
+    # Expressions are nested tuples: (op, args...)
+    def constraint(self):
+        if self.at_op("("):
+            self.next()
+            e = self.expression()
+            self.expect_op(")")
+            return e
+        return self.primary()
+
+    def expression(self):
+        e = self.conjunction()
+        while self.at_op("||"):
+            self.next()
+            e = ("||", e, self.conjunction())
+        return e
+
+    def conjunction(self):
+        e = self.relation()
+        while self.at_op("&&"):
+            self.next()
+            e = ("&&", e, self.relation())
+        return e
+
+    def relation(self):
+        e = self.unary()
+        for op in ("=", "!=", "<", ">", "<=", ">="):
+            if self.at_op(op):
+                self.next()
+                return (op, e, self.unary())
+        return e
+
+    def unary(self):
+        if self.at_op("!"):
+            self.next()
+            return ("!", self.unary())
+        return self.primary()
+
+    def primary(self):
+        if self.at_op("("):
+            self.next()
+            e = self.expression()
+            self.expect_op(")")
+            return e
+        (kind, val) = self.peek()
+        if kind == "name" and self.peek(1) == ("op", "(") and val not in ("a",):
+            self.next()
+            self.next()
+            args = []
+            while not self.at_op(")"):
+                args.append(self.expression())
+                if self.at_op(","): self.next()
+            self.next()
+            return ("call", val.lower(), args)
+        return ("term", self.term())
+
+    def query(self):
+        self.prologue()
+        q = {"form": None, "template": None, "vars": None, "distinct": False,
+             "from": [], "where": [], "order_by": [], "limit": None, "offset": 0}
+
+        if self.at_keyword("CONSTRUCT"):
+            self.next()
+            q["form"] = "CONSTRUCT"
+            q["template"] = self.template()
+        elif self.at_keyword("SELECT"):
+            self.next()
+            q["form"] = "SELECT"
+            if self.at_keyword("DISTINCT", "REDUCED"):
+                self.next()
+                q["distinct"] = True
+            if self.at_op("*"):
+                self.next()
+            else:
+                q["vars"] = []
+                while self.peek()[0] == "var":
+                    q["vars"].append(self.next()[1][1:])
+        else:
+            raise SparqlSyntaxError("Only CONSTRUCT and SELECT queries are supported")
+
+        while self.at_keyword("FROM"):
+            self.next()
+            if self.at_keyword("NAMED"): self.next()
+            q["from"].append(self.term())
+
+        if self.at_keyword("WHERE"): self.next()
+        q["where"] = self.group()
+
+        if self.at_keyword("ORDER"):
+            self.next()
+            self.expect_keyword("BY")
+            while True:
+                if self.at_keyword("ASC", "DESC"):
+                    desc = self.next()[1].upper() == "DESC"
+                    q["order_by"].append((self.constraint(), desc))
+                elif self.peek()[0] == "var":
+                    q["order_by"].append((("term", self.term()), False))
+                else: break
+
+        while self.at_keyword("LIMIT", "OFFSET"):
+            modifier = self.next()[1].lower()
+            q[modifier] = int(self.next()[1])
+        return q
+
+    def update(self):
+        """CLEAR, DROP, ADD and [WITH g] DELETE {..} WHERE {..}
+        operations, separated by semicolons."""
+        ops = []
+        self.prologue()
+        while self.peek()[0] is not None:
+            word = self.next()[1].upper()
+            if self.at_keyword("SILENT"): self.next()
+            if word in ("CLEAR", "DROP"):
+                ops.append((word, self.graph_ref()))
+            elif word == "ADD":
+                source = self.graph_ref()
+                self.expect_keyword("TO")
+                ops.append((word, source, self.graph_ref()))
+            elif word in ("WITH", "DELETE"):
+                graph = None
+                if word == "WITH":
+                    graph = self.term()
+                    self.expect_keyword("DELETE")
+                template = self.template()
+                self.expect_keyword("WHERE")
+                ops.append(("DELETE", graph, template, self.group()))
+            else:
+                raise SparqlSyntaxError("Unsupported update operation %s"%word)
+            if self.at_op(";"): self.next()
+        return ops
+
+    def graph_ref(self):
+        if self.at_keyword("DEFAULT"):
+            self.next()
+            return None
+        if self.at_keyword("ALL"):
+            self.next()
+            return "ALL"
+        if self.at_keyword("GRAPH"): self.next()
+        return self.term()
+
+class Evaluator(object):
+    def __init__(self, store, contexts=None):
+        self.store = store
+        self.contexts = contexts
+
+    def resolve(self, t, sol):
+        if isinstance(t, Var): return sol.get(t.name)
+        return t
+
+    def match(self, sols, (s, p, o)):
+        ret = []
+        for sol in sols:
+            rs, rp, ro = self.resolve(s, sol), self.resolve(p, sol), self.resolve(o, sol)
+            for (ms, mp, mo, c) in self.store.triples((rs, rp, ro), self.contexts):
+                new = sol
+                ok = True
+                for (t, v) in ((s, ms), (p, mp), (o, mo)):
+                    if isinstance(t, Var):
+                        bound = new.get(t.name)
+                        if bound is None:
+                            if new is sol: new = dict(sol)
+                            new[t.name] = v
+                        elif bound != v:
+                            ok = False
+                if ok: ret.append(new)
+        return ret
+
+    def group(self, elements, sols):
+        filters = []
+        for el in elements:
+            kind = el[0]
+            if kind == "triples":
+                for pattern in el[1]:
+                    sols = self.match(sols, pattern)
+            elif kind == "optional":
+                extended = []
+                for sol in sols:
+                    matches = self.group(el[1], [sol])
+                    extended.extend(matches or [sol])
+                sols = extended
+            elif kind == "group":
+                sols = self.group(el[1], sols)
+            elif kind == "union":
+                sols = sum([self.group(alt, sols) for alt in el[1]], [])
+            elif kind == "subselect":
+                sub = self.select(el[1])
+                sols = [j for j in [join(sol, r) for sol in sols for r in sub] if j is not None]
+            elif kind == "filter":
+                filters.append(el[1])
+            elif kind == "values":
+                sols = [j for j in [join(sol, {el[1].name: v}) for sol in sols for v in el[2]] if j is not None]
+        for f in filters:
+            sols = [sol for sol in sols if effective_boolean(self.evaluate(f, sol))]
+        return sols
+
+    def evaluate(self, e, sol):
+        op = e[0]
+        try:
+            if op == "term": return self.resolve(e[1], sol)
+            if op == "||": return effective_boolean(self.evaluate(e[1], sol)) or effective_boolean(self.evaluate(e[2], sol))
+            if op == "&&": return effective_boolean(self.evaluate(e[1], sol)) and effective_boolean(self.evaluate(e[2], sol))
+            if op == "!": return not effective_boolean(self.evaluate(e[1], sol))
+            if op == "call": return self.call(e[1], [self.evaluate(a, sol) for a in e[2]], e[2], sol)
+
+            (a, b) = (self.evaluate(e[1], sol), self.evaluate(e[2], sol))
+            if a is None or b is None: return None
+            if op == "=": return a == b or comparable(a) == comparable(b)
+            if op == "!=": return not (a == b or comparable(a) == comparable(b))
+            (a, b) = (comparable(a), comparable(b))
+            if op == "<": return a < b
+            if op == ">": return a > b
+            if op == "<=": return a <= b
+            if op == ">=": return a >= b
+        except (TypeError, ValueError):
+            return None
+
+    def call(self, name, args, exprs, sol):
+        if name == "bound": return args[0] is not None
+        if args and args[0] is None: return None
+        if name == "str": return Literal(unicode(args[0]))
+        if name == "lang": return Literal(getattr(args[0], "language", None) or "")
+        if name == "datatype": return getattr(args[0], "datatype", None)
+        if name in ("isiri", "isuri"): return type(args[0]) == URIRef
+        if name == "isblank": return type(args[0]) == BNode
+        if name == "isliteral": return type(args[0]) == Literal
+        if name == "sameterm": return args[0] == args[1]
+        if name == "regex":
+            flags = len(args) > 2 and "i" in unicode(args[2]) and re.I or 0
+            return re.search(unicode(args[1]), unicode(args[0]), flags) is not None
+        raise SparqlSyntaxError("Unsupported function %s"%name)
+
+    def select(self, q):
+        sols = self.group(q["where"], [{}])
+
+        for (e, desc) in reversed(q["order_by"]):
+            sols.sort(key=lambda sol: comparable(self.evaluate(e, sol)), reverse=desc)
+
+        if q["vars"] is not None:
+            sols = [dict([(v, sol[v]) for v in q["vars"] if v in sol]) for sol in sols]
+        if q["distinct"]:
+            seen = set()
+            unique = []
+            for sol in sols:
+                k = tuple(sorted(sol.items()))
+                if k in seen: continue
+                seen.add(k)
+                unique.append(sol)
+            sols = unique
+
+        sols = sols[q["offset"]:]
+        if q["limit"] is not None: sols = sols[:q["limit"]]
+        return sols
+
+    def construct(self, q):
+        g = bound_graph()
+        for sol in self.select(q):
+            fresh = {}
+            for pattern in q["template"]:
+                t = []
+                for x in pattern:
+                    if isinstance(x, Var):
+                        if x.name.startswith("_bnode_"):
+                            x = fresh.setdefault(x.name, BNode())
+                        else:
+                            x = sol.get(x.name)
+                    t.append(x)
+                if None in t or type(t[0]) == Literal or type(t[1]) != URIRef: continue
+                g.add(tuple(t))
+        return g
+
+def join(a, b):
+    ret = dict(a)
+    for (k, v) in b.iteritems():
+        if ret.setdefault(k, v) != v: return None
+    return ret
+
+def comparable(t):
+    if type(t) == Literal:
+        v = t.toPython()
+        if isinstance(v, Literal): return unicode(v)
+        return v
+    if t is None: return None
+    return unicode(t)
+
+def effective_boolean(v):
+    if v is None: return False
+    if type(v) == bool: return v
+    if type(v) == Literal:
+        p = v.toPython()
+        if isinstance(p, Literal): return len(unicode(p)) > 0
+        return bool(p)
+    return True
+
+def select_results_xml(vars, sols):
+    from xml.sax.saxutils import escape, quoteattr
+    ret = ['<?xml version="1.0"?>\n<sparql xmlns="http://www.w3.org/2005/sparql-results#">\n<head>']
+    ret.extend(['<variable name=%s/>'%quoteattr(v) for v in vars])
+    ret.append('</head>\n<results>')
+    for sol in sols:
+        ret.append('<result>')
+        for (k, v) in sol.iteritems():
+            if type(v) == URIRef: b = '<uri>%s</uri>'%escape(v)
+            elif type(v) == BNode: b = '<bnode>%s</bnode>'%escape(v)
+            elif v.language: b = '<literal xml:lang=%s>%s</literal>'%(quoteattr(v.language), escape(v))
+            elif v.datatype: b = '<literal datatype=%s>%s</literal>'%(quoteattr(v.datatype), escape(v))
+            else: b = '<literal>%s</literal>'%escape(v)
+            ret.append('<binding name=%s>%s</binding>'%(quoteattr(k), b))
+        ret.append('</result>')
+    ret.append('</results>\n</sparql>\n')
+    return u"\n".join(ret).encode("utf-8")
+
+def query(store, q, format="xml"):
+    """Evaluate a CONSTRUCT (returned as RDF/XML, or as N-Triples or Turtle
+    when format is "nt" or "turtle") or SELECT (returned as SPARQL XML results) against store."""
+    parsed = Parser(q).query()
+    store.lock.acquire()
+    try:
+        e = Evaluator(store, parsed["from"] or None)
+        if parsed["form"] == "CONSTRUCT":
+            g = e.construct(parsed)
+            return serialize_rdf(g, format)
+        sols = e.select(parsed)
+    finally:
+        store.lock.release()
+
+    vars = parsed["vars"]
+    if vars is None:
+        vars = sorted(set(sum([s.keys() for s in sols], [])))
+    return select_results_xml(vars, sols)
+
+def update(store, u):
+    ops = Parser(u).update()
+    store.lock.acquire()
+    try:
+        for op in ops:
+            if op[0] in ("CLEAR", "DROP"):
+                contexts = op[1] == "ALL" and store.contexts() or [op[1]]
+                store.apply(clears=contexts)
+            elif op[0] == "ADD":
+                adds = [(s, p, o) for (s, p, o, c) in store.triples((None, None, None), [op[1]])]
+                store.apply(adds=adds, context=op[2])
+            elif op[0] == "DELETE":
+                (graph, template, where) = op[1:]
+                q = {"template": template, "where": where, "vars": None, "distinct": False,
+                     "order_by": [], "limit": None, "offset": 0}
+                removes = list(Evaluator(store, [graph]).construct(q))
+                store.apply(removes=removes, context=graph)
+    finally:
+        store.lock.release()
+    return True
+
+def construct_to_delete(q):
+    """Rewrite "CONSTRUCT {t} FROM g WHERE {p}" as the SPARQL 1.1 update
+    "WITH g DELETE {t} WHERE {p}", which removes exactly the statements
+    the query would have returned.  The template and pattern are copied
+    verbatim.  Raises SparqlSyntaxError for anything else -- solution
+    modifiers, several FROMs, blank nodes in the template, trailing text,
+    or GRAPH, SERVICE or dataset keywords in the template or pattern,
+    which would reach past g -- so callers can fall back to fetching and
+    removing."""
+    tokens = []
+    pos = 0
+    while pos < len(q):
+        m = token_re.match(q, pos)
+        if not m: raise SparqlSyntaxError("Can't parse query at: %s"%q[pos:pos+40])
+        pos = m.end()
+        if m.lastgroup != "ws": tokens.append((m.lastgroup, m.group(), m.start(), m.end()))
+    tokens.append((None, None, len(q), len(q)))
+
+    def keyword(i):
+        return tokens[i][0] == "name" and tokens[i][1].upper()
+
+    def closing(i):
+        if tokens[i][:2] != ("op", "{"): raise SparqlSyntaxError("Expected {, got %s"%tokens[i][1])
+        depth = 0
+        for j in xrange(i, len(tokens)):
+            if tokens[j][:2] == ("op", "{"): depth += 1
+            elif tokens[j][:2] == ("op", "}"): depth -= 1
+            if depth == 0: return j
+        raise SparqlSyntaxError("Unbalanced braces")
+
+    i = 0
+    while keyword(i) in ("BASE", "PREFIX"):
+        i += keyword(i) == "BASE" and 2 or 3
+    if keyword(i) != "CONSTRUCT": raise SparqlSyntaxError("Not a CONSTRUCT query")
+    prologue_end = tokens[i][2]
+
+    template = (i + 1, closing(i + 1))
+    if [t for t in tokens[template[0]:template[1]] if t[0] == "bnode"]:
+        raise SparqlSyntaxError("Blank nodes can't be deleted by template")
+
+    i = template[1] + 1
+    graphs = []
+    while keyword(i) == "FROM":
+        graphs.append(tokens[i + 1])
+        i += 2
+    if len(graphs) != 1 or not (graphs[0][0] == "iri" or graphs[0][1] == "$context"):
+        raise SparqlSyntaxError("Need exactly one FROM graph")
+
+    if keyword(i) == "WHERE": i += 1
+    where = (i, closing(i))
+    if tokens[where[1] + 1][0] is not None:
+        raise SparqlSyntaxError("Unexpected %s after WHERE clause"%tokens[where[1] + 1][1])
+
+    for (a, b) in (template, where):
+        for k in xrange(a, b):
+            if keyword(k) in ("GRAPH", "SERVICE", "FROM", "NAMED", "WITH", "USING"):
+                raise SparqlSyntaxError("%s reaches past the FROM graph"%tokens[k][1])
+
+    span = lambda (a, b): q[tokens[a][2]:tokens[b][3]]
+    return "%sWITH %s\nDELETE %s\nWHERE %s\n"%(q[:prologue_end], graphs[0][1], span(template), span(where))
@@ -1,6 +1,7 @@
-import rdflib
+import rdflib, re
 from rdflib import Namespace, URIRef, Literal, BNode
 from StringIO import StringIO as sIO
+from xml.etree import cElementTree as ElementTree
 
 
 rdflib.plugin.register('sparql', rdflib.query.Processor,
@@ -20,20 +21,251 @@ NS = {"sp":sp, "rdf":rdf, "rdfs":rdfs, "owl":owl, "api":api, "foaf": foaf}
 
 anyuri = URIRef("http://www.w3.org/2001/XMLSchema#anyURI")
 
+class BadRequest(ValueError):
+    """Raised for a request that can't be answered as asked, e.g. a path
+    that doesn't name a valid resource; the server answers 400."""
+
 # metaclass to allow class-based dictionary look-up
 class LookupType(type):
     def __getitem__(self, key):
         return self.__getitem__(key)
 
-def serialize_rdf(model):
-    return model.serialize(format="pretty-xml")
+def serialize_rdf(model, format="xml"):
+    return "".join(serialize_chunks(model, format))
+
+def serialize_ntriples(model):
+    return serialize_rdf(model, "nt")
+
+def serialize_chunks(model, format="xml", chunk_size=65536):
+    """Serialize model as "xml" (flat rdf:Description RDF/XML), "nt" or
+    "turtle", yielding UTF-8 chunks of about chunk_size bytes as it goes,
+    one subject at a time -- no DOM, nesting or subject tracking."""
+    writer = {"xml": RdfXmlWriter, "nt": NTriplesWriter, "turtle": TurtleWriter}[format]()
+    buf, buffered = [], 0
+    for piece in writer.chunks(model):
+        buf.append(piece)
+        buffered += len(piece)
+        if buffered >= chunk_size:
+            yield "".join(buf).encode("utf-8")
+            buf, buffered = [], 0
+    if buf: yield "".join(buf).encode("utf-8")
+
+def by_subject(model):
+    """(subject, [(predicate, object)]) for each subject in model."""
+    seen = set()
+    for s in model.subjects():
+        if s in seen: continue
+        seen.add(s)
+        yield (s, list(model.predicate_objects(s)))
+
+nt_quote_re = re.compile(ur'[^\x20-\x7e]|["\\]')
+nt_quotes = {u'\t': u'\\t', u'\n': u'\\n', u'\r': u'\\r', u'"': u'\\"', u'\\': u'\\\\'}
+
+def nt_quote(s):
+    """Escape a string for an N-Triples (or Turtle) literal or IRI."""
+    def repl(m):
+        c = m.group(0)
+        if c in nt_quotes: return nt_quotes[c]
+        if ord(c) > 0xFFFF: return u"\\U%08X"%ord(c)
+        return u"\\u%04X"%ord(c)
+    return nt_quote_re.sub(repl, unicode(s))
+
+class NTriplesWriter(object):
+    def term(self, t):
+        if type(t) == URIRef: return u"<%s>"%nt_quote(t)
+        if type(t) == BNode: return u"_:%s"%t
+        ret = u'"%s"'%nt_quote(t)
+        if t.language: return ret + u"@" + t.language
+        if t.datatype: return ret + u"^^<%s>"%nt_quote(t.datatype)
+        return ret
+
+    def chunks(self, model):
+        terms = {}      # predicates and repeated objects, written once each
+        for (s, pos) in by_subject(model):
+            subject = self.term(s)
+            for (p, o) in pos:
+                pt = terms.get(p) or terms.setdefault(p, self.term(p))
+                yield u"%s %s %s .\n"%(subject, pt, self.term(o))
+
+# An XML name that can end a predicate's URI (rdf:RDF needs predicates
+# as prefix:local element names).
+ncname_re = re.compile(r'[A-Za-z_][A-Za-z0-9_.-]*$')
+
+def xml_escape(s, attribute=False):
+    s = unicode(s).replace(u"&", u"&amp;").replace(u"<", u"&lt;").replace(u">", u"&gt;").replace(u"\r", u"&#13;")
+    if attribute: s = s.replace(u'"', u"&quot;").replace(u"\n", u"&#10;").replace(u"\t", u"&#9;")
+    return s
+
+class RdfXmlWriter(object):
+    def __init__(self, namespaces=None):
+        self.namespaces = namespaces or default_ns
+        self.prefixes = dict([(unicode(uri), prefix) for (prefix, uri) in self.namespaces.iteritems()])
+        self.elements = {}      # predicate --> (open tag, close tag)
+        self.node_ids = {}      # bnode --> rdf:nodeID
+
+    def element(self, p):
+        ret = self.elements.get(p)
+        if ret: return ret
+        m = ncname_re.search(p)
+        if m == None or m.start() == 0: raise Exception("Can't write predicate %s as RDF/XML"%p)
+        (ns, local) = (p[:m.start()], p[m.start():])
+        prefix = self.prefixes.get(ns)
+        if prefix:
+            ret = (u"%s:%s"%(prefix, local), u"%s:%s"%(prefix, local))
+        else:
+            ret = (u'ns:%s xmlns:ns="%s"'%(local, xml_escape(ns, True)), u"ns:%s"%local)
+        self.elements[p] = ret
+        return ret
+
+    def node_id(self, b):
+        ret = self.node_ids.get(b)
+        if ret == None:
+            ret = self.node_ids[b] = ncname_re.match(b) and unicode(b) or u"b%s"%len(self.node_ids)
+        return ret
+
+    def node(self, n):
+        if type(n) == BNode: return u'rdf:nodeID="%s"'%self.node_id(n)
+        return u'rdf:about="%s"'%xml_escape(n, True)
+
+    def chunks(self, model):
+        yield u'<?xml version="1.0" encoding="utf-8"?>\n<rdf:RDF'
+        for (prefix, uri) in sorted(self.namespaces.iteritems()):
+            yield u'\n   xmlns:%s="%s"'%(prefix, xml_escape(uri, True))
+        yield u'>\n'
+
+        for (s, pos) in by_subject(model):
+            yield u'  <rdf:Description %s>\n'%self.node(s)
+            for (p, o) in pos:
+                (start, end) = self.element(p)
+                if type(o) == URIRef:
+                    yield u'    <%s rdf:resource="%s"/>\n'%(start, xml_escape(o, True))
+                elif type(o) == BNode:
+                    yield u'    <%s rdf:nodeID="%s"/>\n'%(start, self.node_id(o))
+                else:
+                    attrs = u""
+                    if o.language: attrs = u' xml:lang="%s"'%o.language
+                    elif o.datatype: attrs = u' rdf:datatype="%s"'%xml_escape(o.datatype, True)
+                    yield u'    <%s%s>%s</%s>\n'%(start, attrs, xml_escape(o), end)
+            yield u'  </rdf:Description>\n'
+        yield u'</rdf:RDF>\n'
 
-def parse_rdf(string, model=None, context="none"):
+class TurtleWriter(NTriplesWriter):
+    def __init__(self, namespaces=None):
+        self.namespaces = namespaces or default_ns
+        self.prefixes = dict([(unicode(uri), prefix) for (prefix, uri) in self.namespaces.iteritems()])
+
+    def term(self, t):
+        if type(t) == URIRef:
+            m = ncname_re.search(t)
+            if m and m.start() > 0 and "." not in m.group(0) and t[:m.start()] in self.prefixes:
+                return u"%s:%s"%(self.prefixes[t[:m.start()]], t[m.start():])
+        return NTriplesWriter.term(self, t)
+
+    def chunks(self, model):
+        for (prefix, uri) in sorted(self.namespaces.iteritems()):
+            yield u"@prefix %s: <%s> .\n"%(prefix, nt_quote(uri))
+        terms = {}
+        for (s, pos) in by_subject(model):
+            lines = []
+            for (p, o) in pos:
+                pt = terms.get(p) or terms.setdefault(p, self.term(p))
+                lines.append(u"%s %s"%(pt, self.term(o)))
+            yield u"\n%s\n    %s .\n"%(self.term(s), u" ;\n    ".join(lines))
+
+def parse_rdf(string, model=None, context="none", format=None):
     if model == None:
         model = bound_graph() 
-    model.parse(sIO(string))
+    if format == None:
+        format = looks_like_ntriples(string) and "nt" or "xml"
+    if format == "nt":
+        model.addN([(s, p, o, model) for (s, p, o) in parse_ntriples(string)])
+    else:
+        model.parse(sIO(string))
     return model
 
+sparql_results_ns = "{http://www.w3.org/2005/sparql-results#}"
+xml_lang = "{http://www.w3.org/XML/1998/namespace}lang"
+
+def parse_sparql_results(string):
+    """The solutions in a SPARQL XML results document, as dicts of
+    variable name --> term."""
+    ret = []
+    for result in ElementTree.fromstring(string).getiterator(sparql_results_ns + "result"):
+        sol = {}
+        for b in result.findall(sparql_results_ns + "binding"):
+            v = b[0]
+            kind = v.tag[len(sparql_results_ns):]
+            if kind == "uri": t = URIRef(v.text or "")
+            elif kind == "bnode": t = BNode(v.text)
+            else:
+                datatype = v.get("datatype")
+                t = Literal(v.text or "", lang=v.get(xml_lang), datatype=datatype and URIRef(datatype) or None)
+            sol[b.get("name")] = t
+        ret.append(sol)
+    return ret
+
+def looks_like_ntriples(string):
+    start = string[:200].lstrip()
+    if not start or start[0] in "_#": return True
+    return start[0] == "<" and not start.startswith("<?") and \
+        not start.startswith("<rdf:") and re.match(r'<[^>\s]*>\s', start) != None
+
+# A fast, line-at-a-time N-Triples parser.  Stores can send N-Triples much
+# more cheaply than RDF/XML, and it needs no XML parse to read back.
+nt_term_pattern = r'<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[A-Za-z0-9-]+|\^\^<[^>]*>)?'
+nt_term_re = re.compile(nt_term_pattern)
+nt_line_re = re.compile(r'\s*(%s)\s+(%s)\s+(%s)\s*\.\s*$'%(nt_term_pattern, nt_term_pattern, nt_term_pattern))
+nt_escape_re = re.compile(r'\\(u[0-9A-Fa-f]{4}|U[0-9A-Fa-f]{8}|.)')
+nt_escapes = {'t': u'\t', 'n': u'\n', 'r': u'\r', '"': u'"', "'": u"'", '\\': u'\\', 'b': u'\b', 'f': u'\f'}
+
+def nt_unescape(s):
+    if "\\" not in s: return s
+    def repl(m):
+        e = m.group(1)
+        if e[0] in 'uU': return unichr(int(e[1:], 16))
+        return nt_escapes.get(e, e)
+    return nt_escape_re.sub(repl, s)
+
+def nt_term(t):
+    c = t[0]
+    if c == "<": return URIRef(nt_unescape(t[1:-1]))
+    if c == "_": return BNode(t[2:])
+
+    end = t.rindex('"')
+    lexical = nt_unescape(t[1:end])
+    suffix = t[end+1:]
+    if suffix.startswith("@"): return Literal(lexical, lang=suffix[1:])
+    if suffix.startswith("^^"): return Literal(lexical, datatype=URIRef(nt_unescape(suffix[3:-1])))
+    return Literal(lexical)
+
+def nt_terms(line):
+    """Every N-Triples term on a line, in order."""
+    if type(line) == str: line = line.decode("utf-8")
+    return [nt_term(t) for t in nt_term_re.findall(line)]
+
+def parse_ntriples(lines):
+    """Yield (s, p, o) for each statement in an N-Triples string (or any
+    iterable of lines).  Repeated terms -- predicates, types, codes -- are
+    converted once per parse."""
+    if isinstance(lines, basestring):
+        if type(lines) == str: lines = lines.decode("utf-8")
+        lines = lines.splitlines()
+
+    seen = {}
+    for line in lines:
+        if type(line) == str: line = line.decode("utf-8")
+        m = nt_line_re.match(line)
+        if m == None:
+            if line.strip() == "" or line.lstrip().startswith("#"): continue
+            raise Exception("Can't parse N-Triples line: %s"%line)
+        t = []
+        for raw in m.groups():
+            v = seen.get(raw)
+            if v == None:
+                v = seen[raw] = nt_term(raw)
+            t.append(v)
+        yield tuple(t)
+
 def get_property(model, s, p, raw_statement=False):
     r = model.triples((s, p, None))
     if (raw_statement): return r
@@ -59,6 +291,26 @@ def remap_node(model, old_node, new_node=None):
         model.add(s)
     return
 
+def remap_nodes(model, node_map, link_predicate=None):
+    """remap_node for a whole old --> new node_map at once, in one pass
+    over the model: triples touching a mapped node are rewritten and
+    re-added in a single addN.  With link_predicate, each remapped URI
+    is also linked to its replacement, e.g. (old, sp:externalIDFor, new)."""
+    triples = list(model)
+    changed = [t for t in triples if t[0] in node_map or t[2] in node_map]
+    if 2 * len(changed) > len(triples):
+        # Mostly rewritten anyway (as POSTed records are): emptying the
+        # graph beats removing triples one by one.
+        model.remove((None, None, None))
+        changed = triples
+    else:
+        for t in changed:
+            model.remove(t)
+    new = [(node_map.get(s, s), p, node_map.get(o, o), model) for (s, p, o) in changed]
+    if link_predicate:
+        new.extend([(old, link_predicate, n, model) for (old, n) in node_map.iteritems() if type(old) == URIRef])
+    model.addN(new)
+
 
 def bound_graph():
     g = rdflib.Graph()
@@ -66,6 +318,9 @@ def bound_graph():
         g.bind(p,v)
     return g
 
+def local_name(node):
+    return re.split("[#/]", str(node))[-1]
+
 def rdfS(s):
     return s[0];
 def rdfP(s):
@@ -0,0 +1,165 @@
+"""
+Keep-alive HTTP connection pools for the SPARQL endpoints
+
+One bounded, thread-safe pool per (scheme, host).  Idle connections are
+evicted after max_idle seconds, retired after max_lifetime seconds, and
+health-checked on checkout so a socket closed by the server isn't handed
+out again.
+
+Josh Mandel
+"""
+
+import httplib, threading, time, select, logging
+
+class PoolTimeout(Exception):
+    pass
+
+class PooledConnection(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.uses = 0
+
+    def healthy(self, max_idle, max_lifetime):
+        now = time.time()
+        if max_lifetime and now - self.created_at > max_lifetime: return False
+        if max_idle and now - self.last_used > max_idle: return False
+
+        # An idle keep-alive socket should have nothing to read.  If it's
+        # readable, the server has closed it (or sent junk) -- either way
+        # it can't carry another request.
+        sock = self.conn.sock
+        if sock is None: return self.uses == 0
+        try:
+            readable, w, x = select.select([sock], [], [], 0)
+        except (select.error, ValueError):
+            return False
+        return len(readable) == 0
+
+    def close(self):
+        try: self.conn.close()
+        except: pass
+
+class ConnectionPool(object):
+    def __init__(self, scheme, host, max_size=10, max_idle=30, max_lifetime=300, timeout=None):
+        self.scheme = scheme
+        self.host = host
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+
+        self.idle = []
+        self.in_use = 0
+        self.lock = threading.Condition(threading.Lock())
+
+        self.counters = {"checkouts": 0,
+                         "created": 0,
+                         "reused": 0,
+                         "discarded": 0,
+                         "waits": 0,
+                         "wait_timeouts": 0,
+                         "wait_time_total": 0.0,
+                         "wait_time_max": 0.0,
+                         "peak_in_use": 0}
+
+    def new_connection(self):
+        if self.scheme == "https":
+            conn = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        self.counters["created"] += 1
+        return PooledConnection(conn)
+
+    def get(self, wait_timeout=None):
+        """Check out a connection, blocking while the pool is exhausted."""
+        self.lock.acquire()
+        try:
+            started = time.time()
+            waited = False
+            while not self.idle and self.in_use >= self.max_size:
+                if not waited:
+                    waited = True
+                    self.counters["waits"] += 1
+                    logging.debug("SPARQL pool for %s exhausted (%s in use); waiting"%(self.host, self.in_use))
+
+                remaining = None
+                if wait_timeout is not None:
+                    remaining = wait_timeout - (time.time() - started)
+                    if remaining <= 0:
+                        self.counters["wait_timeouts"] += 1
+                        raise PoolTimeout("No connection to %s available after %ss"%(self.host, wait_timeout))
+                self.lock.wait(remaining)
+
+            if waited:
+                w = time.time() - started
+                self.counters["wait_time_total"] += w
+                self.counters["wait_time_max"] = max(self.counters["wait_time_max"], w)
+
+            pc = None
+            while self.idle:
+                candidate = self.idle.pop()
+                if candidate.healthy(self.max_idle, self.max_lifetime):
+                    pc = candidate
+                    self.counters["reused"] += 1
+                    break
+                candidate.close()
+                self.counters["discarded"] += 1
+
+            if pc is None:
+                pc = self.new_connection()
+
+            self.in_use += 1
+            self.counters["checkouts"] += 1
+            self.counters["peak_in_use"] = max(self.counters["peak_in_use"], self.in_use)
+            return pc
+        finally:
+            self.lock.release()
+
+    def put(self, pc, reusable=True):
+        """Return a checked-out connection.  Pass reusable=False when the
+        response wasn't fully read or the socket errored."""
+        self.lock.acquire()
+        try:
+            self.in_use -= 1
+            if reusable:
+                pc.last_used = time.time()
+                pc.uses += 1
+                self.idle.append(pc)
+            else:
+                pc.close()
+                self.counters["discarded"] += 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            ret = dict(self.counters)
+            ret["max_size"] = self.max_size
+            ret["in_use"] = self.in_use
+            ret["idle"] = len(self.idle)
+            ret["wait_time_avg"] = self.counters["waits"] and \
+                self.counters["wait_time_total"] / self.counters["waits"] or 0.0
+            return ret
+        finally:
+            self.lock.release()
+
+pools = {}
+pools_lock = threading.Lock()
+
+def get_pool(scheme, host, **options):
+    key = (scheme, host)
+    pools_lock.acquire()
+    try:
+        if key not in pools:
+            pools[key] = ConnectionPool(scheme, host, **options)
+        return pools[key]
+    finally:
+        pools_lock.release()
+
+def stats():
+    """Per-endpoint pool statistics, keyed by "scheme://host"."""
+    return dict([("%s://%s"%k, p.stats()) for k, p in pools.items()])
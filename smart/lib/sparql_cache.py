@@ -0,0 +1,242 @@
+"""
+Cache of SPARQL results, scoped to a store context (one record, one app)
+
+Entries are keyed by (endpoint, context, context generation, result
+format, normalized query).  Every write to a context bumps its generation,
+so entries cached before the write can never be served after it -- they
+just age out.
+
+ETags for GETs are made from the same generations (see
+SparqlCache.generations), so any write to a record changes the ETag of
+every GET of it.
+
+Two backends:
+  LocalMemoryBackend -- per-process LRU, for single-process deployments
+  SharedFileBackend  -- an sqlite file shared by every process on the host
+
+Josh Mandel
+"""
+
+import threading, time, re, hashlib, sqlite3, logging, uuid
+
+quoted_or_space = re.compile(r'("(?:[^"\\]|\\.)*"|\'(?:[^\'\\]|\\.)*\'|\s+)')
+
+def normalize_query(q):
+    """Collapse runs of whitespace, except inside quoted literals."""
+    parts = quoted_or_space.split(q.strip())
+    return "".join([(p.isspace() and " " or p) for p in parts])
+
+class LocalMemoryBackend(object):
+    def __init__(self, max_entries=1000, max_bytes=50*1024*1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.generations = {}
+        self.entries = {}       # key --> (value, last_used)
+        self.size = 0
+        self.evictions = 0
+        # Generations restart from 0 with the process.
+        self.epoch = uuid.uuid4().hex
+
+    def generation(self, scope):
+        return self.generations.get(scope, 0)
+
+    def bump(self, scope):
+        self.lock.acquire()
+        try:
+            self.generations[scope] = self.generations.get(scope, 0) + 1
+            return self.generations[scope]
+        finally:
+            self.lock.release()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            e = self.entries.get(key)
+            if e is None: return None
+            self.entries[key] = (e[0], time.time())
+            return e[0]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, scope=None):
+        if len(value) > self.max_bytes: return
+        self.lock.acquire()
+        try:
+            old = self.entries.get(key)
+            if old: self.size -= len(old[0])
+            self.entries[key] = (value, time.time())
+            self.size += len(value)
+            if len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self.evict()
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        # Evict least-recently-used entries down to 90% of both bounds, so
+        # we aren't sorting on every insert once the cache is full.
+        lru = sorted(self.entries.iteritems(), key=lambda e: e[1][1])
+        for (k, (v, t)) in lru:
+            if len(self.entries) <= self.max_entries*0.9 and self.size <= self.max_bytes*0.9: break
+            del self.entries[k]
+            self.size -= len(v)
+            self.evictions += 1
+
+    def stats(self):
+        return {"entries": len(self.entries), "bytes": self.size, "evictions": self.evictions}
+
+class SharedFileBackend(object):
+    def __init__(self, path, max_entries=10000, max_bytes=500*1024*1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.local = threading.local()
+        self.evictions = 0
+
+        db = self.db()
+        db.execute("""CREATE TABLE IF NOT EXISTS generations
+                      (scope TEXT PRIMARY KEY, generation INTEGER)""")
+        db.execute("""CREATE TABLE IF NOT EXISTS entries
+                      (key TEXT PRIMARY KEY, scope TEXT, value BLOB,
+                       size INTEGER, last_used REAL)""")
+        db.execute("CREATE INDEX IF NOT EXISTS entries_by_use ON entries (last_used)")
+        # Generations restart from 0 with a new file.
+        db.execute("CREATE TABLE IF NOT EXISTS epoch (epoch TEXT)")
+        if db.execute("SELECT COUNT(*) FROM epoch").fetchone()[0] == 0:
+            db.execute("INSERT INTO epoch VALUES (?)", (uuid.uuid4().hex,))
+        db.commit()
+        self.epoch = db.execute("SELECT epoch FROM epoch").fetchone()[0]
+
+    def db(self):
+        # sqlite connections can't be shared between threads
+        if not hasattr(self.local, "db"):
+            self.local.db = sqlite3.connect(self.path, timeout=10)
+            self.local.db.text_factory = str
+        return self.local.db
+
+    def generation(self, scope):
+        r = self.db().execute("SELECT generation FROM generations WHERE scope=?", (scope,)).fetchone()
+        return r and r[0] or 0
+
+    def bump(self, scope):
+        db = self.db()
+        db.execute("INSERT OR IGNORE INTO generations VALUES (?, 0)", (scope,))
+        db.execute("UPDATE generations SET generation=generation+1 WHERE scope=?", (scope,))
+        # Entries from older generations are unreachable now.
+        db.execute("DELETE FROM entries WHERE scope=?", (scope,))
+        db.commit()
+        return self.generation(scope)
+
+    def get(self, key):
+        db = self.db()
+        r = db.execute("SELECT value FROM entries WHERE key=?", (key,)).fetchone()
+        if r is None: return None
+        db.execute("UPDATE entries SET last_used=? WHERE key=?", (time.time(), key))
+        db.commit()
+        return str(r[0])
+
+    def set(self, key, value, scope=None):
+        if len(value) > self.max_bytes: return
+        db = self.db()
+        db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                   (key, scope, sqlite3.Binary(value), len(value), time.time()))
+        (n, size) = db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        while n > self.max_entries or size > self.max_bytes:
+            (k, s) = db.execute("SELECT key, size FROM entries ORDER BY last_used LIMIT 1").fetchone()
+            db.execute("DELETE FROM entries WHERE key=?", (k,))
+            n -= 1
+            size -= s
+            self.evictions += 1
+        db.commit()
+
+    def stats(self):
+        (n, size) = self.db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        return {"entries": n, "bytes": size, "evictions": self.evictions}
+
+class SparqlCache(object):
+    def __init__(self, backend, max_lookup_maps=1000):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.max_lookup_maps = max_lookup_maps
+        self.lookup_maps = {}   # (scope, name) --> (generation, dict)
+        self.lock = threading.Lock()
+
+    def scope(self, endpoint, context):
+        return "%s %s"%(endpoint, context)
+
+    def key(self, scope, query, variant=None):
+        g = self.backend.generation(scope)
+        return hashlib.sha1("%s\n%s\n%s\n%s"%(scope, g, variant, normalize_query(query))).hexdigest()
+
+    def get(self, endpoint, context, query, variant=None):
+        """variant distinguishes otherwise-identical queries whose results
+        differ, e.g. the same CONSTRUCT fetched in two formats."""
+        scope = self.scope(endpoint, context)
+        k = self.key(scope, query, variant)
+        v = self.backend.get(k)
+        if v is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return (k, v)
+
+    def set(self, endpoint, context, key, value):
+        self.backend.set(key, value, self.scope(endpoint, context))
+
+    def invalidate(self, endpoint, context):
+        return self.backend.bump(self.scope(endpoint, context))
+
+    def generations(self, endpoint, context):
+        """Something that changes with every write to context."""
+        return (self.backend.epoch, self.backend.generation(self.scope(endpoint, context)))
+
+    def lookup_map(self, endpoint, context, name):
+        """A dict (local to this process) for memoizing lookups against
+        one context, e.g. external ID --> internal URI.  It's replaced by
+        an empty one once the context's generation moves on."""
+        scope = self.scope(endpoint, context)
+        g = self.backend.generation(scope)
+        self.lock.acquire()
+        try:
+            (generation, m) = self.lookup_maps.get((scope, name), (None, None))
+            if generation != g:
+                if len(self.lookup_maps) >= self.max_lookup_maps: self.lookup_maps.clear()
+                m = {}
+                self.lookup_maps[(scope, name)] = (g, m)
+            return m
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        ret = self.backend.stats()
+        ret["hits"] = self.hits
+        ret["misses"] = self.misses
+        return ret
+
+cache = None
+cache_lock = threading.Lock()
+
+def get_cache():
+    """The process-wide cache configured by settings.SPARQL_CACHE_BACKEND
+    ('local', 'shared', or None to disable caching)."""
+    global cache
+    if cache is not None: return cache or None
+
+    from django.conf import settings
+    cache_lock.acquire()
+    try:
+        if cache is None:
+            kind = getattr(settings, 'SPARQL_CACHE_BACKEND', None)
+            max_entries = getattr(settings, 'SPARQL_CACHE_MAX_ENTRIES', 1000)
+            max_bytes = getattr(settings, 'SPARQL_CACHE_MAX_BYTES', 50*1024*1024)
+            if kind == 'local':
+                cache = SparqlCache(LocalMemoryBackend(max_entries, max_bytes))
+            elif kind == 'shared':
+                cache = SparqlCache(SharedFileBackend(settings.SPARQL_CACHE_FILE, max_entries, max_bytes))
+            else:
+                if kind: logging.warn("Unknown SPARQL_CACHE_BACKEND %s; not caching"%kind)
+                cache = False
+    finally:
+        cache_lock.release()
+    return cache or None
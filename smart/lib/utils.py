@@ -5,7 +5,7 @@ Ben Adida
 ben.adida@childrens.harvard.edu
 """
 
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, HttpResponseNotModified, Http404
 from django.template import Context, loader
 from django.conf import settings
 from django import http
@@ -17,15 +17,22 @@ try:
   from django.forms.fields import email_re
 except:
   from django.core.validators import email_re
-from smart.common.util import parse_rdf, serialize_rdf, bound_graph
+from smart.common.util import parse_rdf, serialize_rdf, serialize_chunks, bound_graph
+from smart.common import rdf_json
+from smart.common.sparql_subset import SparqlSyntaxError
 import django.core.mail as mail
 import logging
 import string, random
 import functools
+import hashlib
 import psycopg2
 import psycopg2.extras
 import httplib
+import socket
 import time
+import zlib
+import re
+from smart.lib import http_pool
 
 smart_base = "http://smartplatforms.org"
 
@@ -131,6 +138,26 @@ def smart_parent(path):
     ret = path.split("/")
     return "/".join(ret[:-2])
 
+def accepts_gzip(request):
+  if request is None: return False
+  for coding in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+    parts = coding.strip().split(';')
+    if parts[0].strip().lower() in ('gzip', 'x-gzip', '*'):
+      q = re.search(r'q=([0-9.]+)', ';'.join(parts[1:]))
+      return not q or float(q.group(1)) > 0
+  return False
+
+def gzip_chunks(chunks, level=6):
+  """gzip-encode an iterable of strings on the fly."""
+  z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  try:
+    for c in chunks:
+      c = z.compress(c)
+      if c: yield c
+    yield z.flush()
+  finally:
+    if hasattr(chunks, 'close'): chunks.close()
+
 def x_domain(r):
   ui = settings.SMART_UI_SERVER_LOCATION
   r['Access-Control-Allow-Origin'] = ui#"*"# "%s://%s:%s"%(ui['scheme'], ui['host'], ui['port'])
@@ -140,53 +167,296 @@ def x_domain(r):
 def trim(p, n):
     return '/'.join(p.split('/')[:-n]).encode()
 
-def url_request(url,  method, headers, data=None):
+def url_request(url,  method, headers, data=None, pooled=False, idempotent=None):
     req = url_request_build(url,  method, headers, data)
-    return url_request_execute(req)
+    return url_request_execute(req, pooled, idempotent)
 
 def url_request_build(url,  method, headers, data=None):
   return HTTPRequest(method, url, HTTPRequest.FORM_URLENCODED_TYPE, data, headers)
 
-def url_request_execute(req):
+def url_request_split(req):
     (scheme, url) = req.path.split("://")
     domain = url.split("/")[0]
     path = "/"+"/".join(url.split("/")[1:])
-    conn = None
-    
-    if (scheme == "http") :        
-        conn = httplib.HTTPConnection(domain)
-    elif (scheme == "https"):
-        conn = httplib.HTTPSConnection(domain)
 
     data = req.data
     if (req.method == "GET"):
         path += "?%s"%data
         data = None
+    return (scheme, domain, path, data)
 
-    #print "URL_REQUEST:", domain, req.method, path, data, req.headers        
-    conn.request(req.method, path, data, req.headers)
-    r = conn.getresponse()
-
+def url_response_handle(r):
     if (r.status == 200):
-        data = r.read()
-        conn.close()
-        return data
+        return r.read()
     elif (r.status == 204):
-        conn.close()
+        r.read()
         return True
     
     
     else: raise Exception("Unexpected HTTP status %s"%r.status)
 
-def rdf_response(s):
-    return x_domain(HttpResponse(s, mimetype="application/rdf+xml"))
+def url_request_execute(req, pooled=False, idempotent=None):
+    if pooled: return url_request_execute_pooled(req, idempotent)
 
-def rdf_get(record_connector, query):
-    res = record_connector.sparql(query)    
-    return rdf_response(res)
+    (scheme, domain, path, data) = url_request_split(req)
+    conn = None
+    
+    if (scheme == "http") :        
+        conn = httplib.HTTPConnection(domain)
+    elif (scheme == "https"):
+        conn = httplib.HTTPSConnection(domain)
+
+    #print "URL_REQUEST:", domain, req.method, path, data, req.headers        
+    conn.request(req.method, path, data, req.headers)
+    r = conn.getresponse()
+    try:
+        return url_response_handle(r)
+    finally:
+        conn.close()
 
-def rdf_delete(record_connector, query, save=True): 
-    to_delete = parse_rdf(record_connector.sparql(query))
+def sparql_pool(scheme, domain):
+    return http_pool.get_pool(scheme, domain,
+                              max_size=getattr(settings, 'SPARQL_POOL_SIZE', 10),
+                              max_idle=getattr(settings, 'SPARQL_POOL_MAX_IDLE', 30),
+                              max_lifetime=getattr(settings, 'SPARQL_POOL_MAX_LIFETIME', 300),
+                              timeout=getattr(settings, 'SPARQL_POOL_SOCKET_TIMEOUT', None))
+
+def pooled_response(pool, req, path, data, idempotent=None):
+    """Send req over a connection from pool, and return it with the
+    response.  A reused connection may have been dropped by the server
+    between our health check and the request, so a failure on one is
+    retried once on a fresh connection -- if the request didn't get sent
+    in full, or if it's idempotent (by default, a GET or HEAD), since
+    otherwise the server may have acted on it already."""
+    if idempotent == None: idempotent = req.method in ("GET", "HEAD")
+    wait = getattr(settings, 'SPARQL_POOL_WAIT_TIMEOUT', None)
+    for attempt in (0, 1):
+        pc = pool.get(wait)
+        sent = False
+        try:
+            pc.conn.request(req.method, path, data, req.headers)
+            sent = True
+            return (pc, pc.conn.getresponse())
+        except (httplib.HTTPException, socket.error):
+            pool.put(pc, reusable=False)
+            if attempt == 0 and pc.uses > 0 and (idempotent or not sent): continue
+            raise
+
+def url_request_execute_pooled(req, idempotent=None):
+    """Like url_request_execute, but over a keep-alive connection
+    checked out of the per-endpoint pool."""
+    (scheme, domain, path, data) = url_request_split(req)
+    pool = sparql_pool(scheme, domain)
+    (pc, r) = pooled_response(pool, req, path, data, idempotent)
+    try:
+        ret = url_response_handle(r)
+    except:
+        pool.put(pc, reusable=False)
+        raise
+    pool.put(pc, reusable=not r.will_close)
+    return ret
+
+class ResponseStream(object):
+    """Iterates over an upstream response body as it arrives, chunk_size
+    bytes at a time, and hands the connection back through release(reusable)
+    once the body is used up -- or when closed early, e.g. by the WSGI
+    server after the client goes away."""
+    def __init__(self, r, release, chunk_size=65536):
+        self.r = r
+        self.release = release
+        self.chunk_size = chunk_size
+        self.done = False
+
+    def __iter__(self):
+        try:
+            while True:
+                b = self.r.read(self.chunk_size)
+                if not b: break
+                yield b
+            self.done = True
+        finally:
+            self.close()
+
+    def close(self):
+        if self.release is None: return
+        release, self.release = self.release, None
+        release(self.done and not self.r.will_close)
+
+def url_request_open(url, method, headers, data=None, pooled=False, chunk_size=65536, idempotent=None):
+    """Like url_request, but returns the response body as a ResponseStream
+    instead of reading it into memory.  Fails before returning if the
+    response status isn't 200."""
+    req = url_request_build(url, method, headers, data)
+    (scheme, domain, path, data) = url_request_split(req)
+
+    if not pooled:
+        if (scheme == "https"): conn = httplib.HTTPSConnection(domain)
+        else: conn = httplib.HTTPConnection(domain)
+        conn.request(req.method, path, data, req.headers)
+        r = conn.getresponse()
+        if r.status != 200:
+            conn.close()
+            raise Exception("Unexpected HTTP status %s"%r.status)
+        return ResponseStream(r, lambda reusable: conn.close(), chunk_size)
+
+    pool = sparql_pool(scheme, domain)
+    (pc, r) = pooled_response(pool, req, path, data, idempotent)
+    if r.status != 200:
+        pool.put(pc, reusable=False)
+        raise Exception("Unexpected HTTP status %s"%r.status)
+    return ResponseStream(r, lambda reusable: pool.put(pc, reusable), chunk_size)
+
+def url_request_stream(url, method, headers, chunks, chunk_size=65536):
+    """Send the strings yielded by chunks as a chunked request body over
+    a pooled connection, without ever holding the whole body in memory."""
+    req = url_request_build(url, method, headers)
+    (scheme, domain, path, data) = url_request_split(req)
+    pool = sparql_pool(scheme, domain)
+    pc = pool.get(getattr(settings, 'SPARQL_POOL_WAIT_TIMEOUT', None))
+
+    def send_chunk(buf):
+        b = "".join(buf)
+        pc.conn.send("%x\r\n%s\r\n"%(len(b), b))
+
+    try:
+        pc.conn.putrequest(method, path, skip_accept_encoding=True)
+        for (h, v) in headers.iteritems():
+            pc.conn.putheader(h, v)
+        pc.conn.putheader("Transfer-Encoding", "chunked")
+        pc.conn.endheaders()
+
+        buf, buffered = [], 0
+        for c in chunks:
+            if type(c) == unicode: c = c.encode("utf-8")
+            buf.append(c)
+            buffered += len(c)
+            if buffered >= chunk_size:
+                send_chunk(buf)
+                buf, buffered = [], 0
+        if buffered: send_chunk(buf)
+        pc.conn.send("0\r\n\r\n")
+
+        r = pc.conn.getresponse()
+        ret = url_response_handle(r)
+    except:
+        pool.put(pc, reusable=False)
+        raise
+    pool.put(pc, reusable=not r.will_close)
+    return ret
+
+# format --> (response mimetype, Accept header to ask the store for it)
+rdf_formats = {
+    "xml": ("application/rdf+xml", "application/rdf+xml,  application/sparql-results+xml"),
+    "nt": ("application/n-triples", "application/n-triples, text/plain"),
+    "turtle": ("text/turtle", "text/turtle, application/x-turtle"),
+    "json": ("application/json", "application/n-triples, text/plain")}
+
+rdf_media_types = {
+    "application/rdf+xml": "xml",
+    "application/n-triples": "nt",
+    "text/turtle": "turtle",
+    "application/x-turtle": "turtle",
+    "application/json": "json"}
+
+def rdf_format(request, json=False):
+    """Which format ("xml", "nt", "turtle" or, where the caller can write
+    it, "json") the client's Accept header prefers; RDF/XML unless it
+    names another one."""
+    if request is None: return "xml"
+    best, best_q = "xml", 0.0
+    for media_range in request.META.get('HTTP_ACCEPT', '').split(','):
+        parts = media_range.strip().split(';')
+        format = rdf_media_types.get(parts[0].strip().lower())
+        if format == None or (format == "json" and not json): continue
+        q = re.search(r'q=([0-9.]+)', ';'.join(parts[1:]))
+        q = float(q.group(1)) if q else 1.0
+        if q > best_q: best, best_q = format, q
+    return best
+
+def rdf_response(s, format="xml"):
+    return x_domain(HttpResponse(s, mimetype=rdf_formats[format][0]))
+
+def rdf_stream_response(chunks, request=None, format="xml"):
+    """Relay an iterable of RDF chunks to the client as they arrive,
+    gzip-encoding them on the way if the client accepts it."""
+    gzip = getattr(settings, 'RESPONSE_GZIP', True) and accepts_gzip(request)
+    r = HttpResponse(gzip and gzip_chunks(chunks) or chunks, mimetype=rdf_formats[format][0])
+    if gzip: r['Content-Encoding'] = 'gzip'
+    r['Vary'] = 'Accept, Accept-Encoding'
+    return x_domain(r)
+
+def json_response(obj, request=None):
+    return rdf_stream_response([simplejson.dumps(obj, sort_keys=True)], request, "json")
+
+def wants_json(request):
+    return rdf_format(request, json=True) == "json"
+
+def rdf_graph_response(model, request=None, types=None, roots=None):
+    """Stream model to the client, serialized in the format it asks for.
+    Given the SMArtTypes of its root objects, that can be JSON (see
+    smart.common.rdf_json), with roots, if given, in that order."""
+    format = rdf_format(request, json=types != None)
+    if format == "json":
+        return json_response(rdf_json.to_json(model, types, roots), request)
+    return rdf_stream_response(serialize_chunks(model, format), request, format)
+
+def etag(record_connector, request, types=None, generations=None):
+    """An ETag for a GET of types (SMArtTypes; None for anything) from
+    record_connector's context, as the request would be answered: it
+    covers the context's write generations (by default, the current
+    ones), the path and query, and the negotiated format and encoding.
+    None if writes aren't being counted."""
+    if generations is None: generations = record_connector.generations()
+    if generations is None: return None
+    gzip = getattr(settings, 'RESPONSE_GZIP', True) and accepts_gzip(request)
+    variant = [record_connector.context, generations, request.get_full_path(),
+               rdf_format(request, json=types != None), gzip]
+    return '"%s"'%hashlib.sha1(simplejson.dumps(variant)).hexdigest()
+
+def conditional_get(record_connector, request, types, respond):
+    """Answer with 304 Not Modified -- without calling respond(), so
+    without touching the store -- if the client's If-None-Match names
+    the current ETag (see etag); otherwise tag respond()'s response."""
+    tag = etag(record_connector, request, types)
+    if tag:
+        matches = [t.strip() for t in request.META.get('HTTP_IF_NONE_MATCH', '').split(',')]
+        if tag in matches or '*' in matches:
+            r = HttpResponseNotModified()
+            r['ETag'] = tag
+            r['Vary'] = 'Accept, Accept-Encoding'
+            return x_domain(r)
+
+    r = respond()
+    if tag and r.status_code == 200 and not r.has_header('ETag'): r['ETag'] = tag
+    return r
+
+def rdf_get(record_connector, query, request=None, types=None, roots=None):
+    format = rdf_format(request, json=types != None)
+    if format == "json":
+        triples = rdf_json.parse_triples(record_connector.sparql(query, rdf_formats["json"][1]))
+        return json_response(rdf_json.to_json(triples, types, roots), request)
+    return rdf_stream_response(record_connector.sparql_stream(query, rdf_formats[format][1]), request, format)
+
+def wants_representation(request):
+    """Did the client ask (Prefer: return=representation) for the affected
+    resources back, rather than just a summary?"""
+    if request is None: return False
+    return 'return=representation' in request.META.get('HTTP_PREFER', '').replace(' ', '')
+
+def rdf_delete(record_connector, query, save=True, request=None, types=None): 
+    # With SPARQL_UPDATE, delete server-side in one SPARQL Update and
+    # answer 204; only fetch the statements first if the client wants them
+    # back, or if the store can't run the update.
+    if save and getattr(settings, 'SPARQL_UPDATE', False) and not wants_representation(request):
+        try:
+            record_connector.sparql_delete(query)
+            return x_domain(HttpResponse(status=204))
+        except SparqlSyntaxError:
+            pass
+        except Exception, e:
+            logging.warning("SPARQL Update failed, deleting by fetch and remove: %s"%e)
+
+    to_delete = record_connector.sparql_graph(query)
     deleted = bound_graph()
 
     for r in to_delete:
@@ -195,14 +465,14 @@ def rdf_delete(record_connector, query, save=True):
        
     if (save): record_connector.execute_transaction()
        
-    return rdf_response(serialize_rdf(deleted))
+    return rdf_graph_response(deleted, request, types)
 
-def rdf_post(record_connector, new_g):
+def rdf_post(record_connector, new_g, request=None, types=None):
     for s in new_g:
         record_connector.pending_adds.append(s)
 
     record_connector.execute_transaction()
-    return rdf_response(serialize_rdf(new_g))
+    return rdf_graph_response(new_g, request, types)
 
 
 logging.basicConfig(
@@ -6,6 +6,8 @@ for tighter integration into email-centric users in Indivo (now SMArt).
 """
 
 from smart.accesscontrol import security
+from smart.common.util import BadRequest
+from django.http import HttpResponseBadRequest
 
 class LazyUser(object):
   def __get__(self, request, obj_type = None):
@@ -17,6 +19,8 @@ class Authentication(object):
   def process_request(self, request):
     request.principal, request.oauth_request = security.get_principal(request)
   def process_exception(self, request, exception):
+    if isinstance(exception, BadRequest):
+      return HttpResponseBadRequest(str(exception))
     print "PROCESSING EXCEPTION"
     import sys, traceback
     print >> sys.stderr, exception, dir(exception)
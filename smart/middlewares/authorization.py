@@ -17,13 +17,16 @@ from smart import accesscontrol
 
 class Authorization(object):
 
+  def __init__(self):
+    # All the exceptions as one regex, compiled once
+    self.exceptions = re.compile("|".join(["(?:%s)"%p for p in settings.SMART_ACCESS_CONTROL_EXCEPTIONS]) or "(?!)")
+
   def process_view(self, request, view_func, view_args, view_kwargs):
     """ The process_view() hook allows us to examine the request before view_func is called"""
     # Url exception(s)
     
-    for exc_pattern in settings.SMART_ACCESS_CONTROL_EXCEPTIONS:
-      if re.match(exc_pattern, request.path):
-        return None
+    if self.exceptions.match(request.path):
+      return None
 
     if hasattr(view_func, 'resolve'):
       view_func = view_func.resolve(request)
@@ -1,61 +1,131 @@
-from smart.common.util import URIRef, Literal, sp, rdf, default_ns, get_property
+from smart.common.util import URIRef, Literal, sp, rdf, default_ns
 from smart.lib.utils import smart_path
 from smart.common.rdf_ontology import ontology
+import threading, time
 
-def augment_data(g, var_bindings, new_nodes):
-    # Quick and dirty CodedValue augmentation to start. 
-    # TODO: generalize this mechanism to allow plug-in extensibility!
-    
-    code_q = """
-            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-            PREFIX sp: <http://smartplatforms.org/terms#>
-            SELECT ?c
-            WHERE { ?cv rdf:type sp:CodedValue .
-                    ?cv sp:code ?c. }"""
-        
-    codes = set(g.query(code_q))
-    print "queried ", code_q, codes
-    codes = filter(lambda s: type(s) == URIRef and \
-                           not str(s).startswith("urn:smart_external_id:") and \
-                       not str(s).startswith(smart_path("")), codes)
-    
-    # For any URI nodes referencing external vocabularies...
-    for c in codes:
-        augment_code_uri(g,c)
+"""
+Augmentation of incoming graphs (on every POST and bulk import).
 
+Augmenters register themselves in order with @augmenter(name), and are
+called as f(g, index, var_bindings, new_nodes).  index is a GraphIndex
+built in one pass over g before any of them run, so the pipeline is
+linear in the size of the graph; it doesn't see triples the augmenters
+add.
+"""
 
-    # Attach each data element (med, problem, lab, etc), to the 
-    # base record URI with the sp:hasDataElement predicate.
-    recordURI = URIRef(smart_path("/records/%s"%var_bindings['record_id']))
-    for n in new_nodes:
-        node_type = get_property(g, n, rdf.type)
+class GraphIndex(object):
+    def __init__(self, g):
+        self.types = {}         # node --> [rdf:type]
+        self.by_type = {}       # rdf:type --> [node]
+        self.by_predicate = {}  # predicate --> [(subject, object)]
+        for (s, p, o) in g:
+            if p == rdf.type:
+                self.types.setdefault(s, []).append(o)
+                self.by_type.setdefault(o, []).append(s)
+            self.by_predicate.setdefault(p, []).append((s, o))
 
-        # Make sure this is a "medical data element" type
-        t = ontology[node_type]
-        if (t.base_path == None): continue
-        if (not t.base_path.startswith("/records")): continue
-        if (n == recordURI): continue # don't assert that the record has itself as an element
+    def type_of(self, node):
+        t = self.types.get(node, [])
+        assert len(t) <= 1, "Expect at most one %s on subject %s; got %s"%(rdf.type, node, len(t))
+        return t and t[0] or None
 
-        g.add((recordURI, sp.hasMedicalDataElement, n))
-        g.add((recordURI, rdf.type, sp.MedicalRecord))
+    def of_type(self, t):
+        return self.by_type.get(t, [])
+
+    def pairs(self, predicate):
+        return self.by_predicate.get(predicate, [])
+
+class PrefixTrie(object):
+    """Finds which of a set of prefixes a string starts with (the
+    longest, if several do) in one walk along the string."""
+    def __init__(self, prefixes):
+        self.root = {}
+        for p in prefixes:
+            node = self.root
+            for ch in p:
+                node = node.setdefault(ch, {})
+            node[None] = p
+
+    def match(self, s):
+        node = self.root
+        ret = None
+        for ch in s:
+            node = node.get(ch)
+            if node == None: break
+            ret = node.get(None, ret)
+        return ret
+
+augmenters = []     # [(name, f)], in the order they run
+timings = {}        # name --> [calls, seconds]
+timings_lock = threading.Lock()
+
+def augmenter(name):
+    """Decorator registering f as the augmenter called name."""
+    def ret(f):
+        augmenters.append((name, f))
+        timings.setdefault(name, [0, 0.0])
+        return f
+    return ret
 
+def augment_data(g, var_bindings, new_nodes):
+    index = GraphIndex(g)
+    for (name, f) in augmenters:
+        started = time.time()
+        f(g, index, var_bindings, new_nodes)
+        elapsed = time.time() - started
+        timings_lock.acquire()
+        try:
+            timings[name][0] += 1
+            timings[name][1] += elapsed
+        finally:
+            timings_lock.release()
+
+def stats():
+    """Calls and total seconds spent, per augmenter."""
+    timings_lock.acquire()
+    try:
+        return dict([(name, {"calls": t[0], "seconds": t[1]}) for (name, t) in timings.iteritems()])
+    finally:
+        timings_lock.release()
 
 code_map = [
     "http://rxnav.nlm.nih.gov/REST/rxcui?idtype=NUI&id=",
     "http://rxnav.nlm.nih.gov/REST/rxcui/",
     "http://www.ihtsdo.org/snomed-ct/concepts/",
     "http://fda.gov/UNII/"]
+code_systems = PrefixTrie(code_map)
+
+@augmenter("coded_values")
+def augment_codes(g, index, var_bindings, new_nodes):
+    # For any URI nodes referencing external vocabularies...
+    coded_values = set(index.of_type(sp.CodedValue))
+    local = smart_path("")
+    codes = set([c for (cv, c) in index.pairs(sp.code) if cv in coded_values])
+    for c in codes:
+        if type(c) != URIRef: continue
+        if str(c).startswith("urn:smart_external_id:") or str(c).startswith(local): continue
+        augment_code_uri(g, c)
 
 def augment_code_uri(g,c):
     g.add((c, rdf.type, sp.Code))
-    for v in code_map:
-        try:
-            assert str(c).startswith(v), "Not a %s: %s"%(v, str(c))
-            i = str(c)[len(v):]
-            g.add((c, sp.system, URIRef(v)))
-            g.add((c, default_ns['dcterms'].identifier, Literal(i)))
-            print "Augmented with", v, i
-            return
-        except: continue
-    
+    v = code_systems.match(str(c))
+    if v == None: return
+    g.add((c, sp.system, URIRef(v)))
+    g.add((c, default_ns['dcterms'].identifier, Literal(str(c)[len(v):])))
 
+@augmenter("record_elements")
+def augment_record_elements(g, index, var_bindings, new_nodes):
+    # Attach each data element (med, problem, lab, etc), to the
+    # base record URI with the sp:hasDataElement predicate.
+    recordURI = URIRef(smart_path("/records/%s"%var_bindings['record_id']))
+    is_element = {}     # type --> whether it's a "medical data element" type
+    for n in new_nodes:
+        node_type = index.type_of(n)
+        if node_type not in is_element:
+            t = ontology[node_type]
+            is_element[node_type] = t.base_path != None and t.base_path.startswith("/records")
+        if not is_element[node_type]: continue
+        if (n == recordURI): continue # don't assert that the record has itself as an element
+
+        g.add((recordURI, sp.hasMedicalDataElement, n))
+        g.add((recordURI, rdf.type, sp.MedicalRecord))
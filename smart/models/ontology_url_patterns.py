@@ -1,11 +1,13 @@
 import re
 from smart.common.rdf_ontology import api_types, api_calls, ontology
 from django.conf.urls.defaults import patterns
+from django.core.urlresolvers import RegexURLPattern
 from smart.lib.utils import MethodDispatcher
 
 class OntologyURLMapper():
   def __init__(self, urlpatterns):
       self.patterns = urlpatterns
+      self.trie = URLTrie()
 
       for p, calls in self.calls_by_path():
         methods = {}
@@ -15,10 +17,11 @@ class OntologyURLMapper():
           mapper = CallMapper.map_call(c)
           methods[str(c.method)] = mapper.maps_to
           arguments.update(mapper.arguments)
-        self.patterns += patterns( '',
-                                 (self.django_path(p),
-                                  MethodDispatcher(methods), 
-                                  arguments))
+        self.trie.add(self.trie_path(p), MethodDispatcher(methods), arguments)
+
+      # One pattern for the whole ontology-driven API, tried after the
+      # hand-written ones (as the per-path regexes used to be).
+      self.patterns.append(self.trie)
   
   def calls_by_path(self):
       ret = {}
@@ -47,6 +50,69 @@ class OntologyURLMapper():
     ret = "^" + ret[1:] + "$"
     return ret
 
+  # get from an absolute OWL path to the segments URLTrie.add expects
+  def trie_path(self, path):
+    ret = str(path).split("?")[0]
+    assert ret[0]=="/", "Expect smart.owl to provide absolute paths"
+    return ret[1:].split("/")
+
+class URLTrieNode(object):
+  def __init__(self):
+    self.literals = {}    # segment --> URLTrieNode
+    self.variables = []   # [(variable name, URLTrieNode)]
+    self.target = None    # (view, default kwargs)
+
+class URLTrie(RegexURLPattern):
+  """Resolves paths a segment at a time, in time proportional to the
+  path's length rather than the number of routes.  A "{name}" segment
+  matches any non-empty segment, binding it as a view kwarg; literal
+  segments are preferred over variables wherever both match."""
+
+  def __init__(self):
+    super(URLTrie, self).__init__(r'^(?P<path>.*)$', None)
+    self.root = URLTrieNode()
+
+  @property
+  def callback(self):
+    return None
+
+  def add(self, segments, view, arguments=None):
+    node = self.root
+    for s in segments:
+      if s.startswith("{") and s.endswith("}"):
+        name = s[1:-1]
+        child = [n for (v, n) in node.variables if v == name]
+        if not child:
+          child = [URLTrieNode()]
+          node.variables.append((name, child[0]))
+        node = child[0]
+      else:
+        assert "{" not in s, "Variables must be whole path segments: %s"%s
+        node = node.literals.setdefault(s, URLTrieNode())
+    node.target = (view, arguments or {})
+
+  def resolve(self, path):
+    match = self.match(self.root, path.split("/"), 0, [])
+    if match:
+      ((view, arguments), bindings) = match
+      kwargs = dict(bindings)
+      kwargs.update(arguments)
+      return view, (), kwargs
+
+  def match(self, node, segments, i, bindings):
+    if i == len(segments):
+      return node.target and (node.target, bindings)
+    s = segments[i]
+    child = node.literals.get(s)
+    if child:
+      ret = self.match(child, segments, i+1, bindings)
+      if ret: return ret
+    if s:
+      for (name, child) in node.variables:
+        ret = self.match(child, segments, i+1, bindings + [(name, s)])
+        if ret: return ret
+    return None
+
 class CallMapper(object):
     __mapper_registry = set()
 
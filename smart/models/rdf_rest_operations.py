@@ -1,17 +1,24 @@
 from smart.models.rdf_store import *
 from smart.models.records import *
 from smart.lib.utils import *
+from smart.common.util import get_property, remap_node, remap_nodes, parse_sparql_results, nt_term, BadRequest
+from smart.common.rdf_ontology import ontology
+from smart.common.query_builder import QueryPlanner
+from smart.models import response_store
 
-import re
+import re, base64
 
 def record_get_object(request, record_id, obj,  **kwargs):
     c = RecordStoreConnector(Record.objects.get(id=record_id))
+    return conditional_get(c, request, [obj.smart_type], lambda: get_object(c, obj, request, **kwargs))
+
+def get_object(c, obj, request, **kwargs):
     id = smart_path(request.path)                
     if ('external_id' in kwargs):
         id = obj.internal_id(c, kwargs['external_id'])
         assert (id != None), "No %s was found with external_id %s"%(obj.type, kwargs['external_id'])
     
-    return rdf_get(c, obj.query_one("<%s>"%id.encode()))
+    return rdf_get(c, obj.query_one("<%s>"%id.encode(), fields=obj.fields(request)), request, [obj.smart_type])
 
 def record_delete_object(request,  record_id, obj, **kwargs):
     c = RecordStoreConnector(Record.objects.get(id=record_id))
@@ -19,7 +26,7 @@ def record_delete_object(request,  record_id, obj, **kwargs):
     if ('external_id' in kwargs):            
         id = obj.internal_id(c, kwargs['external_id'])
         assert (id != None), "No %s was found with external_id %s"%(obj.type, kwargs['external_id'])
-    return rdf_delete(c, obj.query_one("<%s>"%id.encode()))
+    return rdf_delete(c, obj.query_one("<%s>"%id.encode()), request=request, types=[obj.smart_type])
 
 def record_get_all_objects(request, record_id, obj, above_obj=None, **kwargs):
     above_uri = None
@@ -27,7 +34,118 @@ def record_get_all_objects(request, record_id, obj, above_obj=None, **kwargs):
         above_uri = smart_path(smart_parent(request.path))
 
     c = RecordStoreConnector(Record.objects.get(id=record_id))
-    return rdf_get(c, obj.query_all(above_type=above_obj, above_uri=above_uri))
+    return conditional_get(c, request, [obj.smart_type], lambda: (above_obj == None and materialized_get(c, obj, request)) or rdf_get_all(c, obj, above_obj, above_uri, request))
+
+def materialized_get(c, obj, request):
+    """A whole (top-level) collection's stored response, if there's one
+    to serve; see smart.models.response_store."""
+    store = response_store.get_store()
+    if store is None or request.GET: return None
+    return store.response(c, obj.smart_type, request)
+
+query_planner = None
+
+def get_query_planner():
+    global query_planner
+    if query_planner == None:
+        query_planner = QueryPlanner(threshold=getattr(settings, 'SPARQL_PLANNER_THRESHOLD', 500),
+                                     batch_size=getattr(settings, 'SPARQL_PLANNER_BATCH_SIZE', 200),
+                                     estimate_ttl=getattr(settings, 'SPARQL_PLANNER_ESTIMATE_TTL', 300))
+    return query_planner
+
+def rdf_get_all(c, obj, above_obj, above_uri, request):
+    """GET a whole collection in whichever way the QueryPlanner picks:
+    one CONSTRUCT unless ?plan=two_phase or ?plan=auto (or
+    settings.SPARQL_QUERY_PLAN) enables two-phase plans.  ?fields=
+    projects the objects down to the named properties (see
+    SMArtType.projection)."""
+    if [p for p in ('limit', 'cursor', 'order_by') if p in request.GET]:
+        return rdf_get_page(c, obj, above_obj, above_uri, request)
+
+    planner = get_query_planner()
+    collection = (c.endpoint, c.context, obj.uri, above_uri)
+    force = request.GET.get('plan', getattr(settings, 'SPARQL_QUERY_PLAN', None))
+    fields = obj.fields(request)
+    if planner.choose(collection, force) == planner.SINGLE:
+        return rdf_get(c, obj.query_all(above_type=above_obj, above_uri=above_uri, fields=fields), request, [obj.smart_type])
+
+    roots = [s['root_subject'] for s in parse_sparql_results(c.sparql(obj.query_roots(above_obj, above_uri)))]
+    planner.observe(collection, len(roots))
+
+    # Blank-node roots can't be named in a second query.
+    if [r for r in roots if type(r) != URIRef]:
+        return rdf_get(c, obj.query_all(above_type=above_obj, above_uri=above_uri, fields=fields), request, [obj.smart_type])
+
+    return rdf_get_roots(c, obj, roots, request)
+
+def rdf_get_roots(c, obj, roots, request, values=True):
+    """GET the graphs below a list of (URI) roots, in batches -- named
+    with VALUES, or (values=False) a SPARQL 1.0 FILTER."""
+    fields = obj.fields(request)
+    batches = get_query_planner().batches(roots)
+    if len(batches) == 1:
+        return rdf_get(c, obj.query_values(batches[0], fields, values), request, [obj.smart_type], roots)
+
+    m = bound_graph()
+    for g in c.sparql_many([obj.query_values(b, fields, values) for b in batches], graphs=True):
+        m += g
+    return rdf_graph_response(m, request, [obj.smart_type], roots)
+
+def encode_cursor(order_key, root):
+    return base64.urlsafe_b64encode(simplejson.dumps([order_key and order_key.n3(), unicode(root)]))
+
+def decode_cursor(cursor):
+    """(order key, root) from a cursor made by encode_cursor."""
+    try:
+        (order_key, root) = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+        return (order_key and nt_term(order_key) or None, URIRef(root))
+    except (TypeError, ValueError):
+        raise BadRequest("Invalid cursor %s"%cursor)
+
+def rdf_get_page(c, obj, above_obj, above_uri, request):
+    """GET one page of a collection.
+
+    ?limit=n caps the page size; ?order_by=startDate (or a path like
+    specimenCollected/startDate, "-" first for descending) orders by a
+    property, otherwise roots come in URI order.  When more remain, a
+    Link: <...>; rel="next" header carries the ?cursor= for the next page.
+    Cursors name the last root returned (and its order key) rather than
+    an offset, so writes between requests don't shift page boundaries.
+
+    Each page's roots are named with a SPARQL 1.0 FILTER, or with VALUES
+    (Sesame 2.7+) where two-phase query plans are enabled."""
+    order_by = request.GET.get('order_by', '')
+    descending = order_by.startswith('-')
+    order_path = None
+    if order_by:
+        order_path = obj.smart_type.order_path(order_by.lstrip('-'))
+        if order_path == None:
+            raise BadRequest("Can't order %s by %s"%(obj.smart_type.name, order_by))
+
+    limit = request.GET.get('limit')
+    if limit != None:
+        if not (limit.isdigit() and int(limit) > 0):
+            raise BadRequest("Invalid limit %s"%limit)
+        limit = int(limit)
+
+    after = request.GET.get('cursor') and decode_cursor(request.GET['cursor']) or None
+    q = obj.query_roots(above_obj, above_uri, order_path, descending, after, limit and limit + 1)
+    sols = parse_sparql_results(c.sparql(q))
+    if [s for s in sols if type(s['root_subject']) != URIRef]:
+        raise BadRequest("Can't page blank-node %s"%obj.smart_type.name)
+
+    more = limit != None and len(sols) > limit
+    sols = sols[:limit]
+    values = getattr(settings, 'SPARQL_QUERY_PLAN', None) in (QueryPlanner.TWO_PHASE, QueryPlanner.AUTO)
+    response = rdf_get_roots(c, obj, [s['root_subject'] for s in sols], request, values)
+
+    if more:
+        last = sols[-1]
+        params = {'limit': limit, 'cursor': encode_cursor(last.get('order_key'), last['root_subject'])}
+        if order_by: params['order_by'] = order_by
+        if 'fields' in request.GET: params['fields'] = request.GET['fields']
+        response['Link'] = '<%s?%s>; rel="next"'%(smart_path(request.path), urllib.urlencode(params))
+    return response
 
 def record_delete_all_objects(request, record_id, obj,  above_obj=None, **kwargs):
     above_uri = None
@@ -36,7 +154,7 @@ def record_delete_all_objects(request, record_id, obj,  above_obj=None, **kwargs
 
     
     c = RecordStoreConnector(Record.objects.get(id=record_id))
-    return rdf_delete(c, obj.query_all(above_type=above_obj, above_uri=above_uri))
+    return rdf_delete(c, obj.query_all(above_type=above_obj, above_uri=above_uri), request=request, types=[obj.smart_type])
 
 def record_post_objects(request, record_id, obj, above_obj=None, **kwargs):
     c = RecordStoreConnector(Record.objects.get(id=record_id))
@@ -62,7 +180,7 @@ def record_post_objects(request, record_id, obj, above_obj=None, **kwargs):
                        pred, 
                        new_node))
 
-    return rdf_post(c, g)    
+    return rdf_post(c, g, request, [obj.smart_type])
 
 def record_put_object(request, record_id, obj, above_obj=None, **kwargs):
     # An idempotent PUT requires:  
@@ -71,4 +189,147 @@ def record_put_object(request, record_id, obj, above_obj=None, **kwargs):
     #  3.  Add any parent-child links if needed
     #  4.  Delete the thing from existing store, if it's present
     #  5.  POST the (new) thing to the store
-    pass
+    # Steps 4 and 5 go to the store as one transaction, holding only the
+    # difference between the stored object and the new one.
+    c = RecordStoreConnector(Record.objects.get(id=record_id))
+    g = parse_rdf(request.raw_post_data)
+
+    roots = list(g.subjects(rdf.type, obj.node))
+    assert len(roots) == 1, "PUT needs exactly one %s, got %s"%(obj.uri, len(roots))
+
+    ext = external_id_node(kwargs['external_id'])
+    assert roots[0] == ext or type(roots[0]) == BNode, \
+        "PUT to external_id %s can't carry a different id: %s"%(kwargs['external_id'], roots[0])
+    if roots[0] != ext: remap_node(g, roots[0], ext)
+
+    var_bindings = {'record_id': record_id}
+    parent = None
+    if (above_obj != None):
+        parent_ext = [v for (k, v) in kwargs.iteritems() if k.endswith("_external_id")]
+        assert len(parent_ext) == 1, "Can't tell which %s to PUT below."%above_obj.uri
+        parent = obj.internal_id(c, external_id_node(parent_ext[0]))
+        assert parent != None, "No %s was found with external_id %s"%(above_obj.uri, parent_ext[0])
+        var_bindings.update(uri_var_bindings(above_obj, parent))
+
+    obj.prepare_graph(g, c, var_bindings)
+    root = get_property(g, ext, sp.externalIDFor)
+
+    if (parent != None):
+        pred = above_obj.smart_type.predicate_for_contained_type(obj.smart_type)
+        assert pred != None, "Can't derive the predicate for adding %s below %s."%(obj.uri, above_obj.uri)
+        g.add((parent, pred, root))
+
+    (removes, adds) = graph_diff(c, root, g)
+    if removes or adds:
+        c.pending_removes = removes
+        c.pending_adds = adds
+        c.execute_transaction()
+    return rdf_graph_response(g, request, [obj.smart_type])
+
+def external_id_node(external_id):
+    return URIRef("urn:smart_external_id:%s"%external_id)
+
+def uri_var_bindings(obj, uri):
+    """The values of obj.path's {variables} in one of its resource URIs."""
+    names = re.findall("{(.*?)}", obj.path)
+    m = re.search(re.sub("{.*?}", "([^/]+)", obj.path) + "$", str(uri))
+    return m and dict(zip(names, m.groups())) or {}
+
+def graph_diff(c, root, new_g):
+    """(removes, adds) that take the stored copy of root to the one in
+    new_g.  Blank nodes are paired up with identical stored ones, so an
+    unchanged coded value isn't deleted and re-added; links from root to
+    other gettable resources (a medication's fulfillments) are kept unless
+    new_g restates them."""
+    owned = set(owned_triples(new_g, root))
+    others = [t for t in new_g if t not in owned and type(t[0]) != BNode]
+
+    queries = [owned_triples_query(root)]
+    if others: queries.append(triples_present_query(others))
+    results = c.sparql_many(queries, graphs=True)
+    old_g = results[0]
+    for present in results[1:]: old_g += present
+
+    mapping = {}
+    match_bnodes(new_g, old_g, root, root, mapping)
+    remap_nodes(new_g, mapping)
+
+    removes = []
+    for t in owned_triples(old_g, root):
+        if t in new_g: continue
+        if t[0] == root and type(t[2]) == URIRef and \
+                is_gettable(get_property(old_g, t[2], rdf.type)): continue
+        removes.append(t)
+    adds = [t for t in new_g if t not in old_g]
+    return (removes, adds)
+
+def is_gettable(t):
+    try:
+        return t != None and ontology[t].base_path != None
+    except KeyError:
+        return False
+
+def owned_triples(g, root):
+    """root's own statements, and those of the blank nodes below it."""
+    ret = []
+    todo, seen = [root], set()
+    while todo:
+        n = todo.pop()
+        if n in seen: continue
+        seen.add(n)
+        for t in g.triples((n, None, None)):
+            ret.append(t)
+            if type(t[2]) == BNode: todo.append(t[2])
+    return ret
+
+def owned_triples_query(root, depth=4):
+    """A CONSTRUCT for root's stored statements and those of the blank
+    nodes below it (up to depth levels down), plus the types of the
+    resources root links to."""
+    template = ["%s ?p_1 ?o_1."%root.n3(), "?o_1 rdf:type ?type_1."]
+    nested = ""
+    for i in xrange(depth, 1, -1):
+        template.append("?o_%s ?p_%s ?o_%s."%(i-1, i, i))
+        nested = "OPTIONAL { ?o_%s ?p_%s ?o_%s. FILTER(isBlank(?o_%s)) %s }"%(i-1, i, i, i-1, nested)
+    return """
+        PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+        CONSTRUCT { %s }
+        FROM $context
+        WHERE {
+          %s ?p_1 ?o_1.
+          OPTIONAL { ?o_1 rdf:type ?type_1. FILTER(isIRI(?o_1)) }
+          %s
+        }"""%("\n ".join(template), root.n3(), nested)
+
+def bnode_signature(g, b, path=()):
+    if b in path: return "..."
+    parts = []
+    for (s, p, o) in g.triples((b, None, None)):
+        v = type(o) == BNode and "[%s]"%bnode_signature(g, o, path + (b,)) or o.n3()
+        parts.append("%s %s"%(p.n3(), v))
+    return "; ".join(sorted(parts))
+
+def match_bnodes(new_g, old_g, new_node, old_node, mapping):
+    """Pair each blank node below new_node with an identical one below
+    old_node (same predicate, same statements all the way down)."""
+    candidates = {}
+    for (p, o) in old_g.predicate_objects(old_node):
+        if type(o) == BNode:
+            candidates.setdefault((p, bnode_signature(old_g, o)), []).append(o)
+    for (p, o) in new_g.predicate_objects(new_node):
+        if type(o) != BNode or o in mapping: continue
+        olds = candidates.get((p, bnode_signature(new_g, o)))
+        if olds:
+            mapping[o] = olds.pop()
+            match_bnodes(new_g, old_g, o, mapping[o], mapping)
+
+def triples_present_query(triples):
+    """A CONSTRUCT returning whichever of triples are already stored."""
+    template, alternatives = [], []
+    for (i, (s, p, o)) in enumerate(triples):
+        template.append("%s %s ?o_%s."%(s.n3(), p.n3(), i))
+        alternatives.append("{ %s %s ?o_%s. FILTER(sameTerm(?o_%s, %s)) }"%(s.n3(), p.n3(), i, i, o.n3()))
+    return """
+        CONSTRUCT { %s }
+        FROM $context
+        WHERE { %s }"""%("\n ".join(template), "\n UNION ".join(alternatives))
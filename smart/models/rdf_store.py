@@ -6,14 +6,22 @@ Ben Adida
 
 from base import *
 from django.utils import simplejson
-from smart.lib import utils
-from smart.common.util import URIRef, Literal, BNode
+from smart.lib import utils, sparql_cache
+from smart.common.util import URIRef, Literal, BNode, parse_rdf
+from smart.common import quad_store, sparql_subset
 from smart.models.apps import *
 from smart.models.accounts import *
 from smart.models import PHA
 from django.conf import settings
 from string import Template
-import urllib, uuid
+import urllib, uuid, copy, time, logging, threading
+from multiprocessing.pool import ThreadPool
+
+# Sesame answers CONSTRUCTs in whichever RDF format we ask for.  N-Triples
+# is far cheaper than RDF/XML to produce and to parse, so internal callers
+# that only want a graph back ask for it (Sesame < 2.7 calls it text/plain).
+RDF_XML_ACCEPT = "application/rdf+xml,  application/sparql-results+xml"
+NTRIPLES_ACCEPT = "application/n-triples, text/plain, application/rdf+xml;q=0.5"
 
 class PHA_RDFStore(Object): 
   Meta = BaseMeta()
@@ -34,17 +42,60 @@ class SesameConnector(object):
         self.pending_clears = []
         self.endpoint = endpoint
 
-    def request(self, url, method, headers, data=None):
-        return utils.url_request(url, method, headers, data)
+    def request(self, url, method, headers, data=None, idempotent=None):
+        return utils.url_request(url, method, headers, data, pooled=True, idempotent=idempotent)
+
+    def request_stream(self, url, method, headers, chunks):
+        return utils.url_request_stream(url, method, headers, chunks)
+
+    def pool_stats(self):
+        """Keep-alive pool statistics for this connector's endpoint."""
+        (scheme, url) = self.endpoint.split("://")
+        return utils.sparql_pool(scheme, url.split("/")[0]).stats()
         
-    def sparql(self, q):
+    def sparql(self, q, accept=RDF_XML_ACCEPT):
         u = self.endpoint
         #print "Querying, ", q
         data = urllib.urlencode({"query" : q})
+        # POSTed only to fit long queries; safe to retry.
         res = self.request(u, "POST", {"Content-type": "application/x-www-form-urlencoded", 
-                                        "Accept" : "application/rdf+xml,  application/sparql-results+xml"}, data)
+                                        "Accept" : accept}, data, idempotent=True)
         return res
-            
+
+    def sparql_stream(self, q, accept=RDF_XML_ACCEPT):
+        """Like sparql, but returns an iterable over the result body as it
+        arrives from the store, for relaying straight to a client."""
+        data = urllib.urlencode({"query" : q})
+        return utils.url_request_open(self.endpoint, "POST", {"Content-type": "application/x-www-form-urlencoded", 
+                                                              "Accept" : accept}, data, pooled=True, idempotent=True)
+
+    def sparql_graph(self, q, model=None):
+        """Run a CONSTRUCT and parse the result into model (or a new graph),
+        fetching it as N-Triples rather than RDF/XML."""
+        return parse_rdf(self.sparql(q, NTRIPLES_ACCEPT), model)
+
+    def sparql_many(self, queries, max_concurrency=None, graphs=False):
+        """Run several queries concurrently; results come back in order."""
+        return sparql_many([(self, q) for q in queries], max_concurrency, graphs)
+
+    def sparql_update(self, u):
+        """Run a SPARQL 1.1 Update request against the store."""
+        data = urllib.urlencode({"update" : u})
+        return self.request("%s/statements"%self.endpoint, "POST",
+                            {"Content-type": "application/x-www-form-urlencoded"}, data)
+
+    def size(self):
+        """Number of statements in the store (or in our context)."""
+        params = self.context and urllib.urlencode({"context": "<%s>"%self.context}) or ""
+        return int(self.request("%s/size"%self.endpoint, "GET", {"Accept": "text/plain"}, params))
+
+    def sparql_delete(self, q):
+        """Delete every statement the CONSTRUCT q would return with one
+        server-side SPARQL Update, rather than fetching them and posting
+        them back as removes.  Raises SparqlSyntaxError, before touching
+        the store, if q can't be rewritten as an update."""
+        self.sparql_update(sparql_subset.construct_to_delete(q))
+
     def serialize_node(self, node):
         t = None
 
@@ -57,7 +108,9 @@ class SesameConnector(object):
         else:
           raise Exception("Unknown node type for %s"%node)          
         
-        return "<%s><![CDATA[%s]]></%s>"%(t,str(node),t)
+        # "]]>" can't appear inside a CDATA section; split it across two.
+        v = unicode(node).encode("utf-8").replace("]]>", "]]]]><![CDATA[>")
+        return "<%s><![CDATA[%s]]></%s>"%(t,v,t)
 
 
     def serialize_statement(self, st):
@@ -66,13 +119,14 @@ class SesameConnector(object):
                            self.serialize_node(st[2]),
                            )
 
-    
-    def execute_transaction(self):
-        t = '<?xml version="1.0"?>'
-        t += "<transaction>\n"
+    def transaction_chunks(self):
+        """Yield the application/x-rdftransaction document piece by piece,
+        so it can be streamed to the store as it's encoded."""
+        yield '<?xml version="1.0"?>'
+        yield "<transaction>\n"
 
         if len(self.pending_clears) > 0:
-          t += """
+          yield """
           <clear>
           <contexts>
           %s
@@ -80,22 +134,93 @@ class SesameConnector(object):
           </clear>"""%"\n".join([self.serialize_node(c) for c in self.pending_clears])
 
         for a in self.pending_adds:
-            t += "<add>%s</add>\n"%self.serialize_statement(a)
+            yield "<add>%s</add>\n"%self.serialize_statement(a)
 
         for d in self.pending_removes:
-            t += "<remove>%s</remove>\n"%self.serialize_statement(d)
+            yield "<remove>%s</remove>\n"%self.serialize_statement(d)
         
-        t += "</transaction>"
+        yield "</transaction>"
+    
+    def execute_transaction(self):
         u = "%s/statements"%self.endpoint
-#        print "Executing \n", t
-        success =  self.request(u, "POST", {"Content-Type" : "application/x-rdftransaction"}, t)
+        success = self.request_stream(u, "POST", 
+                                      {"Content-Type" : "application/x-rdftransaction"}, 
+                                      self.transaction_chunks())
         if (success):
             self.pending_clears = []
             self.pending_adds = []
             self.pending_removes = []
             return True
-        raise Exception("Failed to execute sesame transaction: %s"%t)
+        raise Exception("Failed to execute sesame transaction: %s clears, %s adds, %s removes"%(
+                len(self.pending_clears), len(self.pending_adds), len(self.pending_removes)))
+
+    def batch_connector(self, adds, context=None):
+        """A copy of this connector holding just one batch of adds."""
+        c = copy.copy(self)
+        c.pending_clears = []
+        c.pending_adds = adds
+        c.pending_removes = []
+        if context: c.context = context
+        return c
+
+    def execute_bulk_transaction(self, batch_size=5000, workers=4, atomic=False):
+        """Commit pending_adds in batches of batch_size statements, with up
+        to workers batches in flight at once over pooled connections.
+
+        With atomic=True the batches are staged in a scratch context, then
+        swapped into this connector's context by a single SPARQL Update
+        (which also applies any pending clears), so a failed load leaves
+        the target context untouched.  Returns throughput statistics."""
+        started = time.time()
+        adds = self.pending_adds
+        batches = [adds[i:i+batch_size] for i in xrange(0, len(adds), batch_size)]
+
+        staging = None
+        if atomic:
+            if not self.context:
+                raise Exception("Atomic bulk transactions need a context to stage into.")
+            if self.pending_removes:
+                raise Exception("Atomic bulk transactions only support clears and adds.")
+            staging = "http://smartplatforms.org/staging/%s"%uuid.uuid4()
+        elif self.pending_clears or self.pending_removes:
+            # Clears and removes go first, in their own (small) transaction.
+            c = self.batch_connector([])
+            c.pending_clears = self.pending_clears
+            c.pending_removes = self.pending_removes
+            c.execute_transaction()
+
+        pool = ThreadPool(max(1, min(workers, len(batches))))
+        try:
+            try:
+                for ok in pool.imap_unordered(lambda b: self.batch_connector(b, staging).execute_transaction(), batches):
+                    pass
+            except:
+                if staging: self.sparql_update("DROP SILENT GRAPH <%s>"%staging)
+                raise
+        finally:
+            pool.close()
+
+        if staging:
+            swap = ["CLEAR SILENT GRAPH %s"%c.n3() for c in self.pending_clears]
+            swap.append("ADD SILENT GRAPH <%s> TO GRAPH <%s>"%(staging, self.context))
+            swap.append("DROP SILENT GRAPH <%s>"%staging)
+            self.sparql_update(" ;\n".join(swap))
+
+        elapsed = time.time() - started
+        stats = {"statements": len(adds),
+                 "batches": len(batches),
+                 "seconds": elapsed,
+                 "statements_per_sec": elapsed and len(adds) / elapsed or 0.0}
+        logging.info("Bulk transaction: %(statements)s statements in %(batches)s batches, %(seconds).2fs (%(statements_per_sec).0f statements/sec)"%stats)
+
+        self.pending_clears = []
+        self.pending_adds = []
+        self.pending_removes = []
+        return stats
    
+# Called as f(endpoint, context) after each write to a context.
+write_listeners = []
+
 class ContextSesameConnector(SesameConnector):
     def __init__(self, endpoint, context):
         super(ContextSesameConnector, self).__init__(endpoint)
@@ -109,26 +234,184 @@ class ContextSesameConnector(SesameConnector):
                               self.serialize_node(URIRef(self.context.encode()))
                              )
         
-    def sparql(self, q):
+    def bind_context(self, q):
         if (q.find("$context") == -1 ): raise Exception("NO CONTEXT FOR %s"%q)
-        q = Template(q).substitute(context="<%s>"%self.context)
-        return super(ContextSesameConnector, self).sparql(q)
+        return Template(q).substitute(context="<%s>"%self.context)
+
+    def sparql(self, q, accept=RDF_XML_ACCEPT):
+        q = self.bind_context(q)
+
+        cache = sparql_cache.get_cache()
+        if cache is None:
+            return super(ContextSesameConnector, self).sparql(q, accept)
+
+        (key, res) = cache.get(self.endpoint, self.context, q, accept)
+        if res is None:
+            res = super(ContextSesameConnector, self).sparql(q, accept)
+            cache.set(self.endpoint, self.context, key, res)
+        return res
+
+    def sparql_stream(self, q, accept=RDF_XML_ACCEPT):
+        q = self.bind_context(q)
+
+        cache = sparql_cache.get_cache()
+        if cache is None:
+            return super(ContextSesameConnector, self).sparql_stream(q, accept)
+
+        (key, res) = cache.get(self.endpoint, self.context, q, accept)
+        if res is not None: return [res]
+
+        # Cache the body as it streams past, if it turns out small enough.
+        stream = super(ContextSesameConnector, self).sparql_stream(q, accept)
+        return tee_to_cache(stream, cache.backend.max_bytes,
+                            lambda body: cache.set(self.endpoint, self.context, key, body))
+
+    def lookup_map(self, name):
+        """A dict for memoizing lookups against this context.  With the
+        SPARQL cache on, it's shared by the whole process until the next
+        write to the context; otherwise it's this connector's own."""
+        cache = sparql_cache.get_cache()
+        if cache is not None:
+            return cache.lookup_map(self.endpoint, self.context, name)
+        if not hasattr(self, "lookup_maps"): self.lookup_maps = {}
+        return self.lookup_maps.setdefault(name, {})
+
+    def generations(self):
+        """What a GET from our context depends on; it changes with every
+        write to the context.  None if writes aren't being counted
+        (there's no SPARQL cache)."""
+        cache = sparql_cache.get_cache()
+        if cache is None: return None
+        return cache.generations(self.endpoint, self.context)
+
+    def invalidate_cache(self, contexts=None):
+        """Bump the cache generation of every context we're writing to."""
+        self.lookup_maps = {}
+        cache = sparql_cache.get_cache()
+        if cache is None: return
+        for c in set([str(c) for c in (contexts or [])] + [self.context]):
+            cache.invalidate(self.endpoint, c)
+            for f in write_listeners:
+                f(self.endpoint, c)
+
+    def execute_transaction(self):
+        clears = list(self.pending_clears)
+        try:
+            return super(ContextSesameConnector, self).execute_transaction()
+        finally:
+            self.invalidate_cache(clears)
+
+    def sparql_update(self, u):
+        if (u.find("$context") != -1): u = self.bind_context(u)
+        try:
+            return super(ContextSesameConnector, self).sparql_update(u)
+        finally:
+            self.invalidate_cache()
 
     def destroy_triples(self):
         self.pending_clears.append(URIRef(self.context.encode()))
         self.execute_transaction()
 
+def tee_to_cache(chunks, max_bytes, store):
+    """Pass chunks through, then hand the whole body to store() -- unless
+    it grew past max_bytes, in which case we stop keeping a copy."""
+    body, size = [], 0
+    try:
+        for c in chunks:
+            if body is not None:
+                body.append(c)
+                size += len(c)
+                if size > max_bytes: body = None
+            yield c
+        if body is not None: store("".join(body))
+    finally:
+        if hasattr(chunks, 'close'): chunks.close()
+
+query_pool = None
+query_pool_lock = threading.Lock()
+
+def sparql_many(connector_queries, max_concurrency=None, graphs=False):
+    """Run each (connector, query) pair on a shared worker pool, with at
+    most max_concurrency (default settings.SPARQL_MAX_CONCURRENCY) of this
+    call's queries in flight at once, so one composite request can't tie
+    up the whole store.  Returns the results in the order given -- as
+    parsed graphs (see sparql_graph) if graphs=True."""
+    global query_pool
+    cap = max_concurrency or getattr(settings, 'SPARQL_MAX_CONCURRENCY', 4)
+    run = graphs and (lambda c, q: c.sparql_graph(q)) or (lambda c, q: c.sparql(q))
+    if len(connector_queries) < 2 or cap < 2:
+        return [run(c, q) for (c, q) in connector_queries]
+
+    if query_pool is None:
+        query_pool_lock.acquire()
+        try:
+            if query_pool is None:
+                query_pool = ThreadPool(getattr(settings, 'SPARQL_QUERY_THREADS', 10))
+        finally:
+            query_pool_lock.release()
+
+    results = [None] * len(connector_queries)
+    in_flight = []
+    for (i, (c, q)) in enumerate(connector_queries):
+        if len(in_flight) >= cap:
+            (j, r) = in_flight.pop(0)
+            results[j] = r.get()
+        in_flight.append((i, query_pool.apply_async(run, (c, q))))
+    for (j, r) in in_flight:
+        results[j] = r.get()
+    return results
+
+class EmbeddedConnector(SesameConnector):
+    """Same interface as SesameConnector, but answered in-process by an
+    embedded quad store (one per endpoint) instead of Sesame over HTTP."""
+
+    def store(self):
+        name = self.endpoint.rstrip("/").rsplit("/", 1)[-1]
+        return quad_store.get_store(name, getattr(settings, 'EMBEDDED_STORE_DIR', None))
+
+    def sparql(self, q, accept=RDF_XML_ACCEPT):
+        format = accept.startswith("application/n-triples") and "nt" or accept.startswith("text/turtle") and "turtle" or "xml"
+        return sparql_subset.query(self.store(), q, format)
+
+    def sparql_stream(self, q, accept=RDF_XML_ACCEPT):
+        # q arrives with its context already bound
+        return [EmbeddedConnector.sparql(self, q, accept)]
+
+    def sparql_update(self, u):
+        return sparql_subset.update(self.store(), u)
+
+    def size(self):
+        return self.store().count(self.context and URIRef(self.context.encode()) or None)
+
+    def execute_transaction(self):
+        context = self.context and URIRef(self.context.encode()) or None
+        self.store().apply(clears=self.pending_clears,
+                           adds=self.pending_adds,
+                           removes=self.pending_removes,
+                           context=context)
+        self.pending_clears = []
+        self.pending_adds = []
+        self.pending_removes = []
+        return True
+
+class ContextEmbeddedConnector(ContextSesameConnector, EmbeddedConnector):
+    pass
+
+if getattr(settings, 'RDF_STORE_BACKEND', 'sesame') == 'embedded':
+    StoreConnector, ContextStoreConnector = EmbeddedConnector, ContextEmbeddedConnector
+else:
+    StoreConnector, ContextStoreConnector = SesameConnector, ContextSesameConnector
 
-class DemographicConnector(SesameConnector):
+class DemographicConnector(StoreConnector):
     def __init__(self):
         super(DemographicConnector, self).__init__(settings.RECORD_SPARQL_ENDPOINT)
 
-class RecordStoreConnector(ContextSesameConnector):
+class RecordStoreConnector(ContextStoreConnector):
     def __init__(self, record):
         super(RecordStoreConnector, self).__init__(settings.RECORD_SPARQL_ENDPOINT, 
                                                    "http://smartplatforms.org/records/%s"%record.id)
 
-class TemporaryStoreConnector(ContextSesameConnector):
+class TemporaryStoreConnector(ContextStoreConnector):
     def __init__(self):
         self.temp_id =str(uuid.uuid4()) 
         super(TemporaryStoreConnector, self).__init__(settings.TEMP_SPARQL_ENDPOINT, 
@@ -139,7 +422,7 @@ class TemporaryStoreConnector(ContextSesameConnector):
     def __exit__(self, type, value, traceback):
         self.destroy_triples()
     
-class PHAConnector(ContextSesameConnector):
+class PHAConnector(ContextStoreConnector):
     def __init__(self, request):
         pha = request.principal
         if not (isinstance(pha, PHA)):
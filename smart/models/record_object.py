@@ -2,7 +2,7 @@ import re, uuid
 from django.conf import settings
 from smart.common.rdf_ontology import api_types, api_calls, ontology
 from rdf_rest_operations import *
-from smart.common.util import remap_node, parse_rdf, get_property, LookupType, URIRef, sp, rdf, default_ns
+from smart.common.util import remap_node, remap_nodes, parse_rdf, get_property, LookupType, URIRef, sp, rdf, default_ns, parse_sparql_results
 from ontology_url_patterns import CallMapper, BasicCallMapper
 from graph_augmenter import augment_data
 
@@ -52,27 +52,39 @@ class RecordObject(object):
         return None    
          
     def internal_id(self, record_connector, external_id):
-        idquery = """
-            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
-            CONSTRUCT {%s <http://smartplatforms.org/terms#externalIDFor> ?o.}
+        return self.internal_ids(record_connector, [external_id])[external_id]
+
+    def internal_ids(self, record_connector, external_ids, batch_size=200):
+        """Map each external ID to its internal URI (or None), with one
+        query per batch_size IDs not already in the connector's
+        "external_ids" lookup map."""
+        if not external_ids: return {}
+        known = record_connector.lookup_map("external_ids")
+        missing = list(set([e for e in external_ids if e not in known]))
+        if missing:
+            batches = [missing[i:i+batch_size] for i in xrange(0, len(missing), batch_size)]
+            found = {}
+            for res in record_connector.sparql_many([self.internal_ids_query(b) for b in batches]):
+                for sol in parse_sparql_results(res):
+                    found.setdefault(sol['external_id'], set()).add(sol['internal_id'])
+
+            for e in missing:
+                ids = found.get(e, set())
+                if len(ids) > 1:
+                    raise Exception( "MORE THAN ONE ENTITY WITH EXTERNAL ID %s : %s"%(e, ", ".join([str(x) for x in ids])))
+                known[e] = ids and ids.pop() or None
+        return dict([(e, known[e]) for e in external_ids])
+
+    def internal_ids_query(self, external_ids):
+        # A FILTER rather than VALUES, which SPARQL 1.0 stores (Sesame
+        # before 2.7) don't understand.
+        return """
+            SELECT ?external_id ?internal_id
             FROM $context
             WHERE {
-                    %s <http://smartplatforms.org/terms#externalIDFor> ?o.
-                  }  """%(external_id.n3(), external_id.n3())
-        print "querying", idquery
-        id_graph = parse_rdf(record_connector.sparql(idquery))
-
-
-        l = list(id_graph)
-        if len(l) > 1:
-            raise Exception( "MORE THAN ONE ENTITY WITH EXTERNAL ID %s : %s"%(external_id, ", ".join([str(x[0]) for x in l])))
-
-        try:
-            s =  l[0][2]
-            print "FOUND an internal id", s
-            return s
-        except: 
-            return None
+                    ?external_id <http://smartplatforms.org/terms#externalIDFor> ?internal_id.
+                    FILTER (%s)
+                  }  """%" || ".join(["?external_id = %s"%e.n3() for e in external_ids])
         
     def path_var_bindings(self, request_path):
         var_names =  re.findall("{(.*?)}",self.path)
@@ -144,29 +156,43 @@ class RecordObject(object):
         node_map = {}    
         nodes = set(g.subjects()) | set(g.objects())
 
+        # Resolve every external ID up front, in batches, rather than one
+        # query per node in determine_remap_target.
+        self.internal_ids(c, [n for n in nodes if type(n) == URIRef and str(n).startswith("urn:smart_external_id:")])
+
         for s in nodes:
             new_node = self.determine_remap_target(g,c,s, var_bindings)
             if new_node: node_map[s] = new_node
 
-        for (old_node, new_node) in node_map.iteritems():
-            remap_node(g, old_node, new_node)
-            if type(old_node) == URIRef:
-                g.add((old_node, sp.externalIDFor, new_node))
-
+        remap_nodes(g, node_map, link_predicate=sp.externalIDFor)
 
         return node_map.values()
 
     def prepare_graph(self, g, c, var_bindings=None):
         new_uris = self.generate_uris(g, c, var_bindings)
         augment_data(g, var_bindings, new_uris)
+        return new_uris
 
-    def query_one(self, id,filter_clause=""):
-        ret = self.smart_type.query(one_name=id,filter_clause=filter_clause)
+    def query_one(self, id,filter_clause="", fields=None):
+        ret = self.smart_type.query(one_name=id,filter_clause=filter_clause, fields=fields)
         return ret
 
-    def query_all(self, above_type=None, above_uri=None,filter_clause=""):
+    def query_all(self, above_type=None, above_uri=None,filter_clause="", fields=None):
         atype = above_type and above_type.smart_type or None
-        return self.smart_type.query(above_type=atype, above_uri=above_uri,filter_clause=filter_clause)
+        return self.smart_type.query(above_type=atype, above_uri=above_uri,filter_clause=filter_clause, fields=fields)
+
+    def query_roots(self, above_type=None, above_uri=None, order_by=None, descending=False, after=None, limit=None):
+        atype = above_type and above_type.smart_type or None
+        return self.smart_type.roots_query(above_type=atype, above_uri=above_uri, order_by=order_by,
+                                           descending=descending, after=after, limit=limit)
+
+    def query_values(self, roots, fields=None, values=True):
+        return self.smart_type.values_query(roots, fields, values)
+
+    def fields(self, request):
+        """The projection asked for by ?fields=, or None for everything."""
+        fields = request.GET.get('fields')
+        return fields and self.smart_type.projection(fields) or None
 
 for t in api_types:
     RecordObject(t)
@@ -250,7 +276,7 @@ def record_get_filtered_labs(request, *args, **kwargs):
           ?filteredLab <http://smartplatforms.org/terms#code> ?filteredLoinc.
         }  FILTER (%s)"""%filters
            )
-      return rdf_response(c.sparql(q))
+      return conditional_get(c, request, [l.smart_type], lambda: rdf_get(c, q, request, [l.smart_type]))
 
 
 
@@ -263,13 +289,11 @@ def record_get_allergies(request, *args, **kwargs):
       ae = RecordObject["http://smartplatforms.org/terms#AllergyException"]
       c = RecordStoreConnector(Record.objects.get(id=record_id))
 
-      ma = c.sparql(a.query_all())
-      m = parse_rdf(ma)
-
-      mae = c.sparql(ae.query_all())
-      parse_rdf(mae, model=m)
-
-      return rdf_response(serialize_rdf(m))
+      def respond():
+          (m, mae) = c.sparql_many([a.query_all(), ae.query_all()], graphs=True)
+          m += mae
+          return rdf_graph_response(m, request, [a.smart_type, ae.smart_type])
+      return conditional_get(c, request, [a.smart_type, ae.smart_type], respond)
 
 @CallMapper.register(category="record_item",
                      method="POST",
@@ -280,4 +304,7 @@ def record_post_alert(request, *args, **kwargs):
       app = request.principal.share.with_app
 
       RecordAlert.from_rdf(request.raw_post_data, r, app)
+      if wants_json(request):
+          a = RecordObject["http://smartplatforms.org/terms#Alert"]
+          return rdf_graph_response(parse_rdf(request.raw_post_data), request, [a.smart_type])
       return rdf_response(request.raw_post_data)
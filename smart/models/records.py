@@ -10,7 +10,7 @@ from smart.common.util import rdf, foaf, sp, serialize_rdf, parse_rdf, bound_gra
 from smart.lib import utils
 from smart.models.apps import *
 from smart.models.accounts import *
-from smart.models.rdf_store import DemographicConnector, RecordStoreConnector
+from smart.models.rdf_store import DemographicConnector, RecordStoreConnector, sparql_many
 from string import Template
 import re, datetime
 
@@ -42,34 +42,32 @@ class Record(Object):
 
   @classmethod
   def search_records(cls, query):
+    return serialize_rdf(cls.search_records_graph(query))
+
+  @classmethod
+  def search_records_graph(cls, query):
     c = DemographicConnector()
-    res = c.sparql(query)
-    m = parse_rdf(res)
+    m = c.sparql_graph(query)
 
     # for each person, look up their demographics object.
     from smart.models.record_object import RecordObject
     people = m.triples((None, rdf['type'], sp.Demographics))
     pobj = RecordObject[sp.Demographics] 
 
-    return_graph = bound_graph()
+    # Pull out each person's demographics, from their own record context.
+    queries = []
     for person in people:
       p = person[0] # subject
 
-      # Connect to RDF Store
       pid = re.search("\/records\/(.*?)\/demographics", str(p)).group(1)
       print "matched ", p," to ", pid
       c = RecordStoreConnector(Record.objects.get(id=pid))
+      queries.append((c, pobj.query_one(p.n3())))
 
-      # Pull out demographics
-      p_uri = p.n3() # subject URI
-      p_subgraph = parse_rdf(c.sparql(pobj.query_one(p_uri)))
-      print "subq: " , pobj.query_one(p_uri)
-      print "subgraph: ", serialize_rdf(p_subgraph)
-      
-      # Append to search result graph
-      return_graph += p_subgraph
-    print "got", serialize_rdf(return_graph)
-    return serialize_rdf(return_graph)
+    return_graph = bound_graph()
+    for g in sparql_many(queries, graphs=True):
+      return_graph += g
+    return return_graph
 
   @classmethod
   def rdf_to_objects(cls, res):
@@ -149,6 +147,14 @@ class RecordAlert(Object):
     a.save()
     return a
 
+  def to_json(self):
+    return {'id': self.id,
+            'notes': self.alert_text,
+            'time': self.alert_time and self.alert_time.isoformat(),
+            'triggering_app': self.triggering_app.email,
+            'acknowledged_by': self.acknowledged_by and self.acknowledged_by.id,
+            'acknowledged_at': self.acknowledged_at and self.acknowledged_at.isoformat()}
+
   def acknowledge(self, account):
     self.acknowledged_by =  account
     self.acknowledged_at = datetime.datetime.now()
@@ -0,0 +1,219 @@
+"""
+Materialized responses for whole record collections
+
+The body of GET /records/{id}/<collection>/, for each record, type and
+format, is kept gzipped in a store (one of sparql_cache's backends:
+'local' per process, or 'shared' in an sqlite file on local disk) along
+with the write generations (see SparqlCache.generations) it was built
+at.  record_get_all_objects serves a body whose generations are still
+current straight from the store, without touching the triple store or
+a serializer.
+
+Bodies are built in the background: on a miss (the request is answered
+live meanwhile), after any write to the record, and
+on warm-up (see warm, and load_tools/warm_responses.py).  With
+RESPONSE_STORE_MAX_STALE, a body that a write has made stale is still
+served, with a Warning, for that many seconds after it was built, while
+its rebuild runs.
+"""
+
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils import simplejson
+from smart.lib import sparql_cache
+from smart.lib.utils import rdf_format, rdf_formats, accepts_gzip, x_domain, etag
+from smart.common import rdf_json
+from smart.common.rdf_ontology import ontology
+from smart.models import rdf_store
+from smart.models.records import Record
+from multiprocessing.pool import ThreadPool
+import threading, time, hashlib, logging, gzip, zlib, cStringIO
+
+class ResponseStore(object):
+    def __init__(self, backend, formats=("xml", "json"), max_stale=0, threads=2):
+        self.backend = backend
+        self.formats = formats
+        self.max_stale = max_stale
+        self.pool = ThreadPool(threads)
+        self.lock = threading.Lock()
+        self.building = set()   # (endpoint, context, type_uri, format) queued or running
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def key(self, endpoint, context, type_uri, format):
+        return hashlib.sha1("response\n%s\n%s\n%s\n%s"%(endpoint, context, type_uri, format)).hexdigest()
+
+    def index_key(self, endpoint, context):
+        return hashlib.sha1("responses\n%s\n%s"%(endpoint, context)).hexdigest()
+
+    def scope(self, endpoint, context):
+        return "%s %s"%(endpoint, context)
+
+    def materialized(self, endpoint, context):
+        """[(type_uri, format)] built for context so far."""
+        v = self.backend.get(self.index_key(endpoint, context))
+        return v and [tuple(e) for e in simplejson.loads(v)] or []
+
+    def get(self, endpoint, context, type_uri, format):
+        """(header, gzipped body) stored for a collection, or None."""
+        v = self.backend.get(self.key(endpoint, context, type_uri, format))
+        if v is None: return None
+        (header, body) = v.split("\n", 1)
+        return (simplejson.loads(header), body)
+
+    def build(self, endpoint, context, type_uri, format):
+        """Run the collection's query and store its body."""
+        c = rdf_store.ContextStoreConnector(endpoint, context)
+        t = ontology[type_uri]
+        # Taken before the query, so a write that races it leaves the
+        # body looking stale rather than current.
+        generations = c.generations()
+        if format == "json":
+            triples = rdf_json.parse_triples(c.sparql(t.query_all(), rdf_formats["json"][1]))
+            body = simplejson.dumps(rdf_json.to_json(triples, [t]), sort_keys=True)
+        else:
+            body = c.sparql(t.query_all(), rdf_formats[format][1])
+        if type(body) == unicode: body = body.encode("utf-8")
+
+        buf = cStringIO.StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=6)
+        f.write(body)
+        f.close()
+        header = simplejson.dumps({"generations": generations, "built": time.time()})
+        self.backend.set(self.key(endpoint, context, type_uri, format), header + "\n" + buf.getvalue(),
+                         self.scope(endpoint, context))
+
+        entries = self.materialized(endpoint, context)
+        if (type_uri, format) not in entries:
+            entries.append((type_uri, format))
+            self.backend.set(self.index_key(endpoint, context), simplejson.dumps(entries),
+                             self.scope(endpoint, context))
+
+    def rebuild(self, endpoint, context, type_uri, format):
+        """Queue a build, unless one for the same body is already queued."""
+        job = (endpoint, context, type_uri, format)
+        self.lock.acquire()
+        try:
+            if job in self.building: return
+            self.building.add(job)
+        finally:
+            self.lock.release()
+        self.pool.apply_async(self.run_build, job)
+
+    def run_build(self, endpoint, context, type_uri, format):
+        job = (endpoint, context, type_uri, format)
+        try:
+            try:
+                self.build(endpoint, context, type_uri, format)
+            except Exception, e:
+                logging.exception("Couldn't materialize %s as %s for %s: %s"%(type_uri, format, context, e))
+        finally:
+            self.lock.acquire()
+            try:
+                self.building.discard(job)
+            finally:
+                self.lock.release()
+
+    def written(self, endpoint, context):
+        """Queue rebuilds of the bodies a write to context has made stale."""
+        for (type_uri, format) in self.materialized(endpoint, context):
+            self.rebuild(endpoint, context, type_uri, format)
+
+    def response(self, c, smart_type, request):
+        """The stored response to request, a GET of smart_type's whole
+        collection from c's context, or None to answer it live."""
+        format = rdf_format(request, json=True)
+        if format not in self.formats: return None
+        type_uri = str(smart_type.node)
+
+        stored = self.get(c.endpoint, c.context, type_uri, format)
+        if stored is None:
+            self.misses += 1
+            self.rebuild(c.endpoint, c.context, type_uri, format)
+            return None
+
+        (header, body) = stored
+        current = list(c.generations())
+        stale = header["generations"] != current
+        if stale:
+            self.rebuild(c.endpoint, c.context, type_uri, format)
+            if time.time() - header["built"] > self.max_stale:
+                self.misses += 1
+                return None
+            self.stale_hits += 1
+        else:
+            self.hits += 1
+
+        gzipped = getattr(settings, 'RESPONSE_GZIP', True) and accepts_gzip(request)
+        r = HttpResponse(gzipped and body or zlib.decompress(body, 16 + zlib.MAX_WBITS),
+                         mimetype=rdf_formats[format][0])
+        if gzipped: r['Content-Encoding'] = 'gzip'
+        r['Vary'] = 'Accept, Accept-Encoding'
+        if stale:
+            r['Warning'] = '110 - "Response is Stale"'
+            r['ETag'] = etag(c, request, [smart_type], tuple(header["generations"]))
+        return x_domain(r)
+
+    def warm(self, record_ids, types, formats=None):
+        """Queue builds of types' collections (type URIs) for each record."""
+        for record_id in record_ids:
+            c = rdf_store.RecordStoreConnector(Record(id=record_id))
+            for type_uri in types:
+                for format in (formats or self.formats):
+                    self.rebuild(c.endpoint, c.context, type_uri, format)
+
+    def wait(self):
+        """Block until every queued build has run."""
+        while self.building:
+            time.sleep(0.05)
+
+    def stats(self):
+        ret = self.backend.stats()
+        ret["hits"] = self.hits
+        ret["stale_hits"] = self.stale_hits
+        ret["misses"] = self.misses
+        ret["building"] = len(self.building)
+        return ret
+
+store = None
+store_lock = threading.Lock()
+
+def get_store():
+    """The process-wide store configured by settings.RESPONSE_STORE_BACKEND
+    ('local', 'shared', or None to answer every GET live).  It needs the
+    SPARQL cache's write generations, so it's off without one."""
+    global store
+    if store is not None: return store or None
+
+    store_lock.acquire()
+    try:
+        if store is None:
+            kind = getattr(settings, 'RESPONSE_STORE_BACKEND', None)
+            max_entries = getattr(settings, 'RESPONSE_STORE_MAX_ENTRIES', 1000)
+            max_bytes = getattr(settings, 'RESPONSE_STORE_MAX_BYTES', 200*1024*1024)
+            backend = None
+            if kind and sparql_cache.get_cache() is None:
+                logging.warn("RESPONSE_STORE_BACKEND needs a SPARQL_CACHE_BACKEND; not materializing")
+            elif kind == 'local':
+                backend = sparql_cache.LocalMemoryBackend(max_entries, max_bytes)
+            elif kind == 'shared':
+                backend = sparql_cache.SharedFileBackend(settings.RESPONSE_STORE_FILE, max_entries, max_bytes)
+            elif kind:
+                logging.warn("Unknown RESPONSE_STORE_BACKEND %s; not materializing"%kind)
+
+            store = False
+            if backend:
+                store = ResponseStore(backend,
+                                      formats=getattr(settings, 'RESPONSE_STORE_FORMATS', ("xml", "json")),
+                                      max_stale=getattr(settings, 'RESPONSE_STORE_MAX_STALE', 0),
+                                      threads=getattr(settings, 'RESPONSE_STORE_THREADS', 2))
+    finally:
+        store_lock.release()
+    return store or None
+
+def written(endpoint, context):
+    s = get_store()
+    if s: s.written(endpoint, context)
+
+rdf_store.write_listeners.append(written)
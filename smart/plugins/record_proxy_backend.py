@@ -2,7 +2,7 @@ import re, RDF, uuid
 from django.conf import settings
 from smart.common.util import remap_node, parse_rdf, LookupType
 from smart.common.rdf_ontology import api_types, api_calls, ontology
-from smart.lib.utils import url_request
+from smart.lib.utils import url_request, url_request_open, rdf_stream_response
 from smart.models.rdf_rest_operations import *
 from smart.models.ontology_url_patterns import CallMapper, BasicCallMapper
 
@@ -11,8 +11,7 @@ PROXY_BASE  = "http://sandbox-api.smartplatforms.org"
 def proxy_get(request, *args, **kwargs):
     print "proxying request", request.path, args, kwargs
     url = PROXY_BASE + request.path    
-    ret = url_request(url, "GET", {})
-    return rdf_response(ret)
+    return rdf_stream_response(url_request_open(url, "GET", {}), request)
 
 @CallMapper.register
 class RecordItemProxy(BasicCallMapper):
@@ -0,0 +1,362 @@
+"""
+Tests of the record API against the configured triple store, and of
+the pieces below it that run offline: the embedded quad store, its
+SPARQL evaluator and the CONSTRUCT-to-DELETE rewrite, the N-Triples
+parser, the streaming RDF writers and the API's URL trie.
+
+To run:
+
+  python manage.py test smart
+"""
+
+from django.test import TestCase
+from django.http import HttpRequest, QueryDict
+from smart.models.records import Record
+from smart.models.record_object import RecordObject
+from smart.models.rdf_rest_operations import record_post_objects
+from smart.models.rdf_store import RecordStoreConnector
+from smart.models.ontology_url_patterns import URLTrie, OntologyURLMapper
+from smart.common.util import parse_sparql_results, parse_rdf, parse_ntriples, nt_term, looks_like_ntriples, sp, rdf
+from smart.common.util import serialize_rdf, serialize_chunks, bound_graph
+from smart.common.quad_store import QuadStore
+from smart.common import sparql_subset
+from rdflib import URIRef, Literal, BNode, ConjunctiveGraph
+from rdflib.compare import isomorphic
+import unittest, tempfile, shutil, re
+
+RECORD_ID = "9999999"
+
+MEDICATION = """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:sp="http://smartplatforms.org/terms#"
+         xmlns:dcterms="http://purl.org/dc/terms/">
+  <sp:Medication>
+    <sp:drugName>
+      <sp:CodedValue>
+        <sp:code rdf:resource="http://rxnav.nlm.nih.gov/REST/rxcui/213269"/>
+        <dcterms:title>Tylenol</dcterms:title>
+      </sp:CodedValue>
+    </sp:drugName>
+    <sp:startDate>2007-03-14</sp:startDate>
+  </sp:Medication>
+</rdf:RDF>"""
+
+FULFILLMENT = """<?xml version="1.0" encoding="utf-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns:sp="http://smartplatforms.org/terms#"
+         xmlns:dcterms="http://purl.org/dc/terms/">
+  <sp:Fulfillment>
+    <dcterms:date>2007-03-14</dcterms:date>
+    <sp:dispenseDaysSupply>30</sp:dispenseDaysSupply>
+  </sp:Fulfillment>
+</rdf:RDF>"""
+
+def post_request(path, data):
+    request = HttpRequest()
+    request.method = "POST"
+    request.path = path
+    request.GET = QueryDict("")
+    request.META = {'CONTENT_TYPE': "application/rdf+xml"}
+    request.raw_post_data = data
+    return request
+
+class RecordPostTests(TestCase):
+    def setUp(self):
+        self.record = Record.objects.create(id=RECORD_ID, full_name="Test Patient")
+        self.c = RecordStoreConnector(self.record)
+        self.c.destroy_triples()
+
+    def tearDown(self):
+        self.c.destroy_triples()
+
+    def subjects(self, type_name):
+        res = self.c.sparql("""
+            PREFIX rdf: <http://www.w3.org/1999/02/22-rdf-syntax-ns#>
+            SELECT ?s FROM $context WHERE { ?s rdf:type <http://smartplatforms.org/terms#%s> . }"""%type_name)
+        return [r['s'] for r in parse_sparql_results(res)]
+
+    def test_post_nested_object(self):
+        meds = RecordObject[sp.Medication]
+        fills = RecordObject[sp.Fulfillment]
+
+        r = record_post_objects(post_request("/records/%s/medications/"%RECORD_ID, MEDICATION), RECORD_ID, meds)
+        self.assertEqual(r.status_code, 200)
+        [med] = self.subjects("Medication")
+
+        med_id = str(med).rstrip("/").rsplit("/", 1)[-1]
+        path = "/records/%s/medications/%s/fulfillments/"%(RECORD_ID, med_id)
+        r = record_post_objects(post_request(path, FULFILLMENT), RECORD_ID, fills, above_obj=meds,
+                                medication_id=med_id)
+        self.assertEqual(r.status_code, 200)
+
+        [fill] = self.subjects("Fulfillment")
+        res = self.c.sparql("""
+            SELECT ?f FROM $context WHERE { <%s> <http://smartplatforms.org/terms#fulfillment> ?f . }"""%med)
+        self.assertEqual([s['f'] for s in parse_sparql_results(res)], [fill])
+
+G1 = URIRef("http://smartplatforms.org/records/1")
+G2 = URIRef("http://smartplatforms.org/records/2")
+MED = URIRef("http://smartplatforms.org/records/1/medications/1")
+MED2 = URIRef("http://smartplatforms.org/records/1/medications/2")
+
+class QuadStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_triples_by_pattern_and_context(self):
+        store = QuadStore()
+        store.apply(adds=[(MED, rdf.type, sp.Medication), (MED, sp.startDate, Literal("2007-03-14")),
+                          (MED2, rdf.type, sp.Medication)], context=G1)
+        store.apply(adds=[(MED, rdf.type, sp.Medication)], context=G2)
+
+        self.assertEqual(store.count(G1), 3)
+        self.assertEqual(store.count(G2), 1)
+        self.assertEqual(set(store.triples((None, rdf.type, sp.Medication), [G1])),
+                         set([(MED, rdf.type, sp.Medication, G1), (MED2, rdf.type, sp.Medication, G1)]))
+        self.assertEqual(len(list(store.triples((MED, None, None), [G1]))), 2)
+        self.assertEqual(len(list(store.triples((MED, rdf.type, None)))), 2)
+        self.assertEqual(list(store.triples((None, None, Literal("2007-03-14")), [G2])), [])
+
+    def test_transaction_order(self):
+        store = QuadStore()
+        store.apply(adds=[(MED, rdf.type, sp.Medication)], context=G1)
+        # Clears, then adds, then removes.
+        store.apply(clears=[G1], adds=[(MED2, rdf.type, sp.Medication), (MED2, sp.startDate, Literal("2009"))],
+                    removes=[(MED2, sp.startDate, Literal("2009"))], context=G1)
+        self.assertEqual(list(store.triples((None, None, None), [G1])), [(MED2, rdf.type, sp.Medication, G1)])
+        self.assertEqual(store.size, 1)
+
+    def test_journal_replay_and_compaction(self):
+        store = QuadStore(self.dir)
+        b = BNode()
+        store.apply(adds=[(MED, sp.drugName, b), (b, sp.code, URIRef("http://rxnav.nlm.nih.gov/REST/rxcui/213269")),
+                          (b, URIRef("http://purl.org/dc/terms/title"), Literal(u"Tyl\xe9nol \"500\"", lang="en"))],
+                    context=G1)
+        store.apply(adds=[(MED2, rdf.type, sp.Medication)], context=G2)
+        store.apply(removes=[(MED, sp.drugName, b)], context=G1)
+        store.apply(clears=[G2])
+        expected = set(store.triples((None, None, None)))
+
+        self.assertEqual(set(QuadStore(self.dir).triples((None, None, None))), expected)
+        store.compact()
+        replayed = QuadStore(self.dir)
+        self.assertEqual(set(replayed.triples((None, None, None))), expected)
+        self.assertEqual(replayed.size, 2)
+
+class SparqlSubsetTests(unittest.TestCase):
+    def setUp(self):
+        self.store = QuadStore()
+        b = BNode()
+        self.store.apply(adds=[(MED, rdf.type, sp.Medication), (MED, sp.startDate, Literal("2007-03-14")),
+                               (MED, sp.drugName, b), (b, rdf.type, sp.CodedValue),
+                               (b, URIRef("http://purl.org/dc/terms/title"), Literal("Tylenol")),
+                               (MED2, rdf.type, sp.Medication), (MED2, sp.startDate, Literal("2009-01-01"))],
+                         context=G1)
+        self.store.apply(adds=[(MED, rdf.type, sp.Problem)], context=G2)
+
+    def select(self, q):
+        return parse_sparql_results(sparql_subset.query(self.store, q))
+
+    def test_select_optional_order_limit(self):
+        sols = self.select("""
+            PREFIX sp: <http://smartplatforms.org/terms#>
+            PREFIX dcterms: <http://purl.org/dc/terms/>
+            SELECT ?m ?title FROM <%s>
+            WHERE { ?m a sp:Medication . OPTIONAL { ?m sp:drugName ?d . ?d dcterms:title ?title . } }
+            ORDER BY DESC(?m)"""%G1)
+        self.assertEqual([(s['m'], s.get('title')) for s in sols], [(MED2, None), (MED, Literal("Tylenol"))])
+
+        sols = self.select("SELECT ?m FROM <%s> WHERE { ?m <%s> ?date . } ORDER BY ?date LIMIT 1"%(G1, sp.startDate))
+        self.assertEqual([s['m'] for s in sols], [MED])
+
+    def test_filter_union_values(self):
+        sols = self.select("""SELECT ?m FROM <%s> WHERE { ?m <%s> ?d . FILTER(?d > "2008" || ?m = <%s>) }
+                              ORDER BY ?m"""%(G1, sp.startDate, MED))
+        self.assertEqual([s['m'] for s in sols], [MED, MED2])
+
+        sols = self.select("""SELECT ?x FROM <%s>
+                              WHERE { { ?x a <%s> . } UNION { ?x a <%s> . } VALUES ?x { <%s> } }"""%(
+                              G1, sp.Medication, sp.CodedValue, MED2))
+        self.assertEqual([s['x'] for s in sols], [MED2])
+
+    def test_construct_stays_in_its_graph(self):
+        g = parse_rdf(sparql_subset.query(self.store, "CONSTRUCT { ?s a ?t } FROM <%s> WHERE { ?s a ?t }"%G2))
+        self.assertEqual(list(g), [(MED, rdf.type, sp.Problem)])
+
+    def test_delete_update(self):
+        sparql_subset.update(self.store, """
+            WITH <%s> DELETE { ?m ?p ?o } WHERE { ?m a <%s> ; <%s> "2009-01-01" ; ?p ?o . }"""%(
+            G1, sp.Medication, sp.startDate))
+        self.assertEqual(list(self.store.triples((MED2, None, None))), [])
+        self.assertEqual(self.store.count(G1), 5)
+        self.assertEqual(self.store.count(G2), 1)
+
+    def test_unsupported_syntax(self):
+        self.assertRaises(sparql_subset.SparqlSyntaxError, sparql_subset.query, self.store,
+                          "ASK { ?s ?p ?o }")
+        self.assertRaises(sparql_subset.SparqlSyntaxError, sparql_subset.query, self.store,
+                          "SELECT ?s WHERE { ?s ?p ?o ")
+
+class ConstructToDeleteTests(unittest.TestCase):
+    def setUp(self):
+        self.store = QuadStore()
+        self.store.apply(adds=[(MED, rdf.type, sp.Medication), (MED, sp.startDate, Literal("2007-03-14")),
+                               (MED2, rdf.type, sp.Medication)], context=G1)
+        self.store.apply(adds=[(MED, sp.startDate, Literal("2007-03-14"))], context=G2)
+
+    def test_deletes_what_construct_returns(self):
+        q = """PREFIX sp: <http://smartplatforms.org/terms#>
+               CONSTRUCT { ?m sp:startDate ?d } FROM $context WHERE { ?m sp:startDate ?d }"""
+        u = sparql_subset.construct_to_delete(q)
+        self.assertTrue(u.startswith("PREFIX sp:"))
+        sparql_subset.update(self.store, u.replace("$context", G1.n3()))
+        self.assertEqual(list(self.store.triples((None, sp.startDate, None), [G1])), [])
+        self.assertEqual(self.store.count(G1), 2)
+        self.assertEqual(self.store.count(G2), 1)
+
+    def test_rejects_queries_reaching_past_from_graph(self):
+        for q in ["CONSTRUCT { ?s ?p ?o } FROM $context WHERE { GRAPH <%s> { ?s ?p ?o } }"%G2,
+                  "CONSTRUCT { ?s ?p ?o } FROM $context WHERE { ?s ?p ?x . { graph ?g { ?s ?p ?o } } }",
+                  "CONSTRUCT { ?s ?p ?o } FROM $context WHERE { SERVICE <http://example.org/sparql> { ?s ?p ?o } }",
+                  "CONSTRUCT { GRAPH <%s> { ?s ?p ?o } } FROM $context WHERE { ?s ?p ?o }"%G2,
+                  "CONSTRUCT { ?s ?p ?o } FROM $context FROM NAMED <%s> WHERE { ?s ?p ?o }"%G2,
+                  "CONSTRUCT { ?s ?p ?o } FROM $context FROM <%s> WHERE { ?s ?p ?o }"%G2]:
+            self.assertRaises(sparql_subset.SparqlSyntaxError, sparql_subset.construct_to_delete, q)
+
+    def test_rejects_what_a_delete_cant_express(self):
+        for q in ["CONSTRUCT { ?s ?p _:b } FROM $context WHERE { ?s ?p ?o }",
+                  "CONSTRUCT { ?s ?p ?o } FROM $context WHERE { ?s ?p ?o } LIMIT 10",
+                  "CONSTRUCT { ?s ?p ?o } WHERE { ?s ?p ?o }",
+                  "SELECT ?s FROM $context WHERE { ?s ?p ?o }"]:
+            self.assertRaises(sparql_subset.SparqlSyntaxError, sparql_subset.construct_to_delete, q)
+
+NTRIPLES = r"""# A comment, then a blank line
+
+<http://smartplatforms.org/records/1/medications/1> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://smartplatforms.org/terms#Medication> .
+<http://smartplatforms.org/records/1/medications/1> <http://smartplatforms.org/terms#drugName> _:b1 .
+_:b1 <http://purl.org/dc/terms/title> "Tylenol \"Extra\" \\ strength\tcaplet\u00E9\U0001F48A" .
+<http://smartplatforms.org/records/1/medications/1> <http://smartplatforms.org/terms#startDate> "2007-03-14"^^<http://www.w3.org/2001/XMLSchema#date> .
+  <http://smartplatforms.org/records/1/medications/1>   <http://smartplatforms.org/terms#notes>   "" .
+_:b1 <http://purl.org/dc/terms/title> "Tyl\u00E9nol"@fr .
+"""
+
+class NTriplesParserTests(unittest.TestCase):
+    def test_matches_rdflib(self):
+        ours = ConjunctiveGraph()
+        ours.addN([(s, p, o, ours) for (s, p, o) in parse_ntriples(NTRIPLES)])
+        theirs = ConjunctiveGraph()
+        theirs.parse(data=NTRIPLES, format="nt")
+        self.assertEqual(len(ours), 6)
+        self.assertTrue(isomorphic(ours, theirs))
+
+    def test_terms(self):
+        self.assertEqual(nt_term(r'"a\"b\\c\nd"'), Literal(u'a"b\\c\nd'))
+        self.assertEqual(nt_term(r'"\u00E9t\u00E9"@fr'), Literal(u"\xe9t\xe9", lang="fr"))
+        self.assertEqual(nt_term('"5"^^<http://www.w3.org/2001/XMLSchema#integer>'),
+                         Literal("5", datatype=URIRef("http://www.w3.org/2001/XMLSchema#integer")))
+        self.assertEqual(nt_term("_:node1"), BNode("node1"))
+        self.assertEqual(nt_term("<http://example.org/a%20b>"), URIRef("http://example.org/a%20b"))
+
+    def test_utf8(self):
+        # Beyond N-Triples' ASCII, but what a UTF-8 store may send.
+        [(s, p, o)] = list(parse_ntriples('_:b1 <http://purl.org/dc/terms/title> "Tyl\xc3\xa9nol" .\n'))
+        self.assertEqual(o, Literal(u"Tyl\xe9nol"))
+
+    def test_blank_nodes_shared_within_a_parse(self):
+        [(s1, p1, o1), (s2, p2, o2)] = list(parse_ntriples(NTRIPLES.splitlines()[3:5]))
+        self.assertEqual(o1, s2)
+
+    def test_format_sniffing(self):
+        self.assertTrue(looks_like_ntriples(NTRIPLES))
+        self.assertTrue(looks_like_ntriples(""))
+        self.assertFalse(looks_like_ntriples(MEDICATION))
+        self.assertEqual(len(parse_rdf(NTRIPLES)), 6)
+        self.assertEqual(len(parse_rdf(MEDICATION)), 6)
+
+    def test_bad_line(self):
+        self.assertRaises(Exception, list, parse_ntriples('<http://example.org/a> <http://example.org/b> "unterminated .'))
+
+def writer_test_graph():
+    g = bound_graph()
+    b, b2 = BNode(), BNode()
+    dcterms = "http://purl.org/dc/terms/"
+    g.add((MED, rdf.type, sp.Medication))
+    g.add((MED, sp.drugName, b))
+    g.add((b, rdf.type, sp.CodedValue))
+    g.add((b, sp.code, URIRef("http://rxnav.nlm.nih.gov/REST/rxcui/213269?a=1&b=2")))
+    g.add((b, URIRef(dcterms + "title"), Literal(u'Tylenol "Extra" <500mg> & \\ co\n\ttabs \r\xe9\u4e2d\U0001F48A')))
+    g.add((b, URIRef(dcterms + "title"), Literal(u"Tyl\xe9nol", lang="fr")))
+    g.add((MED, sp.startDate, Literal("2007-03-14", datatype=URIRef("http://www.w3.org/2001/XMLSchema#date"))))
+    g.add((MED, URIRef("http://example.org/not-a-known-ns#note"), Literal("")))
+    g.add((MED, URIRef("http://example.org/vocab/v1.0"), b2))
+    g.add((b2, URIRef("http://example.org/vocab/count"), Literal("3")))
+    return g
+
+class RdfWriterTests(unittest.TestCase):
+    def round_trip(self, format, rdflib_format):
+        g = writer_test_graph()
+        parsed = ConjunctiveGraph()
+        parsed.parse(data=serialize_rdf(g, format), format=rdflib_format)
+        self.assertEqual(len(parsed), len(g))
+        self.assertTrue(isomorphic(parsed, g))
+
+    def test_rdf_xml_round_trip(self):
+        self.round_trip("xml", "xml")
+
+    def test_ntriples_round_trip(self):
+        self.round_trip("nt", "nt")
+        self.assertTrue(isomorphic(parse_rdf(serialize_rdf(writer_test_graph(), "nt")), writer_test_graph()))
+
+    def test_turtle_round_trip(self):
+        self.round_trip("turtle", "n3")
+
+    def test_chunks(self):
+        g = bound_graph()
+        for i in xrange(500):
+            g.add((URIRef("http://smartplatforms.org/records/1/medications/%s"%i), rdf.type, sp.Medication))
+        for format in ("xml", "nt", "turtle"):
+            chunks = list(serialize_chunks(g, format, chunk_size=1024))
+            self.assertTrue(len(chunks) > 1)
+            self.assertEqual([type(c) for c in chunks], [str] * len(chunks))
+            self.assertEqual("".join(chunks), serialize_rdf(g, format))
+
+class URLTrieTests(unittest.TestCase):
+    def setUp(self):
+        self.trie = URLTrie()
+        self.trie.add(["records", "{record_id}", ""], "record")
+        self.trie.add(["records", "search", ""], "search")
+        self.trie.add(["records", "search", "recent"], "recent")
+        self.trie.add(["records", "{record_id}", "medications", ""], "meds", {"obj": "Medication"})
+        self.trie.add(["records", "{record_id}", "medications", "{medication_id}"], "med")
+
+    def test_bindings_and_arguments(self):
+        self.assertEqual(self.trie.resolve("records/1/"), ("record", (), {"record_id": "1"}))
+        self.assertEqual(self.trie.resolve("records/1/medications/"),
+                         ("meds", (), {"record_id": "1", "obj": "Medication"}))
+        self.assertEqual(self.trie.resolve("records/1/medications/2"),
+                         ("med", (), {"record_id": "1", "medication_id": "2"}))
+
+    def test_literals_preferred_with_backtracking(self):
+        self.assertEqual(self.trie.resolve("records/search/"), ("search", (), {}))
+        # The literal "search" branch has no medications below it.
+        self.assertEqual(self.trie.resolve("records/search/medications/"),
+                         ("meds", (), {"record_id": "search", "obj": "Medication"}))
+
+    def test_no_match(self):
+        for path in ["records/1", "records//", "records/1/medications/2/", "records/1/problems/", "other/1/", ""]:
+            self.assertEqual(self.trie.resolve(path), None, path)
+
+    def test_ontology_routes(self):
+        # Every API path resolves to its own calls, binding what the
+        # per-path regex it replaced would have.
+        import smart.urls.urls      # registers the views calls map to
+        mapper = OntologyURLMapper([])
+        for (path, calls) in mapper.calls_by_path():
+            sample = re.sub("{(.*?)}", lambda m: m.group(1) + "_x", str(path).split("?")[0])[1:]
+            (view, args, kwargs) = mapper.trie.resolve(sample)
+            self.assertEqual(sorted(view.methods.keys()), sorted(set([str(c.method) for c in calls])), path)
+            groups = re.match(mapper.django_path(path), sample).groupdict()
+            self.assertEqual(dict([(k, kwargs[k]) for k in groups]), groups)
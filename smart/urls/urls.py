@@ -24,6 +24,10 @@ urlpatterns += patterns(
     (r'^records/search/xml$', record_search_xml),
     (r'^records/search$', record_search),
     (r'^records/(?P<record_id>[^/]+)$', record_info),
+    (r'^records/(?P<record_id>[^/]+)/batch$', MethodDispatcher({
+                                       'GET': record_batch,
+                                       'POST': record_batch,
+                                       'OPTIONS' : allow_options})),
 
     (r'^accounts/(?P<account_id>[^/]+)/apps/(?P<app_email>[^/]+)$', MethodDispatcher({
                 'PUT': add_app,
@@ -7,6 +7,7 @@ from pha import *
 from account import *
 from smarthacks import *
 from rdfstore import *
+from batch import *
 
 from django.http import HttpResponse
 def get_version(request): return HttpResponse(VERSION, mimetype="text/plain")
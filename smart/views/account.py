@@ -49,6 +49,8 @@ def account_password_set(request, account):
 @paramloader()
 def record_get_alerts(request, record):
   alerts = RecordAlert.objects.filter(record=record)
+  if utils.wants_json(request):
+    return utils.json_response([a.to_json() for a in alerts], request)
   return render_template('alerts', { 'alerts': alerts }, type='xml')
 
 @paramloader()
@@ -232,7 +234,7 @@ def user_get(request, user_id, **kwargs):
         m = a.to_rdf()
     except: return HttpResponseNotFound()
     
-    return utils.x_domain(HttpResponse(utils.serialize_rdf(m), "application/rdf+xml"))
+    return utils.rdf_graph_response(m, request)
 
 
 @CallMapper.register(method="GET",
@@ -257,5 +259,5 @@ def user_search(request, **kwargs):
         print "Adding ", a.email, a.given_name, a.family_name
         a.to_rdf(m)
     
-    return utils.x_domain(HttpResponse(utils.serialize_rdf(m), "application/rdf+xml"))
+    return utils.rdf_graph_response(m, request)
 
@@ -0,0 +1,196 @@
+"""
+Several GETs of one record's data in one request
+
+GET /records/{record_id}/batch?path=...&path=... (or a POST of a JSON
+list of paths, or of {"path": ..., "etag": ...} objects) answers each
+path as if it had been requested on its own, by the same principal:
+the batch is authenticated and authorized once, and each part is then
+checked against the principal's permissions in memory and must be a
+GET of the same record.  Parts run concurrently, at most
+SPARQL_MAX_CONCURRENCY at a time.
+
+The answer is multipart/mixed, one application/http response per part,
+or -- for Accept: application/json -- {"responses": [...]} with each
+part's status, ETag and (JSON) body.  Parts fail on their own: a part
+that can't be found, isn't allowed or breaks is reported with its own
+status, and the rest of the batch is still answered.
+"""
+
+from django.conf import settings
+from django.core import urlresolvers
+from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
+from django.core.handlers.base import BaseHandler
+from django.core.handlers.wsgi import STATUS_CODE_TEXT
+from django.db import connection
+from django.http import HttpRequest, HttpResponse, HttpResponseBadRequest, Http404, QueryDict
+from django.utils import simplejson
+from smart.lib.utils import x_domain, accepts_gzip, gzip_chunks, wants_json
+from smart.common.util import BadRequest
+from multiprocessing.pool import ThreadPool
+import threading, urlparse, uuid, logging
+
+__all__ = ["record_batch"]
+
+class BatchPartRequest(HttpRequest):
+    """A GET of one part of a batch, made as the batch's principal; the
+    batch's headers apply, except those about encoding and caching the
+    batch itself."""
+    def __init__(self, request, path, query, etag=None):
+        HttpRequest.__init__(self)
+        self.method = "GET"
+        self.path = path
+        self.GET = QueryDict(query)
+        self.META = dict([(k, v) for (k, v) in request.META.iteritems()
+                          if k not in ('HTTP_ACCEPT_ENCODING', 'HTTP_IF_NONE_MATCH', 'CONTENT_TYPE', 'CONTENT_LENGTH')])
+        self.META.update({'REQUEST_METHOD': "GET", 'PATH_INFO': path, 'QUERY_STRING': query})
+        if etag: self.META['HTTP_IF_NONE_MATCH'] = etag
+        self.principal = getattr(request, 'principal', None)
+        self.oauth_request = getattr(request, 'oauth_request', None)
+        self.raw_post_data = ""
+
+def batch_parts(request):
+    """[(path, etag)] asked for, from ?path= or a POSTed JSON list."""
+    if request.method == "POST":
+        entries = simplejson.loads(request.raw_post_data)
+        if type(entries) == dict: entries = entries["paths"]
+    else:
+        entries = request.GET.getlist('path')
+    ret = []
+    for e in entries:
+        if type(e) == dict: ret.append((e["path"], e.get("etag")))
+        else: ret.append((e, None))
+    return ret
+
+exception_handler = None
+
+def exception_response(part, e):
+    """The response the site's middleware makes of an exception raised by
+    a part's view (as it would for a view it had called), or None."""
+    global exception_handler
+    if exception_handler is None:
+        handler = BaseHandler()
+        handler.load_middleware()
+        exception_handler = handler
+    for f in exception_handler._exception_middleware:
+        r = f(part, e)
+        if r: return r
+    return None
+
+def part_response(r):
+    body = "".join(r)
+    return (r.status_code, [(h, r[h]) for h in ('Content-Type', 'ETag', 'Warning') if r.has_header(h)], body)
+
+def get_part(request, record_id, path, etag):
+    """(status, [(header, value)], body) of one part."""
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(path)
+    part = BatchPartRequest(request, path, query, etag)
+    try:
+        (view, args, kwargs) = urlresolvers.resolve(path)
+        if hasattr(view, 'resolve'):
+            view = view.resolve(part)
+        if view is None:
+            return (405, [], "No GET for %s"%path)
+        if kwargs.get('record_id') != record_id or not request.principal.permset.evaluate(part, view, args, kwargs):
+            raise PermissionDenied
+
+        return part_response(view(part, *args, **kwargs))
+    except (Http404, ObjectDoesNotExist):
+        return (404, [], "No resource at %s"%path)
+    except PermissionDenied:
+        return (403, [], "Not permitted to GET %s"%path)
+    except BadRequest, e:
+        return (400, [], str(e))
+    except Exception, e:
+        r = exception_response(part, e)
+        if r: return part_response(r)
+        logging.exception("Batch part %s failed: %s"%(path, e))
+        return (500, [], "Failed to GET %s"%path)
+
+def get_pooled_part(request, record_id, path, etag):
+    """get_part, on a batch_pool thread.  Django opens a database
+    connection per thread, and nothing else would close this one."""
+    try:
+        return get_part(request, record_id, path, etag)
+    finally:
+        connection.close()
+
+batch_pool = None
+batch_pool_lock = threading.Lock()
+
+def get_parts(request, record_id, parts):
+    """Answer each (path, etag) part on a shared pool -- not the SPARQL
+    query pool, which the parts' own views may be waiting on -- with at
+    most SPARQL_MAX_CONCURRENCY of them running at once."""
+    global batch_pool
+    cap = getattr(settings, 'SPARQL_MAX_CONCURRENCY', 4)
+    if len(parts) < 2 or cap < 2:
+        return [get_part(request, record_id, p, e) for (p, e) in parts]
+
+    if batch_pool is None:
+        batch_pool_lock.acquire()
+        try:
+            if batch_pool is None:
+                batch_pool = ThreadPool(getattr(settings, 'BATCH_THREADS', 10))
+        finally:
+            batch_pool_lock.release()
+
+    results = [None] * len(parts)
+    in_flight = []
+    for (i, (p, e)) in enumerate(parts):
+        if len(in_flight) >= cap:
+            (j, r) = in_flight.pop(0)
+            results[j] = r.get()
+        in_flight.append((i, batch_pool.apply_async(get_pooled_part, (request, record_id, p, e))))
+    for (j, r) in in_flight:
+        results[j] = r.get()
+    return results
+
+def multipart_chunks(parts, results, boundary):
+    for (i, ((path, etag), (status, headers, body))) in enumerate(zip(parts, results)):
+        yield "--%s\r\nContent-Type: application/http\r\nContent-ID: <%s>\r\nContent-Location: %s\r\n\r\n"%(
+            boundary, i, path)
+        yield "HTTP/1.1 %s %s\r\n"%(status, STATUS_CODE_TEXT.get(status, "UNKNOWN"))
+        for (h, v) in headers:
+            yield "%s: %s\r\n"%(h, v)
+        yield "Content-Length: %s\r\n\r\n"%len(body)
+        yield body
+        yield "\r\n"
+    yield "--%s--\r\n"%boundary
+
+def json_part(path, status, headers, body):
+    headers = dict(headers)
+    ret = {"path": path, "status": status}
+    if 'ETag' in headers: ret["etag"] = headers['ETag']
+    if 'Warning' in headers: ret["warning"] = headers['Warning']
+    if headers.get('Content-Type', '').startswith("application/json"):
+        ret["body"] = simplejson.loads(body)
+    elif body:
+        ret["body"] = body.decode("utf-8")
+    return ret
+
+def record_batch(request, record_id):
+    try:
+        parts = batch_parts(request)
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest("Expected a JSON list of paths")
+    if not parts:
+        return HttpResponseBadRequest("No paths to GET")
+    if len(parts) > getattr(settings, 'BATCH_MAX_PARTS', 20):
+        return HttpResponseBadRequest("At most %s paths per batch"%getattr(settings, 'BATCH_MAX_PARTS', 20))
+
+    results = get_parts(request, record_id, parts)
+
+    if wants_json(request):
+        chunks = [simplejson.dumps({"responses": [json_part(p, *res) for ((p, e), res) in zip(parts, results)]},
+                                   sort_keys=True)]
+        mimetype = "application/json"
+    else:
+        boundary = "batch_%s"%uuid.uuid4().hex
+        chunks = multipart_chunks(parts, results, boundary)
+        mimetype = "multipart/mixed; boundary=%s"%boundary
+
+    gzip = getattr(settings, 'RESPONSE_GZIP', True) and accepts_gzip(request)
+    r = HttpResponse(gzip and gzip_chunks(chunks) or chunks, mimetype=mimetype)
+    if gzip: r['Content-Encoding'] = 'gzip'
+    r['Vary'] = 'Accept, Accept-Encoding'
+    return x_domain(r)
@@ -4,7 +4,8 @@ Josh Mandel
 """
 
 from base import utils, PHAConnector, urllib
-from smart.lib.utils import rdf_response
+from smart.lib.utils import rdf_graph_response, rdf_get, rdf_delete, conditional_get
+from smart.common.util import parse_rdf
 
 """ 
 Implementation of application-specific storage
@@ -29,7 +30,7 @@ def pha_storage_post (request, pha_email):
         connector.pending_adds.append(s)
     connector.execute_transaction()
     
-    return rdf_response(serialize_rdf(g))
+    return rdf_graph_response(g, request)
 
 def pha_storage_get (request, pha_email):    
     # todo: fix so apps can't get other apps' RDF.
@@ -38,10 +39,10 @@ def pha_storage_get (request, pha_email):
         query = request.GET[SPARQL].replace("WHERE", " from $context WHERE ")
 
     connector = PHAConnector(request) 
-    return rdf_get(connector, query)   
+    return conditional_get(connector, request, None, lambda: rdf_get(connector, query, request))
 
 def pha_storage_delete(request, pha_email):
     query =  urllib.unquote_plus(request.raw_post_data[7:]).encode()      
     query = query.replace("WHERE", " from $context WHERE ")
     connector = PHAConnector(request)
-    return rdf_delete(connector, query)
+    return rdf_delete(connector, query, request=request)
@@ -45,7 +45,7 @@ def container_capabilities(request, **kwargs):
              sp['capability'],
              sporg['capability/Pillbox/lookup']))
     
-    return utils.x_domain(HttpResponse(utils.serialize_rdf(m), "application/rdf+xml"))
+    return utils.rdf_graph_response(m, request)
 
 @paramloader()
 def record_list(request, account):
@@ -179,6 +179,9 @@ def remove_app(request, account, app):
 
 def record_search(request):
     q = request.GET.get('sparql', None)
+    if utils.wants_json(request):
+        demographics = RecordObject["http://smartplatforms.org/terms#Demographics"]
+        return utils.rdf_graph_response(Record.search_records_graph(q), request, [demographics.smart_type])
     record_list = Record.search_records(q)
     return HttpResponse(record_list, mimetype="application/rdf+xml")
 